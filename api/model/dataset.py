@@ -1,7 +1,5 @@
 from pydantic import BaseModel, Field
 
-from backend.fineselection.retriever.retriever import RetrieverType
-
 
 class Dataset(BaseModel):
     name: str = Field(description="Name of the dataset.")
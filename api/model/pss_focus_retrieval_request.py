@@ -1,6 +1,8 @@
 from pydantic import BaseModel, Field, validator
 from typing import Optional
 
+from backend.util.availability import dataset_is_available
+
 
 class PSSFocusRetrievalRequest(BaseModel):
     focus: str = Field(description="Focus word(s)")
@@ -38,7 +40,6 @@ class PSSFocusRetrievalRequest(BaseModel):
 
     @validator('dataset')
     def image_pool_must_exist(cls, dataset: str):
-        from backend import MMIRS
-        if not MMIRS.dataset_is_available(dataset):
+        if not dataset_is_available(dataset.strip()):
             raise ValueError(f"Dataset {dataset} does not exist!")
         return dataset.strip()
@@ -2,8 +2,9 @@ from typing import Optional
 
 from pydantic import BaseModel, Field, validator, root_validator
 
-# FIXME this import takes a lot of time due to cascading imports
-from backend.fineselection.fine_selection_stage import RankedBy
+from backend.fineselection.ranked_by import RankedBy
+from backend.fineselection.wra_format import WRA_FORMATS
+from backend.util.availability import get_available_retrievers, dataset_is_available
 
 
 class RetrievalRequest(BaseModel):
@@ -28,8 +29,15 @@ class RetrievalRequest(BaseModel):
                                           default=False)
     return_wra_matrices: Optional[bool] = Field(description="If true the WRA matrices of the top-k images are returned",
                                                 default=False)
+    wra_format: Optional[str] = Field(
+        description="Format of the returned WRA matrices. Either 'plot' (URLs of the plots) or 'npz' (a binary npz "
+                    "archive with the float16 WRA matrices, the tokens and the image URLs)",
+        default='plot')
     return_timings: Optional[bool] = Field(description="If true timings of the operation are returned",
                                            default=False)
+    thumbnail_width: Optional[int] = Field(
+        description="If set, the URLs of the (not annotated) images point to resized variants with (about) this width",
+        default=None)
 
     @root_validator
     def focus_must_exist_in_context(cls, values):
@@ -42,21 +50,19 @@ class RetrievalRequest(BaseModel):
 
     @validator('retriever')
     def retriever_must_exist(cls, retriever: str):
-        from backend import MMIRS
-        if retriever.strip() not in MMIRS.get_available_retrievers():
+        if retriever.strip() not in get_available_retrievers():
             raise ValueError(f"Retriever {retriever} does not exist!")
         return retriever.strip()
 
     @validator('dataset')
     def image_pool_must_exist(cls, dataset: str):
-        from backend import MMIRS
-        if not MMIRS.dataset_is_available(dataset):
+        if not dataset_is_available(dataset.strip()):
             raise ValueError(f"Dataset {dataset} does not exist!")
         return dataset.strip()
 
     @validator('ranked_by')
     def ranked_by_must_be_valid(cls, ranked_by: RankedBy):
-        if ranked_by != RankedBy.COMBINED or ranked_by != RankedBy.FOCUS or ranked_by != RankedBy.COMBINED:
+        if ranked_by not in (RankedBy.CONTEXT, RankedBy.FOCUS, RankedBy.COMBINED):
             ranked_by = RankedBy.COMBINED
         return ranked_by
 
@@ -66,6 +72,18 @@ class RetrievalRequest(BaseModel):
             raise ValueError("Focus Weight has to be between 0 and 1!")
         return focus_weight
 
+    @validator('wra_format')
+    def wra_format_must_be_valid(cls, wra_format: str):
+        if wra_format not in WRA_FORMATS:
+            raise ValueError(f"WRA Format has to be one of {WRA_FORMATS}!")
+        return wra_format
+
+    @validator('thumbnail_width')
+    def thumbnail_width_must_be_positive(cls, thumbnail_width: Optional[int]):
+        if thumbnail_width is not None and thumbnail_width <= 0:
+            raise ValueError("Thumbnail Width has to be positive!")
+        return thumbnail_width
+
     @validator('context')
     def context_must_not_be_empty(cls, context: str):
         if context is None or len(context) == 0:
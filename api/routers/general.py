@@ -1,7 +1,10 @@
-from fastapi import APIRouter
-from fastapi.responses import RedirectResponse, JSONResponse
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import RedirectResponse, JSONResponse, PlainTextResponse
 from loguru import logger
 
+from backend import MMIRS
+from backend.util.metrics import MetricsRegistry
+
 router = APIRouter()
 
 
@@ -17,3 +20,34 @@ async def root_to_docs():
 async def heartbeat():
     logger.info("GET request on /heartbeat")
     return JSONResponse(content=True)
+
+
+@router.get("/metrics", tags=["general"], description="Metrics in the Prometheus text format")
+async def metrics():
+    return PlainTextResponse(content=MetricsRegistry().render(), media_type="text/plain; version=0.0.4")
+
+
+@router.get("/ready", tags=["general"],
+            description="Readiness check. Responds with 503 while the datasets configured for the warm up are loading "
+                        "(see lazy_init). Lists the datasets (and retrievers) that are ready.")
+async def ready():
+    mmirs = MMIRS()
+    ready_datasets = [{'dataset': ds, 'retriever': ret} for ds, ret in mmirs.get_ready_datasets()]
+    is_ready = not mmirs.is_warming_up()
+    return JSONResponse(content={'ready': is_ready, 'datasets': ready_datasets}, status_code=200 if is_ready else 503)
+
+
+@router.get("/ready/{dataset}", tags=["general"],
+            description="Readiness check of a dataset. Responds with 503 if the models and indices required to retrieve "
+                        "images of the dataset with the retriever are not loaded yet. If warm_up is true, they get "
+                        "loaded in the background.")
+async def dataset_ready(dataset: str, retriever: str = 'teran_coco', warm_up: bool = False):
+    mmirs = MMIRS()
+    if (dataset, retriever) not in mmirs.get_available_image_feature_pools():
+        raise HTTPException(status_code=404, detail=f"{dataset} ImagePool for {retriever} Retriever is not available!")
+    is_ready = mmirs.is_ready(dataset, retriever)
+    if not is_ready and warm_up:
+        logger.info(f"Requested warm up of {dataset} for {retriever}")
+        mmirs.request_warm_up(dataset, retriever)
+    return JSONResponse(content={'dataset': dataset, 'retriever': retriever, 'ready': is_ready},
+                        status_code=200 if is_ready else 503)
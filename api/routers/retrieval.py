@@ -1,7 +1,11 @@
-from fastapi import APIRouter
+import asyncio
+from functools import partial
+
+from fastapi import APIRouter, HTTPException
 from loguru import logger
-from starlette.responses import JSONResponse
-from typing import List
+from pydantic import BaseModel
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from typing import List, Union, Callable, AsyncIterator, Optional, TypeVar
 
 from api.model import RetrievalRequest
 from api.model.dataset import Dataset
@@ -9,41 +13,187 @@ from api.model.pss_context_retrieval_request import PSSContextRetrievalRequest
 from api.model.pss_focus_retrieval_request import PSSFocusRetrievalRequest
 from api.model.retriever import Retriever
 from backend import MMIRS
+from backend.fineselection.wra_format import NPZ_MEDIA_TYPE
+from backend.util.event_stream import EventStream, encode_ndjson_event, NDJSON_MEDIA_TYPE
+from backend.util.metrics import MetricsRegistry
 from backend.util.mmirs_timer import MMIRSTimer
+from backend.util.request_executor import RequestExecutor, RequestRejectedError
+from backend.util.result_cache import ResultCache, CACHE_STATUS_HEADER
+from backend.util.slow_request_profiler import SlowRequestProfiler
+from backend.util.wra_payload import encode_wra_payload
 
 router = APIRouter()
 timer = MMIRSTimer()
+metrics = MetricsRegistry()
+profiler = SlowRequestProfiler()
+
+T = TypeVar('T')
 
 PREFIX = '/retrieval'
 TAGS = ["retrieval"]
 
 
+def run_profiled(fn: Callable[..., Response], req: BaseModel, *args) -> Response:
+    # slow requests get profiled (see SlowRequestProfiler)
+    with profiler.profile(name=fn.__name__.lstrip('_'), params=req.dict()):
+        return fn(req, *args)
+
+
+def rejected(e: RequestRejectedError) -> HTTPException:
+    logger.warning(e)
+    metrics.counter('mmirs_requests_rejected_total', 'Requests rejected by the RequestExecutor').inc()
+    return HTTPException(status_code=429, detail=str(e), headers={'Retry-After': '1'})
+
+
+def timed_out() -> HTTPException:
+    logger.error(f"Request timed out after {RequestExecutor().timeout}s!")
+    metrics.counter('mmirs_requests_timed_out_total', 'Requests that exceeded the timeout').inc()
+    return HTTPException(status_code=503,
+                         detail=f"Request timed out after {RequestExecutor().timeout}s!",
+                         headers={'Retry-After': '5'})
+
+
+async def run_in_request_executor(fn: Callable[[BaseModel], Response], req: BaseModel) -> Response:
+    # the MMIRS calls are blocking, so they run in the bounded RequestExecutor to keep the event loop responsive
+    try:
+        return await RequestExecutor().run(run_profiled, fn, req)
+    except RequestRejectedError as e:
+        raise rejected(e)
+    except asyncio.TimeoutError:
+        raise timed_out()
+
+
+async def run_in_thread(fn: Callable[..., T], *args, **kwargs) -> T:
+    # blocking I/O (e.g. the sqlite ResultCache) runs in the default thread pool to keep the event loop responsive
+    return await asyncio.get_event_loop().run_in_executor(None, partial(fn, *args, **kwargs))
+
+
+def result_cache_key(req: RetrievalRequest) -> Optional[str]:
+    """
+    Computes the key of the request in the ResultCache or returns None if the response must not be cached, i.e., if
+    the timings are requested or the response contains URLs of annotated images or wra plots. These artifacts are only
+    registered at the image server of this process and can get evicted from the render caches.
+    """
+    cache = ResultCache()
+    if not cache.enabled or req.return_timings or req.annotate_max_focus_region or \
+            (req.return_wra_matrices and req.wra_format == 'plot'):
+        return None
+    params = req.dict(exclude={'return_timings'})
+    # whitespace does not change the result
+    params['context'] = ' '.join(req.context.split())
+    params['focus'] = ' '.join(req.focus.split())
+    return cache.compute_key('top_k_images', params, dataset=req.dataset, retriever=req.retriever)
+
+
 @router.post('/top_k_images',
              tags=TAGS,
-             description='Retrieve the top-k images for the query.')
-async def top_k_images(req: RetrievalRequest) -> JSONResponse:
+             description='Retrieve the top-k images for the query. If return_wra_matrices is true and wra_format is '
+                         'npz, the response is a binary npz archive (application/x-npz). The X-MMIRS-Cache header '
+                         'tells if the response was served from the result cache (HIT, MISS or BYPASS).')
+async def top_k_images(req: RetrievalRequest) -> Union[JSONResponse, Response]:
     logger.info(f"POST request on {PREFIX}/top_k_images with RetrievalRequest: {req}")
-    timer.start_new_timing_session()
-    urls = MMIRS().retrieve_top_k_images(req)
+    # computing the key stats the data files (see ResultCache.get_data_version)
+    key = await run_in_thread(result_cache_key, req)
+    if key is None:
+        response = await run_in_request_executor(_top_k_images, req)
+        response.headers[CACHE_STATUS_HEADER] = 'BYPASS'
+        return response
+
+    cached = await run_in_thread(ResultCache().get, key)
+    if cached is not None:
+        media_type, body = cached
+        return Response(content=body, media_type=media_type, headers={CACHE_STATUS_HEADER: 'HIT'})
+    response = await run_in_request_executor(_top_k_images, req)
+    await run_in_thread(ResultCache().put, key, media_type=response.media_type, body=response.body)
+    response.headers[CACHE_STATUS_HEADER] = 'MISS'
+    return response
+
+
+def _top_k_images(req: RetrievalRequest) -> Union[JSONResponse, Response]:
+    # the timing session is request-scoped, i.e., nothing gets measured if neither the timings are requested nor the
+    # metrics are enabled
+    with timer.timing_session(enabled=req.return_timings or metrics.enabled) as session:
+        urls = MMIRS().retrieve_top_k_images(req)
+    timings = session.get_measurements() if req.return_timings else None
+    if req.return_wra_matrices and req.wra_format == 'npz':
+        img_urls, wra = urls
+        payload = encode_wra_payload(image_urls=img_urls,
+                                     wra_matrices=wra['wra'],
+                                     context_tokens=wra['context_tokens'],
+                                     focus_span=wra['focus_span'],
+                                     max_focus_region_indices=wra['max_focus_region_indices'],
+                                     timings=timings)
+        return Response(content=payload, media_type=NPZ_MEDIA_TYPE)
     if req.return_timings:
-        timings = timer.get_current_timing_session().get_measurements()
         return JSONResponse(content={'urls': urls, 'timings': timings})
     else:
         return JSONResponse(content=urls)
 
 
+@router.post('/top_k_images/stream',
+             tags=TAGS,
+             description='Retrieve the top-k images for the query and stream the results as newline delimited JSON '
+                         '(application/x-ndjson) as soon as they are available. Every line is an event '
+                         '{"event": ..., "data": ...}: "pss" (number and URLs of the preselected candidates), "top_k" '
+                         '(URLs of the ranked images), "annotated" and "wra_plot" (rank and URL of every annotated '
+                         'image and WRA plot), and finally "done" (the URLs and timings like /top_k_images) or "error".')
+async def top_k_images_stream(req: RetrievalRequest) -> StreamingResponse:
+    logger.info(f"POST request on {PREFIX}/top_k_images/stream with RetrievalRequest: {req}")
+    if req.return_wra_matrices and req.wra_format == 'npz':
+        raise HTTPException(status_code=400, detail="The npz WRA format cannot be streamed!")
+    stream = EventStream()
+    try:
+        future = RequestExecutor().submit(run_profiled, _top_k_images_stream, req, stream)
+    except RequestRejectedError as e:
+        raise rejected(e)
+
+    async def stream_events() -> AsyncIterator[str]:
+        try:
+            async for event, data in stream.events(timeout=RequestExecutor().timeout):
+                metrics.histogram('mmirs_stream_event_latency_seconds',
+                                  'Time from the start of a streamed request until the event was sent',
+                                  label_names=('event',)).observe(stream.elapsed, event=event)
+                yield encode_ndjson_event(event, data)
+        except asyncio.TimeoutError:
+            # the status code has already been sent
+            future.cancel()
+            e = timed_out()
+            yield encode_ndjson_event('error', {'status_code': e.status_code, 'detail': e.detail})
+
+    return StreamingResponse(stream_events(), media_type=NDJSON_MEDIA_TYPE)
+
+
+def _top_k_images_stream(req: RetrievalRequest, stream: EventStream):
+    try:
+        with timer.timing_session(enabled=req.return_timings or metrics.enabled) as session:
+            urls = MMIRS().retrieve_top_k_images(req, on_event=stream.emit)
+        if req.return_timings:
+            stream.emit('done', {'urls': urls, 'timings': session.get_measurements()})
+        else:
+            stream.emit('done', {'urls': urls})
+    except Exception as e:
+        logger.exception(e)
+        stream.emit('error', {'status_code': 500, 'detail': str(e)})
+    finally:
+        stream.close()
+
+
 @router.post('/pss/top_k_context',
              tags=TAGS,
              description='Retrieve the top-k context related images from the PreselectionStage')
 async def top_k_context(req: PSSContextRetrievalRequest) -> JSONResponse:
     logger.info(f"POST request on {PREFIX}/pss/top_k_context with req: {req}")
-    timer.start_new_timing_session()
-    urls = MMIRS().pss_retrieve_top_k_context_images(context=req.context,
-                                                     dataset=req.dataset,
-                                                     k=req.top_k,
-                                                     exact=req.exact)
+    return await run_in_request_executor(_top_k_context, req)
+
+
+def _top_k_context(req: PSSContextRetrievalRequest) -> JSONResponse:
+    with timer.timing_session(enabled=req.return_timings or metrics.enabled) as session:
+        urls = MMIRS().pss_retrieve_top_k_context_images(context=req.context,
+                                                         dataset=req.dataset,
+                                                         k=req.top_k,
+                                                         exact=req.exact)
     if req.return_timings:
-        timings = timer.get_current_timing_session().get_measurements()
+        timings = session.get_measurements()
         return JSONResponse(content={'urls': urls, 'timings': timings})
     else:
         return JSONResponse(content=urls)
@@ -54,16 +204,20 @@ async def top_k_context(req: PSSContextRetrievalRequest) -> JSONResponse:
              description='Retrieve the top-k focus related images from the PreselectionStage')
 async def top_k_focus(req: PSSFocusRetrievalRequest) -> JSONResponse:
     logger.info(f"POST request on {PREFIX}/pss/top_k_context with req: {req}")
-    timer.start_new_timing_session()
-    urls = MMIRS().pss_retrieve_top_k_focus_images(focus=req.focus,
-                                                   dataset=req.dataset,
-                                                   k=req.top_k,
-                                                   weight_by_sim=req.weight_by_sim,
-                                                   top_k_similar=req.top_k_similar_terms,
-                                                   max_similar=req.max_similar_terms,
-                                                   return_similar_terms=req.return_similar_terms)
+    return await run_in_request_executor(_top_k_focus, req)
+
+
+def _top_k_focus(req: PSSFocusRetrievalRequest) -> JSONResponse:
+    with timer.timing_session(enabled=req.return_timings or metrics.enabled) as session:
+        urls = MMIRS().pss_retrieve_top_k_focus_images(focus=req.focus,
+                                                       dataset=req.dataset,
+                                                       k=req.top_k,
+                                                       weight_by_sim=req.weight_by_sim,
+                                                       top_k_similar=req.top_k_similar_terms,
+                                                       max_similar=req.max_similar_terms,
+                                                       return_similar_terms=req.return_similar_terms)
     if req.return_timings:
-        timings = timer.get_current_timing_session().get_measurements()
+        timings = session.get_measurements()
         return JSONResponse(content={'urls': urls, 'timings': timings})
     else:
         return JSONResponse(content=urls)
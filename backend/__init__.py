@@ -1,2 +1,8 @@
-from backend.imgserver.lighttp_img_server import LighttpImgServer
-from .mmirs import MMIRS
+from backend.util.lazy_import import lazy_attributes
+
+# the attributes are imported from the submodules on their first access (see lazy_attributes)
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    'LighttpImgServer': '.imgserver.lighttp_img_server',
+    'MMIRS': '.mmirs',
+})
+__all__ = ['LighttpImgServer', 'MMIRS']
@@ -1 +1,8 @@
-from .fine_selection_stage import FineSelectionStage
+from backend.util.lazy_import import lazy_attributes
+
+# the attributes are imported from the submodules on their first access (see lazy_attributes)
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    'FineSelectionStage': '.fine_selection_stage',
+    'RankedBy': '.ranked_by',
+})
+__all__ = ['FineSelectionStage', 'RankedBy']
@@ -1,6 +1,12 @@
-# order matters!
-from .image_search_space import ImageSearchSpace
-from .teran_iss import TeranISS
-from .image_feature_pool import ImageFeaturePool
-from .teran_precomputed_image_emb_pool import TeranPrecomputedImageEmbeddingsPool
-from .image_feature_pool_factory import ImageFeaturePoolFactory
+from backend.util.lazy_import import lazy_attributes
+
+# the attributes are imported from the submodules on their first access (see lazy_attributes)
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    'ImageSearchSpace': '.image_search_space',
+    'TeranISS': '.teran_iss',
+    'ImageFeaturePool': '.image_feature_pool',
+    'TeranPrecomputedImageEmbeddingsPool': '.teran_precomputed_image_emb_pool',
+    'ImageFeaturePoolFactory': '.image_feature_pool_factory',
+    'TeranImageEmbeddingsMemmap': '.teran_image_emb_memmap',
+})
+__all__ = ['ImageSearchSpace', 'TeranISS', 'ImageFeaturePool', 'TeranPrecomputedImageEmbeddingsPool', 'ImageFeaturePoolFactory', 'TeranImageEmbeddingsMemmap']
@@ -3,6 +3,7 @@ from typing import Tuple, Set
 
 from backend.fineselection.data import TeranPrecomputedImageEmbeddingsPool, ImageFeaturePool
 from backend.fineselection.retriever.retriever import RetrieverType
+from backend.util.lazy_dict import LazyDict
 from config import conf
 
 
@@ -20,8 +21,10 @@ class ImageFeaturePoolFactory(object):
                                    retriever_name in
                                    cls._conf[source_dataset].keys()}
 
-            # keys -> Tuple[source_dataset, retriever_type]
-            cls.pool_cache = {}
+            # keys -> Tuple[source_dataset, retriever_type]. the pools get created on their first use
+            cls.pool_cache = LazyDict(keys=cls.available_pools,
+                                      load=lambda key: cls.__singleton.__create_pool(*key),
+                                      name='ImagePools')
 
         return cls.__singleton
 
@@ -30,18 +33,17 @@ class ImageFeaturePoolFactory(object):
             raise NotImplementedError(
                 f"{source_dataset.upper()} ImagePool for {retriever_name.upper()} Retriever is not implemented!")
 
-        if (source_dataset, retriever_name) in self.pool_cache:
-            return self.pool_cache[(source_dataset, retriever_name)]
+        return self.pool_cache[(source_dataset, retriever_name)]
 
+    def __create_pool(self, source_dataset: str, retriever_name: str) -> ImageFeaturePool:
         pool_conf = self._conf[source_dataset][retriever_name]
         if RetrieverType.TERAN in retriever_name.lower():
             logger.info(f"Creating TeranPrecomputedImageEmbeddingsPool for {retriever_name}...")
-            pool = TeranPrecomputedImageEmbeddingsPool(source_dataset=source_dataset,
+            return TeranPrecomputedImageEmbeddingsPool(source_dataset=source_dataset,
                                                        pre_fetch=pool_conf.pre_fetch,
                                                        feats_root=pool_conf.feats_root,
                                                        fn_prefix=pool_conf.fn_prefix,
                                                        num_workers=pool_conf.num_workers)
-            self.pool_cache[(source_dataset, retriever_name)] = pool
 
         elif RetrieverType.UNITER in retriever_name.lower():
             raise NotImplementedError(f"UNITER ImagePools not yet implemented!")
@@ -49,11 +51,11 @@ class ImageFeaturePoolFactory(object):
         else:
             raise NotImplementedError(f"ImagePools for {retriever_name.upper()} not yet implemented!")
 
-        return self.pool_cache[(source_dataset, retriever_name)]
+    def is_pool_loaded(self, source_dataset: str, retriever_name: str) -> bool:
+        return self.pool_cache.is_loaded((source_dataset, retriever_name))
 
     def create_and_cache_all_available(self) -> None:
-        for source_dataset, retriever_name in self.available_pools:
-            self.create_or_get_pool(source_dataset, retriever_name)
+        self.pool_cache.load_all()
 
     def get_available_pools(self) -> Set[Tuple[str, str]]:
         return self.available_pools
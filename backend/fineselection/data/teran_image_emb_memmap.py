@@ -0,0 +1,115 @@
+import os
+from typing import List, Union
+
+import numpy as np
+from loguru import logger
+from tqdm import tqdm
+
+from backend.fineselection.data import TeranPrecomputedImageEmbeddingsPool
+
+
+class TeranImageEmbeddingsMemmap(object):
+    """
+    This class represents ALL precomputed TERAN image embeddings of a pool as a single memory-mapped matrix
+    with shape (num_images, num_rois, emb_dim) and an aligned array holding the image ids of the rows.
+     - the matrix is never loaded completely into memory but read in blocks (see TeranFullScanEngine)
+    """
+
+    def __init__(self, embs_file: str, ids_file: str):
+        if not (os.path.lexists(embs_file) and os.path.isfile(embs_file)):
+            logger.error(f"Cannot read image embeddings memmap at {embs_file}!")
+            raise FileNotFoundError(f"Cannot read image embeddings memmap at {embs_file}!")
+        if not (os.path.lexists(ids_file) and os.path.isfile(ids_file)):
+            logger.error(f"Cannot read image ids of memmap at {ids_file}!")
+            raise FileNotFoundError(f"Cannot read image ids of memmap at {ids_file}!")
+
+        self.embs_file = embs_file
+        self.ids_file = ids_file
+
+        self.embs = np.load(embs_file, mmap_mode='r')
+        self.image_ids = np.load(ids_file, allow_pickle=False)
+
+        if len(self.embs) != len(self.image_ids):
+            raise ValueError(f"Number of image embeddings ({len(self.embs)}) and image ids ({len(self.image_ids)}) "
+                             f"do not match!")
+        logger.info(f"Loaded image embeddings memmap {embs_file} with shape {self.embs.shape}!")
+
+    def get_block(self, start: int, end: int) -> np.ndarray:
+        return self.embs[start:end]
+
+    def get_image_id(self, idx: int) -> str:
+        return str(self.image_ids[idx])
+
+    def get_image_ids(self, indices: List[int]) -> List[str]:
+        return [self.get_image_id(idx) for idx in indices]
+
+    @property
+    def num_rois(self) -> int:
+        return self.embs.shape[1]
+
+    def __len__(self):
+        return len(self.embs)
+
+    @staticmethod
+    def get_file_paths(memmap_root: str, source_dataset: str, retriever_name: str):
+        fn = os.path.join(memmap_root, f"{source_dataset}_{retriever_name}")
+        return fn + '.embs.npy', fn + '.ids.npy'
+
+    @staticmethod
+    def build(pool: TeranPrecomputedImageEmbeddingsPool,
+              retriever_name: str,
+              memmap_root: str,
+              chunk_size: int = 10000,
+              dtype: Union[str, np.dtype] = np.float32) -> 'TeranImageEmbeddingsMemmap':
+        """
+        Builds the memmap by copying the embeddings of the pool chunk by chunk so that the pool never gets loaded
+        completely into memory.
+        :param pool: the pool containing the precomputed image embeddings
+        :param retriever_name: name of the retriever that precomputed the embeddings
+        :param memmap_root: the directory where the memmap and the image ids get persisted
+        :param chunk_size: number of images that are loaded into memory at once
+        :param dtype: dtype of the memmap. float16 halves the I/O but costs precision
+        """
+        os.makedirs(memmap_root, exist_ok=True)
+        embs_file, ids_file = TeranImageEmbeddingsMemmap.get_file_paths(memmap_root,
+                                                                        pool.source_dataset,
+                                                                        retriever_name)
+
+        image_ids = [str(iid) for iid in pool.data.image_ids]
+        logger.info(f"Building image embeddings memmap for {len(image_ids)} images at {embs_file}...")
+
+        embs = None
+        for start in tqdm(range(0, len(image_ids), chunk_size), desc="Copying image embeddings into memmap"):
+            chunk_ids = image_ids[start:start + chunk_size]
+            subset = pool.data.get_subset(image_ids=chunk_ids, pre_fetch_in_memory=True)
+            # the embeddings of the subset are in the same order as its image ids (see TeranISS)
+            chunk = np.array(list(subset.img_embs.values()), dtype=dtype)
+            if embs is None:
+                embs = np.lib.format.open_memmap(embs_file,
+                                                 mode='w+',
+                                                 dtype=dtype,
+                                                 shape=(len(image_ids), *chunk.shape[1:]))
+            embs[start:start + len(chunk)] = chunk
+            del subset, chunk
+        embs.flush()
+        del embs
+
+        np.save(ids_file, np.array(image_ids))
+        logger.info(f"Persisted image embeddings memmap at {embs_file}!")
+
+        return TeranImageEmbeddingsMemmap(embs_file=embs_file, ids_file=ids_file)
+
+    @staticmethod
+    def load_or_build(pool: TeranPrecomputedImageEmbeddingsPool,
+                      retriever_name: str,
+                      memmap_root: str,
+                      **build_kwargs) -> 'TeranImageEmbeddingsMemmap':
+        embs_file, ids_file = TeranImageEmbeddingsMemmap.get_file_paths(memmap_root,
+                                                                        pool.source_dataset,
+                                                                        retriever_name)
+        if os.path.lexists(embs_file) and os.path.lexists(ids_file):
+            return TeranImageEmbeddingsMemmap(embs_file=embs_file, ids_file=ids_file)
+        return TeranImageEmbeddingsMemmap.build(pool, retriever_name, memmap_root, **build_kwargs)
+
+    def __repr__(self):
+        return f"TeranImageEmbeddingsMemmap(embs_file={self.embs_file}, shape={self.embs.shape})"
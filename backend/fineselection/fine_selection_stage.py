@@ -1,7 +1,7 @@
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed, Future
 from concurrent.futures.process import BrokenProcessPool
-from enum import unique, Enum
-from typing import List, Optional, Dict, Union
+from typing import List, Optional, Dict, Union, Tuple, Callable, Any
 
 import numpy as np
 from loguru import logger
@@ -9,19 +9,17 @@ from loguru import logger
 from backend.fineselection.data.image_feature_pool_factory import ImageFeaturePoolFactory
 from backend.fineselection.plot.max_focus_region_annotator import MaxFocusRegionAnnotator
 from backend.fineselection.plot.wra_plotter import WRAPlotter
+from backend.fineselection.ranked_by import RankedBy
 from backend.fineselection.retriever import RetrieverFactory, Retriever
+from backend.fineselection.retriever.retrieval_plan import RetrievalPlan
+from backend.fineselection.retriever.tokenization_context import TokenizationContext
 from backend.imgserver.py_http_image_server import PyHttpImageServer
+from backend.util.compute_executor import get_num_plotting_workers
+from backend.util.metrics import MetricsRegistry, SIZE_BUCKETS
 from backend.util.mmirs_timer import MMIRSTimer
 from config import conf
 
 
-@unique
-class RankedBy(str, Enum):
-    FOCUS = 'focus'
-    CONTEXT = 'context'
-    COMBINED = 'combined'
-
-
 class FineSelectionStage(object):
     __singleton = None
 
@@ -30,13 +28,12 @@ class FineSelectionStage(object):
             cls.__singleton = super(FineSelectionStage, cls).__new__(cls)
             logger.info("Instantiating Fine Selection Stage...")
 
-            # setup and build retrievers
+            # setup and build retrievers and image pools. if lazy_init is enabled, they get built on their first use
             cls.retriever_factory = RetrieverFactory()
-            cls.retriever_factory.create_and_cache_all_available()
-
-            # setup and build image pools
             cls.pool_factory = ImageFeaturePoolFactory()
-            cls.pool_factory.create_and_cache_all_available()
+            if not conf.get('lazy_init', {}).get('enabled', False):
+                cls.retriever_factory.create_and_cache_all_available()
+                cls.pool_factory.create_and_cache_all_available()
 
             cls.img_server = PyHttpImageServer()
 
@@ -46,17 +43,59 @@ class FineSelectionStage(object):
             # setup wra plotter
             cls.wra_plotter = WRAPlotter()
 
-            # init worker pool
-            cls.worker_pool = ProcessPoolExecutor(max_workers=conf.fine_selection.max_workers)
+            # init worker pool. it shares the cores with the ComputeExecutor
+            cls.worker_pool = ProcessPoolExecutor(max_workers=get_num_plotting_workers())
+            cls.worker_pool_lock = threading.Lock()
+            # if true, the annotated images and wra plots are rendered when they get requested from the image server
+            cls.lazy_rendering = conf.fine_selection.get('lazy_rendering', False)
+            if cls.lazy_rendering and conf.mmirs.get('img_server', 'pyhttp') != 'pyhttp_threaded':
+                # the single-threaded server could not serve any other image while it renders an artifact
+                logger.warning("Lazy rendering requires the pyhttp_threaded image server! Disabling lazy rendering.")
+                cls.lazy_rendering = False
 
             cls.timer = MMIRSTimer()
+            cls.iss_size_metric = MetricsRegistry().histogram('mmirs_fss_iss_size',
+                                                              'Number of images in the image search spaces',
+                                                              label_names=('dataset',),
+                                                              buckets=SIZE_BUCKETS)
 
         return cls.__singleton
 
+    def load(self, dataset: str, retriever_name: str):
+        """
+        Loads the retriever and the image pool of the dataset for the retriever.
+        """
+        retriever = self.retriever_factory.create_or_get_retriever(retriever_name)
+        self.pool_factory.create_or_get_pool(source_dataset=dataset, retriever_name=retriever.retriever_name)
+
+    def is_loaded(self, dataset: str, retriever_name: str) -> bool:
+        return self.retriever_factory.is_retriever_loaded(retriever_name) and \
+               self.pool_factory.is_pool_loaded(dataset, retriever_name)
+
     def shutdown(self):
         logger.info(f'Shutting down FineSelectionStage!')
         self.worker_pool.shutdown(wait=False, cancel_futures=True)
 
+    def _restart_worker_pool(self, broken_pool: ProcessPoolExecutor):
+        with self.worker_pool_lock:
+            # concurrent requests that used the same broken pool must not restart the already restarted pool
+            if broken_pool is not self.worker_pool:
+                return
+            logger.error("Shutting down broken worker pool...")
+            self.worker_pool.shutdown(wait=False, cancel_futures=True)
+            logger.error("Instantiating new worker pool...")
+            self.worker_pool = ProcessPoolExecutor(max_workers=get_num_plotting_workers())
+
+    def _submit_render_task(self, fn, **kwargs) -> Future:
+        # used for the lazy rendering, i.e., the pool might have been restarted since the task got registered
+        worker_pool = self.worker_pool
+        try:
+            return worker_pool.submit(fn, **kwargs)
+        except BrokenProcessPool as e:
+            logger.error(e)
+            self._restart_worker_pool(broken_pool=worker_pool)
+            return self.worker_pool.submit(fn, **kwargs)
+
     def find_top_k_images(self,
                           focus: Optional[str],  # TODO what should happen if focus is None further down
                           context: str,
@@ -68,7 +107,25 @@ class FineSelectionStage(object):
                           annotate_max_focus_region: bool = False,
                           focus_weight: float = 0.5,
                           return_scores: bool = False,
-                          return_wra_matrices: bool = False):
+                          return_wra_matrices: bool = False,
+                          wra_format: str = 'plot',
+                          on_event: Optional[Callable[[str, Dict[str, Any]], None]] = None) \
+            -> Union[List[str], Tuple[List[str], Dict]]:
+        """
+        :param wra_format: if 'plot', the wra matrices are plotted and registered at the image server. If 'npz', the
+        wra matrices are not plotted but returned together with the image ids (see encode_wra_payload)
+        :param on_event: optional callback to report the progress, i.e., the ranked image ids ('top_k') as soon as the
+        retrieval is done and every annotated image ('annotated') and wra plot ('wra_plot') as soon as it is
+        available. Gets the name of the event and a dict with the image id(s) (and the rank, the path of the artifact
+        and the fragment of its URL).
+        :return: the top-k image ids. If annotate_max_focus_region or return_wra_matrices is true, additionally a dict
+        with the artifacts of this request (ordered like the image ids):
+         - 'annotated_images': the paths of the annotated images
+         - 'wra_plots': the path and the fragment of the URL (or None) of the wra plots, if wra_format is 'plot'
+         - 'wra_payload': the wra matrices, the context tokens, the focus span and the max focus region indices, if
+           wra_format is 'npz'
+        The URLs of the artifacts are built from their paths (see PyHttpImageServer.get_artifact_url).
+        """
         self.timer.start_measurement("FSS::find_top_k_images")
         # get the retriever
         retriever = self.retriever_factory.create_or_get_retriever(retriever_name)
@@ -78,10 +135,19 @@ class FineSelectionStage(object):
 
         # build and load the image search space (into memory!) containing the preselected images
         iss = pool.get_image_search_space(preselected_image_ids)
+        self.iss_size_metric.observe(len(iss), dataset=dataset)
 
-        return_separated_ranks = False
-        if ranked_by != RankedBy.COMBINED:
-            return_separated_ranks = True
+        # plan which rankings and tensors are required for the requested outputs
+        plan = RetrievalPlan.create(ranked_by=ranked_by,
+                                    annotate_max_focus_region=annotate_max_focus_region,
+                                    return_scores=return_scores,
+                                    return_wra_matrices=return_wra_matrices)
+        logger.debug(f"Retrieving with {plan}")
+
+        # tokenize context and focus only once for the whole request (only required when the WRAs are pooled)
+        tok_ctx = None
+        if focus is not None and plan.needs_wra_matrices:
+            tok_ctx = retriever.create_tokenization_context(context=context, focus=focus)
 
         # do the retrieval
         result_dict = retriever.find_top_k_images(focus=focus,
@@ -89,39 +155,58 @@ class FineSelectionStage(object):
                                                   top_k=top_k,
                                                   iss=iss,
                                                   focus_weight=focus_weight,
-                                                  return_scores=return_scores,
-                                                  return_wra_matrices=return_wra_matrices or annotate_max_focus_region,
-                                                  return_separated_ranks=return_separated_ranks or annotate_max_focus_region)
+                                                  tok_ctx=tok_ctx,
+                                                  plan=plan)
 
         top_k_image_ids = result_dict['top_k'][ranked_by.value]
+        if on_event is not None:
+            on_event('top_k', {'image_ids': top_k_image_ids})
+
+        # the raw wra matrices are returned instead of the plots
+        wra_payload = None
+        if return_wra_matrices and wra_format == 'npz':
+            wra_matrices: np.ndarray = result_dict['wra'][ranked_by.value]
+            wra_payload = {'wra': wra_matrices,
+                           'context_tokens': tok_ctx.context_tokens,
+                           'focus_span': tok_ctx.focus_span,
+                           'max_focus_region_indices': [retriever.find_max_focus_region_index(tok_ctx.focus_span, wra)
+                                                        for wra in wra_matrices]}
+            return_wra_matrices = False
+
         self.timer.start_measurement("FSS::annotate_max_focus_region_and_plot_wra")
+        worker_pool = self.worker_pool
         try:
-            self._run_plotting_methods(context=context,
-                                       focus=focus,
-                                       dataset=dataset,
-                                       ranked_by=ranked_by,
-                                       result_dict=result_dict,
-                                       retriever=retriever,
-                                       annotate_max_focus_region=annotate_max_focus_region,
-                                       return_wra_matrices=return_wra_matrices)
+            artifacts = self._run_plotting_methods(context=context,
+                                                   focus=focus,
+                                                   dataset=dataset,
+                                                   ranked_by=ranked_by,
+                                                   result_dict=result_dict,
+                                                   retriever=retriever,
+                                                   tok_ctx=tok_ctx,
+                                                   annotate_max_focus_region=annotate_max_focus_region,
+                                                   return_wra_matrices=return_wra_matrices,
+                                                   on_event=on_event)
         except BrokenProcessPool as e:
             logger.error(e)
-            logger.error("Shutting down broken worker pool...")
-            self.worker_pool.shutdown(wait=False, cancel_futures=True)
-            logger.error("Instantiating new worker pool...")
-            self.worker_pool = ProcessPoolExecutor(max_workers=conf.fine_selection.max_workers)
+            self._restart_worker_pool(broken_pool=worker_pool)
             logger.error("Retrying plotting methods one more time...")
-            self._run_plotting_methods(context=context,
-                                       focus=focus,
-                                       dataset=dataset,
-                                       ranked_by=ranked_by,
-                                       result_dict=result_dict,
-                                       retriever=retriever,
-                                       annotate_max_focus_region=annotate_max_focus_region,
-                                       return_wra_matrices=return_wra_matrices)
+            artifacts = self._run_plotting_methods(context=context,
+                                                   focus=focus,
+                                                   dataset=dataset,
+                                                   ranked_by=ranked_by,
+                                                   result_dict=result_dict,
+                                                   retriever=retriever,
+                                                   tok_ctx=tok_ctx,
+                                                   annotate_max_focus_region=annotate_max_focus_region,
+                                                   return_wra_matrices=return_wra_matrices,
+                                                   on_event=on_event)
 
         self.timer.stop_measurement()
         self.timer.stop_measurement()
+        if wra_payload is not None:
+            artifacts['wra_payload'] = wra_payload
+        if len(artifacts) > 0:
+            return top_k_image_ids, artifacts
         return top_k_image_ids
 
     def _run_plotting_methods(self,
@@ -131,44 +216,99 @@ class FineSelectionStage(object):
                               ranked_by: RankedBy,
                               result_dict: Dict[str, Dict[str, Union[List[str], np.ndarray, np.ndarray]]],
                               retriever: Retriever,
+                              tok_ctx: TokenizationContext,
                               annotate_max_focus_region: bool,
-                              return_wra_matrices: bool):
+                              return_wra_matrices: bool,
+                              on_event: Optional[Callable[[str, Dict[str, Any]], None]] = None) \
+            -> Dict[str, List[Union[str, Tuple[str, Optional[str]]]]]:
+        """
+        Annotates the max focus regions and / or plots the wras of the top-k images.
+        :return: the paths of the annotated images ('annotated_images') and / or the paths and URL fragments of the wra
+        plots ('wra_plots') ordered like the top-k images
+        """
 
         top_k_image_ids = result_dict['top_k'][ranked_by.value]
+        ranks = {iid: rank for rank, iid in enumerate(top_k_image_ids)}
+        annotated_images: Dict[str, str] = {}
+        wra_plots: Dict[str, Tuple[str, Optional[str]]] = {}
+
+        def add_annotated_image(iid: str, dst: str):
+            annotated_images[iid] = dst
+            if on_event is not None:
+                on_event('annotated', {'rank': ranks[iid], 'image_id': iid, 'path': dst})
+
+        def add_wra_plot(iid: str, dst: str, fragment: Optional[str] = None):
+            wra_plots[iid] = (dst, fragment)
+            if on_event is not None:
+                on_event('wra_plot', {'rank': ranks[iid], 'image_id': iid, 'path': dst, 'fragment': fragment})
 
         if annotate_max_focus_region or return_wra_matrices:
             wra_matrices: np.ndarray = result_dict['wra'][ranked_by.value]
-            focus_span = retriever.find_focus_span_in_context(context=context, focus=focus)
+            focus_span = tok_ctx.focus_span
             max_focus_region_indices = [retriever.find_max_focus_region_index(focus_span, wra)
                                         for iid, wra in zip(top_k_image_ids, wra_matrices)]
 
-            futures = []
-            if annotate_max_focus_region:
-                futures += self.max_focus_anno.annotate_max_focus_regions(pool=self.worker_pool,
-                                                                          image_ids=top_k_image_ids,
-                                                                          dataset=dataset,
-                                                                          max_focus_region_indices=max_focus_region_indices,
-                                                                          focus_text=focus)
-
-            if return_wra_matrices:
-                # generate plots in parallel
-                context_tokens = retriever.tokenize(context, remove_sep_cls=True)
-                futures += self.wra_plotter.generate_wra_plots(pool=self.worker_pool,
-                                                               image_ids=top_k_image_ids,
-                                                               wra_matrices=wra_matrices,
-                                                               max_focus_region_indices=max_focus_region_indices,
-                                                               focus_span=focus_span,
-                                                               context_tokens=context_tokens[0])
-
-            for future in as_completed(futures):
-                iid, dst, task = future.result()
-                if task == 'anno':
-                    # register annotated image at image server
-                    self.img_server.register_annotated_image(img_id=iid,
-                                                             dataset=dataset,
-                                                             annotated_image_path=dst)
-                elif task == 'wra_plot':
-                    # register wra plot at image server
-                    self.img_server.register_wra_plot(img_id=iid, wra_plot_path=dst)
-                else:
-                    raise ValueError(f"Task {task} is unknown!")
+            if self.lazy_rendering:
+                # only register the artifacts at the image server. they get rendered on their first request, i.e.,
+                # they are available as soon as they are registered
+                if annotate_max_focus_region:
+                    dsts = self.max_focus_anno.register_lazy_annotations(submit=self._submit_render_task,
+                                                                         image_ids=top_k_image_ids,
+                                                                         dataset=dataset,
+                                                                         max_focus_region_indices=max_focus_region_indices,
+                                                                         focus_text=focus)
+                    for iid, dst in zip(top_k_image_ids, dsts):
+                        add_annotated_image(iid, dst)
+                if return_wra_matrices:
+                    dsts = self.wra_plotter.register_lazy_wra_plots(submit=self._submit_render_task,
+                                                                    image_ids=top_k_image_ids,
+                                                                    wra_matrices=wra_matrices,
+                                                                    max_focus_region_indices=max_focus_region_indices,
+                                                                    focus_span=focus_span,
+                                                                    context_tokens=tok_ctx.context_tokens)
+                    for iid, (dst, fragment) in zip(top_k_image_ids, dsts):
+                        add_wra_plot(iid, dst, fragment)
+            else:
+                futures = []
+                if annotate_max_focus_region:
+                    futures += self.max_focus_anno.annotate_max_focus_regions(pool=self.worker_pool,
+                                                                              image_ids=top_k_image_ids,
+                                                                              dataset=dataset,
+                                                                              max_focus_region_indices=max_focus_region_indices,
+                                                                              focus_text=focus)
+
+                if return_wra_matrices:
+                    # generate plots in parallel
+                    futures += self.wra_plotter.generate_wra_plots(pool=self.worker_pool,
+                                                                   image_ids=top_k_image_ids,
+                                                                   wra_matrices=wra_matrices,
+                                                                   max_focus_region_indices=max_focus_region_indices,
+                                                                   focus_span=focus_span,
+                                                                   context_tokens=tok_ctx.context_tokens)
+
+                for future in as_completed(futures):
+                    iid, dst, task = future.result()
+                    if task == 'anno':
+                        # add the freshly rendered image to the cache (which might evict old images)
+                        self.max_focus_anno.render_cache.add(dst)
+                    if task in ('wra_plot', 'wra_sprite'):
+                        self.wra_plotter.render_cache.add(dst)
+
+                    if task in ('anno', 'anno_cached'):
+                        add_annotated_image(iid, dst)
+                    elif task in ('wra_plot', 'wra_plot_cached'):
+                        add_wra_plot(iid, dst)
+                    elif task in ('wra_sprite', 'wra_sprite_cached'):
+                        # the wras of all images are tiles of the same sprite sheet
+                        fragments = self.wra_plotter.get_wra_sprite_fragments(np.asarray(wra_matrices))
+                        for sprite_iid, fragment in zip(top_k_image_ids, fragments):
+                            add_wra_plot(sprite_iid, dst, fragment)
+                    else:
+                        raise ValueError(f"Task {task} is unknown!")
+
+        artifacts = {}
+        if annotate_max_focus_region:
+            artifacts['annotated_images'] = [annotated_images[iid] for iid in top_k_image_ids]
+        if return_wra_matrices:
+            artifacts['wra_plots'] = [wra_plots[iid] for iid in top_k_image_ids]
+        return artifacts
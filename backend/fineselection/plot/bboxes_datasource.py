@@ -1,12 +1,38 @@
 import glob
 import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
 
+import numpy as np
 from loguru import logger
+from tqdm import tqdm
+
+
+def load_bboxes(bbox_fn: str) -> np.ndarray:
+    # the members of a npz archive are loaded lazily, so only the bbox array gets decompressed
+    feat = np.load(bbox_fn, allow_pickle=True)
+    # noinspection PyUnresolvedReferences
+    if 'bbox' not in feat.files:
+        raise ValueError("Cannot find bbox in npz archive!")
+    return feat['bbox']
 
 
 # TODO make superclass or interface (see ImageDatasource)
 class BBoxesDatasource(object):
-    def __init__(self, dataset: str, bboxes_root: str, fn_prefix: str, fn_suffix: str):
+    def __init__(self,
+                 dataset: str,
+                 bboxes_root: str,
+                 fn_prefix: str,
+                 fn_suffix: str,
+                 bboxes_memmap_root: Optional[str] = None):
+        """
+        :param dataset: the dataset of the bboxes
+        :param bboxes_root: the directory containing the feature archives (npz) which contain the bboxes
+        :param fn_prefix: prefix of the file names of the feature archives
+        :param fn_suffix: suffix of the file names of the feature archives
+        :param bboxes_memmap_root: the directory containing the bboxes memmap (see build_memmap). If the memmap
+        exists, the bboxes are looked up in the memmap instead of the feature archives.
+        """
         self.dataset = dataset
         self.bboxes_root = bboxes_root
         self.fn_prefix = fn_prefix if fn_prefix is not None else ''
@@ -16,6 +42,28 @@ class BBoxesDatasource(object):
             logger.error(f"Cannot read BBoxesDatasource at {bboxes_root}!")
             raise FileNotFoundError(f"Cannot read BBoxesDatasource at {bboxes_root}!")
 
+        self.bboxes = None
+        self.row_indices = None
+        if bboxes_memmap_root is not None:
+            bboxes_file, ids_file = self.get_memmap_file_paths(bboxes_memmap_root, dataset)
+            if os.path.lexists(bboxes_file) and os.path.lexists(ids_file):
+                self.__load_memmap(bboxes_file, ids_file)
+            else:
+                logger.warning(f"Cannot find bboxes memmap for dataset {dataset} at {bboxes_memmap_root}! "
+                               f"Falling back to the feature archives.")
+
+    def __load_memmap(self, bboxes_file: str, ids_file: str):
+        self.bboxes = np.load(bboxes_file, mmap_mode='r')
+        image_ids = np.load(ids_file, allow_pickle=False)
+        if len(self.bboxes) != len(image_ids):
+            raise ValueError(f"Number of bboxes ({len(self.bboxes)}) and image ids ({len(image_ids)}) do not match!")
+        self.row_indices = {str(iid): row for row, iid in enumerate(image_ids)}
+        logger.info(f"Loaded bboxes memmap {bboxes_file} with shape {self.bboxes.shape}!")
+
+    @property
+    def has_memmap(self) -> bool:
+        return self.bboxes is not None
+
     def get_bbox_file_name(self, img_id: str):
         return self.fn_prefix + img_id + self.fn_suffix
 
@@ -26,11 +74,63 @@ class BBoxesDatasource(object):
             raise FileNotFoundError(f"Cannot read bbox at {img_p}!")
         return img_p
 
+    def get_bbox(self, img_id: str, region_idx: int) -> np.ndarray:
+        """
+        :param img_id: the ID of the image
+        :param region_idx: the index of the region, i.e., the bbox
+        :return: the bbox (x0, y0, x1, y1) of the region. Looked up in the memmap if available.
+        """
+        if self.has_memmap and img_id in self.row_indices:
+            return np.array(self.bboxes[self.row_indices[img_id], region_idx], dtype=np.float32)
+        return load_bboxes(self.get_bbox_path(img_id))[region_idx]
+
     def get_number_of_bboxes(self):
+        if self.has_memmap:
+            return len(self.bboxes)
         return len(glob.glob(os.path.join(self.bboxes_root, self.get_bbox_file_name("*"))))
 
+    @staticmethod
+    def get_memmap_file_paths(bboxes_memmap_root: str, dataset: str) -> Tuple[str, str]:
+        fn = os.path.join(bboxes_memmap_root, dataset)
+        return fn + '.bboxes.npy', fn + '.ids.npy'
+
+    def build_memmap(self, bboxes_memmap_root: str, num_bboxes: int = 36, num_workers: int = 16):
+        """
+        Extracts the bboxes of all images from the feature archives into a single (N, num_bboxes, 4) float32 memmap
+        and an aligned array of image ids. Images with less bboxes are zero-padded.
+        :param bboxes_memmap_root: the directory where the memmap and the image ids get persisted
+        :param num_bboxes: the (max) number of bboxes per image
+        :param num_workers: number of threads that read the feature archives
+        """
+        os.makedirs(bboxes_memmap_root, exist_ok=True)
+        bboxes_file, ids_file = self.get_memmap_file_paths(bboxes_memmap_root, self.dataset)
+
+        bbox_files = sorted(glob.glob(os.path.join(self.bboxes_root, self.get_bbox_file_name("*"))))
+        image_ids = [os.path.basename(fn)[len(self.fn_prefix):len(os.path.basename(fn)) - len(self.fn_suffix)]
+                     for fn in bbox_files]
+        logger.info(f"Building bboxes memmap for {len(image_ids)} images at {bboxes_file}...")
+
+        bboxes = np.lib.format.open_memmap(bboxes_file,
+                                           mode='w+',
+                                           dtype=np.float32,
+                                           shape=(len(image_ids), num_bboxes, 4))
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            for row, bb in enumerate(tqdm(executor.map(load_bboxes, bbox_files),
+                                          total=len(bbox_files),
+                                          desc="Copying bboxes into memmap")):
+                bb = bb[:num_bboxes]
+                bboxes[row, :len(bb)] = bb
+        bboxes.flush()
+        del bboxes
+
+        np.save(ids_file, np.array(image_ids))
+        logger.info(f"Persisted bboxes memmap at {bboxes_file}!")
+
+        self.__load_memmap(bboxes_file, ids_file)
+
     def __repr__(self):
         return (f"BBoxesDatasource(dataset={self.dataset},\n"
                 f"\tbboxes_root={self.bboxes_root},"
                 f"\tfn_prefix={self.fn_prefix},"
-                f"\tfn_suffix={self.fn_suffix}) with {self.get_number_of_bboxes()} BBoxes!")
+                f"\tfn_suffix={self.fn_suffix},"
+                f"\tmemmap={self.has_memmap}) with {self.get_number_of_bboxes()} BBoxes!")
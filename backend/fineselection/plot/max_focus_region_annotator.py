@@ -1,17 +1,31 @@
 import gc
 import os
 from concurrent.futures import ProcessPoolExecutor, Future
-from typing import List, Tuple
+from functools import lru_cache, partial
+from typing import List, Tuple, Optional, Callable
 
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
+from PIL import Image, ImageDraw, ImageFont
 from loguru import logger
 
-from backend.fineselection.plot.bboxes_datasource import BBoxesDatasource
+from backend.fineselection.plot.bboxes_datasource import BBoxesDatasource, load_bboxes
+from backend.util.render_cache import RenderCache
 from backend.imgserver.py_http_image_server import PyHttpImageServer
 from config import conf
 
+RENDERERS = ('pillow', 'matplotlib')
+# file extensions of the supported output formats
+IMG_FORMATS = {'png': 'png', 'jpeg': 'jpg', 'webp': 'webp'}
+
+# TODO color, etc in config
+# sizes in points (like in matplotlib)
+BBOX_BORDER_LW = 2
+FONT_SIZE = 15
+TEXT_BORDER_LW = 1
+TEXT_BOX_PAD = 4  # default pad of the text bbox in matplotlib
+
 
 class MaxFocusRegionAnnotator(object):
     __singleton = None
@@ -31,22 +45,44 @@ class MaxFocusRegionAnnotator(object):
                 cls.__datasources[ds] = BBoxesDatasource(dataset=str(ds),
                                                          bboxes_root=datasources_conf[ds].bbox_root,
                                                          fn_prefix=datasources_conf[ds].fn_prefix,
-                                                         fn_suffix=datasources_conf[ds].fn_suffix)
+                                                         fn_suffix=datasources_conf[ds].fn_suffix,
+                                                         bboxes_memmap_root=cls.__conf.get('bboxes_memmap_root',
+                                                                                           None))
             logger.debug(f"MaxFocusRegionAnnotator has BBoxes datasources: {cls.__datasources}")
 
-            cls.__annotated_images_dst = cls.__conf.annotated_images_dst
-            if not (os.path.lexists(cls.__annotated_images_dst) and os.path.isdir(cls.__annotated_images_dst)):
-                try:
-                    os.mkdir(cls.__annotated_images_dst)
-                except:
-                    raise FileNotFoundError(f"Cannot read annotated image destination at {cls.__annotated_images_dst}!")
+            cls.renderer = cls.__conf.get('renderer', 'pillow')
+            if cls.renderer not in RENDERERS:
+                raise ValueError(f"Renderer {cls.renderer} is unknown! Use one of {RENDERERS}")
+            cls.img_format = cls.__conf.get('img_format', 'jpeg')
+            if cls.img_format not in IMG_FORMATS:
+                raise ValueError(f"Image format {cls.img_format} is not supported! Use one of {list(IMG_FORMATS)}")
+            cls.img_quality = cls.__conf.get('img_quality', 90)
+
+            # the annotated images are cached by their content so that they only get rendered once
+            cls.render_cache = RenderCache(cache_dir=cls.__conf.annotated_images_dst,
+                                           max_size_mb=cls.__conf.get('cache_max_size_mb', 2048),
+                                           name='annotated')
+            logger.debug(f"MaxFocusRegionAnnotator has {cls.render_cache}")
 
             cls.img_server = PyHttpImageServer()
+            cls.img_server.register_artifact_dir(name='annotated', artifact_dir=cls.render_cache.cache_dir)
 
         return cls.__singleton
 
-    def get_max_focus_annotated_image_path(self, image_id: str):
-        return os.path.join(self.__annotated_images_dst, f"{image_id}_annotated.png")
+    def get_max_focus_annotated_image_path(self,
+                                           image_id: str,
+                                           dataset: str,
+                                           max_focus_region_idx: int,
+                                           focus_text: str) -> str:
+        key = RenderCache.compute_key(image_id,
+                                      dataset,
+                                      max_focus_region_idx,
+                                      focus_text,
+                                      self.renderer,
+                                      self.img_format,
+                                      self.img_quality,
+                                      (BBOX_BORDER_LW, FONT_SIZE, TEXT_BORDER_LW, TEXT_BOX_PAD))
+        return self.render_cache.get_path(image_id, 'annotated', key, IMG_FORMATS[self.img_format])
 
     @logger.catch(reraise=True)
     def annotate_max_focus_regions(self,
@@ -61,46 +97,191 @@ class MaxFocusRegionAnnotator(object):
 
         futures = []
         for iid, mfri in zip(image_ids, max_focus_region_indices):
+            dst = self.get_max_focus_annotated_image_path(iid, dataset, mfri, focus_text)
+            if self.render_cache.lookup(dst):
+                # already rendered -> no need to submit a task
+                logger.debug(f"Found cached MaxFocus-annotated image at {dst}")
+                future = Future()
+                future.set_result((iid, dst, 'anno_cached'))
+                futures.append(future)
+                continue
+
             # submit all tasks and keep future
             futures.append(pool.submit(annotate_max_focus_region,
-                                       image_id=iid,
-                                       bbox_fn=self.__datasources[dataset].get_bbox_path(iid),
-                                       max_focus_region_idx=mfri,
-                                       dst=self.get_max_focus_annotated_image_path(iid),
-                                       img_path=self.img_server.get_image_path(iid, dataset),
-                                       dataset=dataset,
-                                       focus_text=focus_text
-                                       )
-                           )
+                                       **self.__get_task_kwargs(iid, mfri, dataset, focus_text, dst)))
         return futures
 
+    @logger.catch(reraise=True)
+    def register_lazy_annotations(self,
+                                  submit: Callable[..., Future],
+                                  image_ids: List[str],
+                                  max_focus_region_indices: List[int],
+                                  dataset: str,
+                                  focus_text: str) -> List[str]:
+        """
+        Registers the annotated images at the image server without rendering them. An image gets rendered when its
+        URL (see PyHttpImageServer.get_artifact_url) is requested for the first time.
+        :param submit: submits a task to the worker pool (like ProcessPoolExecutor.submit)
+        :return: the paths of the annotated images
+        """
+        if dataset not in self.__datasources:
+            logger.error(f"BBoxes for Dataset {dataset} are not available!")
+            raise KeyError(f"BBoxes for {dataset} are not available!")
 
-def load_bboxes(bbox_fn: str) -> np.ndarray:
-    feat = np.load(bbox_fn, allow_pickle=True)
-    # noinspection PyUnresolvedReferences
-    if 'bbox' not in feat.files:
-        raise ValueError("Cannot find bbox in npz archive!")
-    return feat['bbox']
+        dsts = []
+        for iid, mfri in zip(image_ids, max_focus_region_indices):
+            dst = self.get_max_focus_annotated_image_path(iid, dataset, mfri, focus_text)
+            if not self.render_cache.lookup(dst):
+                self.img_server.register_pending_artifact(
+                    artifact_path=dst,
+                    render=partial(submit,
+                                   annotate_max_focus_region,
+                                   **self.__get_task_kwargs(iid, mfri, dataset, focus_text, dst)),
+                    on_rendered=self.render_cache.add)
+            dsts.append(dst)
+        return dsts
+
+    def __get_task_kwargs(self, image_id: str, max_focus_region_idx: int, dataset: str, focus_text: str, dst: str):
+        bbox_ds = self.__datasources[dataset]
+        return dict(image_id=image_id,
+                    # with the memmap, the bbox lookup is cheap enough to do it right here
+                    bbox=bbox_ds.get_bbox(image_id, max_focus_region_idx) if bbox_ds.has_memmap else None,
+                    bbox_fn=None if bbox_ds.has_memmap else bbox_ds.get_bbox_path(image_id),
+                    max_focus_region_idx=max_focus_region_idx,
+                    dst=dst,
+                    img_path=self.img_server.get_image_path(image_id, dataset),
+                    dataset=dataset,
+                    focus_text=focus_text,
+                    renderer=self.renderer,
+                    img_format=self.img_format,
+                    img_quality=self.img_quality)
 
 
 @logger.catch(reraise=True)
 def annotate_max_focus_region(image_id: str,
-                              bbox_fn: str,
+                              bbox: Optional[np.ndarray],
+                              bbox_fn: Optional[str],
                               max_focus_region_idx: int,
                               dst: str,
                               img_path: str,
                               dataset: str,
-                              focus_text: str) -> Tuple[str, str, str]:
+                              focus_text: str,
+                              renderer: str = 'pillow',
+                              img_format: str = 'jpeg',
+                              img_quality: int = 90) -> Tuple[str, str, str]:
     logger.debug(f"Annotating maximum focus region for image {image_id} of dataset {dataset}")
 
-    # load bboxes
-    bboxes = load_bboxes(bbox_fn)
-    # find the bbox with maximum focus signal in the WRA matrix
-    foc_bb = bboxes[max_focus_region_idx]
-    # free bboxes memory
-    del bboxes
+    if bbox is not None:
+        # the bbox with maximum focus signal in the WRA matrix was already looked up in the bboxes memmap
+        foc_bb = bbox
+    else:
+        # load bboxes
+        bboxes = load_bboxes(bbox_fn)
+        # find the bbox with maximum focus signal in the WRA matrix
+        foc_bb = bboxes[max_focus_region_idx]
+        # free bboxes memory
+        del bboxes
+
+    # render into a temporary file and rename it afterwards so that the cached file is never read half-written
+    tmp_dst = RenderCache.get_tmp_path(dst)
+    if renderer == 'pillow':
+        render_max_focus_region_with_pillow(img_path=img_path,
+                                            bbox=foc_bb,
+                                            focus_text=focus_text,
+                                            dst=tmp_dst,
+                                            img_format=img_format,
+                                            img_quality=img_quality)
+    elif renderer == 'matplotlib':
+        render_max_focus_region_with_matplotlib(img_path=img_path,
+                                                bbox=foc_bb,
+                                                focus_text=focus_text,
+                                                dst=tmp_dst,
+                                                img_format=img_format,
+                                                img_quality=img_quality)
+    else:
+        raise ValueError(f"Renderer {renderer} is unknown! Use one of {RENDERERS}")
+    os.replace(tmp_dst, dst)
+    logger.debug(f"Persisted MaxFocus-annotated image at {dst}")
+
+    return image_id, dst, 'anno'
+
+
+def _compute_text_y(y0: float, y1: float, height: int) -> float:
+    # check if the text is outside of the image and re-position if so
+    ty0 = y0 - BBOX_BORDER_LW - FONT_SIZE // 2
+    if ty0 < FONT_SIZE // 2:  # outside on top
+        ty0 = y1 + FONT_SIZE + BBOX_BORDER_LW + TEXT_BORDER_LW  # reposition below bbox
+    if ty0 + FONT_SIZE + TEXT_BORDER_LW > height:  # outside on bottom
+        ty0 = y1 - BBOX_BORDER_LW - FONT_SIZE // 2  # reposition inside the bbox at the bottom
+    return ty0
+
+
+@lru_cache(maxsize=None)
+def _load_font(size_px: int) -> ImageFont.ImageFont:
+    # use the default font of matplotlib (DejaVu Sans) so that both renderers look the same
+    try:
+        return ImageFont.truetype(os.path.join(mpl.get_data_path(), 'fonts', 'ttf', 'DejaVuSans.ttf'), size_px)
+    except OSError:
+        logger.warning(f"Cannot load DejaVuSans font! Falling back to the default font of Pillow.")
+        return ImageFont.load_default()
+
 
+def render_max_focus_region_with_pillow(img_path: str,
+                                        bbox: np.ndarray,
+                                        focus_text: str,
+                                        dst: str,
+                                        img_format: str = 'jpeg',
+                                        img_quality: int = 90):
+    """
+    Draws the bbox and the focus text directly onto the decoded image.
+    The sizes are converted from points to pixels like matplotlib does so that the output looks the same.
+    """
+    with Image.open(img_path) as im:
+        im = im.convert('RGBA')
+    width, height = im.size
+    pt_to_px = mpl.rcParams['figure.dpi'] / 72.
+
+    # get the position of the bbox
+    x0, y0, x1, y1 = float(bbox[0]), float(bbox[1]), float(bbox[2]), float(bbox[3])
 
+    # draw on a transparent overlay so that we get the same alpha blending as matplotlib
+    overlay = Image.new('RGBA', im.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+
+    # draw the bbox border rectangle
+    bbox_border_lw_px = max(1, round(BBOX_BORDER_LW * pt_to_px))
+    draw.rectangle([x0, y0, x1, y1], outline=(255, 0, 0, round(0.75 * 255)), width=bbox_border_lw_px)
+
+    # draw the focus text in a rect on the upper right outside of the bbox
+    font = _load_font(round(FONT_SIZE * pt_to_px))
+    tx0, ty0 = x0 + TEXT_BORDER_LW + BBOX_BORDER_LW, _compute_text_y(y0, y1, height)
+    # same anchor as matplotlib: left aligned and on the baseline
+    l, t, r, b = draw.textbbox((tx0, ty0), focus_text, font=font, anchor='ls')
+    pad_px = TEXT_BOX_PAD * pt_to_px
+    draw.rectangle([l - pad_px, t - pad_px, r + pad_px, b + pad_px],
+                   fill=(0, 0, 255, round(0.5 * 255)),
+                   outline=(0, 0, 0, round(0.5 * 255)),
+                   width=max(1, round(TEXT_BORDER_LW * pt_to_px)))
+    im = Image.alpha_composite(im, overlay)
+
+    # the text is drawn opaque on top of the text box
+    ImageDraw.Draw(im).text((tx0, ty0), focus_text, font=font, anchor='ls', fill=(255, 255, 255, 255))
+
+    im = im.convert('RGB')
+    if img_format == 'png':
+        im.save(dst, format='PNG')
+    else:
+        im.save(dst, format=img_format.upper(), quality=img_quality)
+    im.close()
+    overlay.close()
+
+
+def render_max_focus_region_with_matplotlib(img_path: str,
+                                            bbox: np.ndarray,
+                                            focus_text: str,
+                                            dst: str,
+                                            img_format: str = 'png',
+                                            img_quality: int = 90):
     # setup matplotlib so that the image gets drawn on the axes canvas in full size
     # https://stackoverflow.com/a/53816322
     dpi = mpl.rcParams['figure.dpi']
@@ -118,41 +299,29 @@ def annotate_max_focus_region(image_id: str,
     ax.imshow(im_data)
 
     # get the position of the bbox
-    x0, y0, x1, y1 = foc_bb[0], foc_bb[1], foc_bb[2], foc_bb[3]
+    x0, y0, x1, y1 = bbox[0], bbox[1], bbox[2], bbox[3]
     w, h = x1 - x0, y1 - y0
 
     # draw the bbox border rectangle
-    # TODO color, etc in config
-    bbox_border_lw = 2
     ax.add_patch(plt.Rectangle((x0, y0), w, h,
                                fill=False,
                                edgecolor='red',
-                               linewidth=bbox_border_lw,
+                               linewidth=BBOX_BORDER_LW,
                                alpha=0.75))
 
     # draw the focus text in a rect on the upper right outside of the bbox
-    # TODO color, etc in config
-    fs = 15
-    text_border_lw = 1
-    # check if the text is outside of the image and re-position if so
-    ty0 = y0 - bbox_border_lw - fs // 2
-    if ty0 < fs // 2:  # outside on top
-        ty0 = y1 + fs + bbox_border_lw + text_border_lw  # reposition below bbox
-    if ty0 + fs + text_border_lw > height:  # outside on bottom
-        ty0 = y1 - bbox_border_lw - fs // 2  # reposition inside the bbox at the bottom
-
-    ax.text(x0 + text_border_lw + bbox_border_lw,
-            ty0,
+    ax.text(x0 + TEXT_BORDER_LW + BBOX_BORDER_LW,
+            _compute_text_y(y0, y1, height),
             focus_text,
-            bbox=dict(facecolor='blue', alpha=0.5, linewidth=text_border_lw),
-            fontsize=fs,
+            bbox=dict(facecolor='blue', alpha=0.5, linewidth=TEXT_BORDER_LW, pad=TEXT_BOX_PAD),
+            fontsize=FONT_SIZE,
             color='white')
 
-    fig.savefig(dst)
+    if img_format == 'png':
+        fig.savefig(dst, format='png')
+    else:
+        fig.savefig(dst, format=img_format, pil_kwargs={'quality': img_quality})
     plt.clf()
     plt.cla()
     plt.close("all")
     gc.collect()
-    logger.debug(f"Persisted MaxFocus-annotated image at {dst}")
-
-    return image_id, dst, 'anno'
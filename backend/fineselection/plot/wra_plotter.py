@@ -1,17 +1,28 @@
+import math
 import os
 from concurrent.futures import ProcessPoolExecutor, Future
+from functools import partial
 
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import numpy as np
 from loguru import logger
+from PIL import Image
 from matplotlib.patches import Rectangle
 from mpl_toolkits.axes_grid1 import make_axes_locatable
-from typing import List, Tuple
+from typing import List, Tuple, Callable, Optional
 
+from backend.util.render_cache import RenderCache
 from backend.imgserver.py_http_image_server import PyHttpImageServer
 from config import conf
 
+# matplotlib renders one plot per image, sprite renders the wras of all images of a request into one sprite sheet
+RENDERERS = ('matplotlib', 'sprite')
+# padding between the wras in the sprite sheet
+SPRITE_PADDING_PX = 4
+# color of the border of the max focus region (matplotlib's darkred)
+MAX_FOCUS_REGION_COLOR = (139, 0, 0)
+
 
 class WRAPlotter(object):
     __singleton = None
@@ -23,21 +34,89 @@ class WRAPlotter(object):
 
             cls.__conf = conf.fine_selection.wra_plotter
             assert cls.__conf is not None, f"Cannot find config for WRAPlotter!"
-            cls.__wra_plots_dst = cls.__conf.wra_plots_dst
-            if not (os.path.lexists(cls.__wra_plots_dst) and os.path.isdir(cls.__wra_plots_dst)):
-                try:
-                    os.mkdir(cls.__wra_plots_dst)
-                except:
-                    raise FileNotFoundError(f"Cannot read WRA Plot destination at {cls.__wra_plots_dst}!")
+            # the wra plots are cached by their content so that they only get rendered once
+            cls.render_cache = RenderCache(cache_dir=cls.__conf.wra_plots_dst,
+                                           max_size_mb=cls.__conf.get('cache_max_size_mb', 2048),
+                                           name='wra')
+            logger.debug(f"WRAPlotter has {cls.render_cache}")
 
             cls.cell_size_px = cls.__conf.cell_size_px
+            cls.renderer = cls.__conf.get('renderer', 'matplotlib')
+            if cls.renderer not in RENDERERS:
+                raise ValueError(f"Unknown WRA renderer {cls.renderer}! Available renderers: {RENDERERS}")
 
             cls.img_server = PyHttpImageServer()
+            cls.img_server.register_artifact_dir(name='wra', artifact_dir=cls.render_cache.cache_dir)
 
         return cls.__singleton
 
-    def get_wra_plot_path(self, image_id: str):
-        return os.path.join(self.__wra_plots_dst, f"{image_id}_wra.png")
+    def get_wra_plot_path(self,
+                          image_id: str,
+                          wra: np.ndarray,
+                          max_focus_region_idx: int,
+                          focus_span: Tuple[int, int],
+                          context_tokens: List[str]) -> str:
+        key = RenderCache.compute_key(image_id,
+                                      wra,
+                                      max_focus_region_idx,
+                                      tuple(focus_span),
+                                      tuple(context_tokens),
+                                      self.cell_size_px)
+        return self.render_cache.get_path(image_id, 'wra', key, 'png')
+
+    def get_wra_sprite_path(self,
+                            image_ids: List[str],
+                            wra_matrices: np.ndarray,
+                            max_focus_region_indices: List[int],
+                            focus_span: Tuple[int, int]) -> str:
+        key = RenderCache.compute_key(tuple(image_ids),
+                                      wra_matrices,
+                                      tuple(max_focus_region_indices),
+                                      tuple(focus_span),
+                                      self.cell_size_px)
+        return self.render_cache.get_path('sprite', 'wra', key, 'png')
+
+    def get_wra_sprite_fragments(self, wra_matrices: np.ndarray) -> List[str]:
+        """
+        The URL of the wra of an image is the URL of the sprite sheet with a media fragment (#xywh=x,y,w,h) that
+        denotes the tile of the image in the sprite sheet.
+        :return: the fragments of the tiles of the wras in the sprite sheet
+        """
+        layout = compute_wra_sprite_layout(num_wras=len(wra_matrices),
+                                           wra_shape=wra_matrices.shape[1:],
+                                           cell_size_px=self.cell_size_px)
+        return [f"xywh={x},{y},{w},{h}" for x, y, w, h in layout]
+
+    def __get_sprite_task_kwargs(self,
+                                 wra_matrices: np.ndarray,
+                                 max_focus_region_indices: List[int],
+                                 focus_span: Tuple[int, int],
+                                 dst: str):
+        return dict(wra_matrices=wra_matrices,
+                    max_focus_region_indices=list(max_focus_region_indices),
+                    focus_span=focus_span,
+                    cell_size_px=self.cell_size_px,
+                    dst=dst)
+
+    def generate_wra_sprite(self,
+                            pool: ProcessPoolExecutor,
+                            image_ids: List[str],
+                            wra_matrices: np.ndarray,
+                            max_focus_region_indices: List[int],
+                            focus_span: Tuple[int, int]) -> Future:
+        """
+        Renders the wras of all images into a single sprite sheet with one task (see get_wra_sprite_fragments).
+        :return: the future of the rendering task
+        """
+        wra_matrices = np.asarray(wra_matrices)
+        dst = self.get_wra_sprite_path(image_ids, wra_matrices, max_focus_region_indices, focus_span)
+        if self.render_cache.lookup(dst):
+            logger.debug(f"Found cached WRA Sprite at {dst}")
+            future = Future()
+            future.set_result((None, dst, 'wra_sprite_cached'))
+            return future
+        return pool.submit(render_wra_sprite,
+                           **self.__get_sprite_task_kwargs(wra_matrices, max_focus_region_indices, focus_span, dst))
 
     def generate_wra_plots(self,
                            pool: ProcessPoolExecutor,
@@ -46,23 +125,81 @@ class WRAPlotter(object):
                            max_focus_region_indices: List[int],
                            focus_span: Tuple[int, int],
                            context_tokens: List[str]) -> List[Future]:
+        if self.renderer == 'sprite':
+            return [self.generate_wra_sprite(pool, image_ids, wra_matrices, max_focus_region_indices, focus_span)]
 
         futures = []
         for iid, wra, mfri in zip(image_ids, wra_matrices, max_focus_region_indices):
+            dst = self.get_wra_plot_path(iid, wra, mfri, focus_span, context_tokens)
+            if self.render_cache.lookup(dst):
+                # already plotted -> no need to submit a task
+                logger.debug(f"Found cached WRA Plot at {dst}")
+                future = Future()
+                future.set_result((iid, dst, 'wra_plot_cached'))
+                futures.append(future)
+                continue
+
             # submit all plotting tasks and keep future
             futures.append(pool.submit(plot_wra,
-                                       image_id=iid,
-                                       wra=wra,
-                                       context_tokens=context_tokens,
-                                       max_focus_region_idx=mfri,
-                                       focus_span=focus_span,
-                                       cell_size_px=self.cell_size_px,
-                                       dst=self.get_wra_plot_path(iid)
-                                       )
-                           )
-
+                                       **self.__get_task_kwargs(iid, wra, mfri, focus_span, context_tokens, dst)))
         return futures
 
+    def register_lazy_wra_plots(self,
+                                submit: Callable[..., Future],
+                                image_ids: List[str],
+                                wra_matrices: np.ndarray,
+                                max_focus_region_indices: List[int],
+                                focus_span: Tuple[int, int],
+                                context_tokens: List[str]) -> List[Tuple[str, Optional[str]]]:
+        """
+        Registers the wra plots at the image server without plotting them. A plot gets rendered when its URL (see
+        PyHttpImageServer.get_artifact_url) is requested for the first time.
+        :param submit: submits a task to the worker pool (like ProcessPoolExecutor.submit)
+        :return: the path of the wra plot and the fragment of its tile in the sprite sheet (or None) of every image
+        """
+        if self.renderer == 'sprite':
+            wra_matrices = np.asarray(wra_matrices)
+            dst = self.get_wra_sprite_path(image_ids, wra_matrices, max_focus_region_indices, focus_span)
+            if not self.render_cache.lookup(dst):
+                self.img_server.register_pending_artifact(
+                    artifact_path=dst,
+                    render=partial(submit,
+                                   render_wra_sprite,
+                                   **self.__get_sprite_task_kwargs(wra_matrices,
+                                                                   max_focus_region_indices,
+                                                                   focus_span,
+                                                                   dst)),
+                    on_rendered=self.render_cache.add)
+            return [(dst, fragment) for fragment in self.get_wra_sprite_fragments(wra_matrices)]
+
+        dsts = []
+        for iid, wra, mfri in zip(image_ids, wra_matrices, max_focus_region_indices):
+            dst = self.get_wra_plot_path(iid, wra, mfri, focus_span, context_tokens)
+            if not self.render_cache.lookup(dst):
+                self.img_server.register_pending_artifact(
+                    artifact_path=dst,
+                    render=partial(submit,
+                                   plot_wra,
+                                   **self.__get_task_kwargs(iid, wra, mfri, focus_span, context_tokens, dst)),
+                    on_rendered=self.render_cache.add)
+            dsts.append((dst, None))
+        return dsts
+
+    def __get_task_kwargs(self,
+                          image_id: str,
+                          wra: np.ndarray,
+                          max_focus_region_idx: int,
+                          focus_span: Tuple[int, int],
+                          context_tokens: List[str],
+                          dst: str):
+        return dict(image_id=image_id,
+                    wra=wra,
+                    context_tokens=context_tokens,
+                    max_focus_region_idx=max_focus_region_idx,
+                    focus_span=focus_span,
+                    cell_size_px=self.cell_size_px,
+                    dst=dst)
+
 
 def plot_wra(
         image_id: str,
@@ -113,9 +250,90 @@ def plot_wra(
     cax = divider.append_axes("right", size="5%", pad=0.05)
     plt.colorbar(im, cax=cax)
 
-    # persist the annotated image
-    fig.savefig(dst, bbox_inches='tight')
+    # persist the annotated image. render into a temporary file and rename it afterwards so that the cached file is
+    # never read half-written
+    tmp_dst = RenderCache.get_tmp_path(dst)
+    fig.savefig(tmp_dst, format='png', bbox_inches='tight')
+    os.replace(tmp_dst, dst)
     plt.clf()
     logger.info(f"Persisted WRA Plot for image {image_id} at {dst}")
 
     return image_id, dst, 'wra_plot'
+
+
+_VIRIDIS_LUT: Optional[np.ndarray] = None
+
+
+def _get_viridis_lut() -> np.ndarray:
+    # the default colormap of imshow (see plot_wra) as (256, 3) uint8 lookup table
+    global _VIRIDIS_LUT
+    if _VIRIDIS_LUT is None:
+        _VIRIDIS_LUT = (plt.get_cmap('viridis')(np.arange(256))[:, :3] * 255).round().astype(np.uint8)
+    return _VIRIDIS_LUT
+
+
+def colorize_wras(wra_matrices: np.ndarray) -> np.ndarray:
+    """
+    Maps the wras to RGB via a colormap lookup table. Like imshow, every wra is normalized by its own min and max.
+    :param wra_matrices: the wras with shape (N, num_regions, num_tokens)
+    :return: the RGB wras with shape (N, num_regions, num_tokens, 3)
+    """
+    wra_matrices = np.asarray(wra_matrices, dtype=np.float32)
+    vmin = wra_matrices.min(axis=(1, 2), keepdims=True)
+    vmax = wra_matrices.max(axis=(1, 2), keepdims=True)
+    normed = (wra_matrices - vmin) / np.maximum(vmax - vmin, np.finfo(np.float32).eps)
+    return _get_viridis_lut()[np.rint(normed * 255).astype(np.uint8)]
+
+
+def compute_wra_sprite_layout(num_wras: int,
+                              wra_shape: Tuple[int, int],
+                              cell_size_px: int) -> List[Tuple[int, int, int, int]]:
+    """
+    Arranges the wras in a (roughly square) grid.
+    :return: the tile (x, y, w, h) of every wra in the sprite sheet
+    """
+    h, w = wra_shape[0] * cell_size_px, wra_shape[1] * cell_size_px
+    num_cols = max(1, math.ceil(math.sqrt(num_wras)))
+    return [((i % num_cols) * (w + SPRITE_PADDING_PX), (i // num_cols) * (h + SPRITE_PADDING_PX), w, h)
+            for i in range(num_wras)]
+
+
+def render_wra_sprite(wra_matrices: np.ndarray,
+                      max_focus_region_indices: List[int],
+                      focus_span: Tuple[int, int],
+                      cell_size_px: int,
+                      dst: str) -> Tuple[None, str, str]:
+    """
+    Renders the wras of all images of a request into a single PNG sprite sheet (see compute_wra_sprite_layout).
+    In contrast to plot_wra, the sprite only contains the heatmaps and the max focus regions, i.e., the tokens,
+    region IDs and the colorbar are left to the client.
+    """
+    wra_matrices = np.asarray(wra_matrices)
+    num_wras = len(wra_matrices)
+    layout = compute_wra_sprite_layout(num_wras, wra_matrices.shape[1:], cell_size_px)
+    sheet_w = max(x + w for x, _, w, _ in layout)
+    sheet_h = max(y + h for _, y, _, h in layout)
+    sheet = np.full((sheet_h, sheet_w, 3), 255, dtype=np.uint8)
+
+    # every cell of the wras becomes a cell_size_px x cell_size_px block
+    tiles = colorize_wras(wra_matrices).repeat(cell_size_px, axis=1).repeat(cell_size_px, axis=2)
+
+    lw = max(2, cell_size_px // 10)
+    for tile, (x, y, w, h), mfri in zip(tiles, layout, max_focus_region_indices):
+        sheet[y:y + h, x:x + w] = tile
+
+        # border of the max focus region, i.e., the cells of the focus tokens in the max focus region row
+        y0, y1 = y + mfri * cell_size_px, y + (mfri + 1) * cell_size_px
+        x0, x1 = x + focus_span[0] * cell_size_px, x + min((focus_span[1] + 1) * cell_size_px, w)
+        sheet[y0:y0 + lw, x0:x1] = MAX_FOCUS_REGION_COLOR
+        sheet[y1 - lw:y1, x0:x1] = MAX_FOCUS_REGION_COLOR
+        sheet[y0:y1, x0:x0 + lw] = MAX_FOCUS_REGION_COLOR
+        sheet[y0:y1, x1 - lw:x1] = MAX_FOCUS_REGION_COLOR
+
+    tmp_dst = RenderCache.get_tmp_path(dst)
+    # the sprite consists of large blocks of the same color, which compress well even with a low compression level
+    Image.fromarray(sheet).save(tmp_dst, format='PNG', compress_level=3)
+    os.replace(tmp_dst, dst)
+    logger.info(f"Persisted WRA Sprite of {num_wras} images at {dst}")
+
+    return None, dst, 'wra_sprite'
@@ -0,0 +1,8 @@
+from enum import Enum, unique
+
+
+@unique
+class RankedBy(str, Enum):
+    FOCUS = 'focus'
+    CONTEXT = 'context'
+    COMBINED = 'combined'
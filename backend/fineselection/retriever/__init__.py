@@ -1,4 +1,12 @@
-from .retriever import Retriever
-from .teran_retriever import TeranRetriever
-from .uniter_retriever import UniterRetriever
-from .retriever_factory import RetrieverFactory
+from backend.util.lazy_import import lazy_attributes
+
+# the attributes are imported from the submodules on their first access (see lazy_attributes)
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    'Retriever': '.retriever',
+    'RetrieverType': '.retriever_type',
+    'TeranRetriever': '.teran_retriever',
+    'UniterRetriever': '.uniter_retriever',
+    'RetrieverFactory': '.retriever_factory',
+    'TeranFullScanEngine': '.teran_full_scan_engine',
+})
+__all__ = ['Retriever', 'RetrieverType', 'TeranRetriever', 'UniterRetriever', 'RetrieverFactory', 'TeranFullScanEngine']
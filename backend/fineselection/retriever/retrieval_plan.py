@@ -0,0 +1,66 @@
+from typing import Iterable
+
+RANKINGS = ('context', 'focus', 'combined')
+
+
+class RetrievalPlan(object):
+    """
+    Describes which rankings and tensors a Retriever has to compute to serve a request, so that no work is done for
+    outputs that are not requested. E.g. if the images are ranked by context and neither the WRA matrices are
+    returned nor the max focus regions are annotated, the (expensive) WRA matrices are not computed at all.
+    """
+
+    def __init__(self, rankings: Iterable[str], return_scores: bool = False, return_wra_matrices: bool = False):
+        """
+        :param rankings: the rankings of the top-k images that are returned. Subset of context, focus and combined
+        :param return_scores: if true the scores of the top-k images are returned for every ranking
+        :param return_wra_matrices: if true the wra matrices of the top-k images are returned for every ranking
+        """
+        self.rankings = {str(r.value) if hasattr(r, 'value') else str(r) for r in rankings}
+        if len(self.rankings) == 0 or not self.rankings.issubset(RANKINGS):
+            raise ValueError(f"Rankings must be a non-empty subset of {RANKINGS} but are {self.rankings}!")
+        self.return_scores = return_scores
+        self.return_wra_matrices = return_wra_matrices
+
+    @property
+    def needs_focus_scores(self) -> bool:
+        return 'focus' in self.rankings or 'combined' in self.rankings
+
+    @property
+    def needs_wra_matrices(self) -> bool:
+        # the focus scores are computed by pooling the WRA matrices
+        return self.needs_focus_scores or self.return_wra_matrices
+
+    @staticmethod
+    def create(ranked_by: str,
+               annotate_max_focus_region: bool = False,
+               return_scores: bool = False,
+               return_wra_matrices: bool = False) -> 'RetrievalPlan':
+        """
+        Creates the plan for a request to the FineSelectionStage
+        :param ranked_by: the ranking of the returned top-k images
+        :param annotate_max_focus_region: if true the max focus region gets annotated. This requires the WRA matrices
+        :param return_scores: if true the scores of the top-k images are returned
+        :param return_wra_matrices: if true the WRA matrices of the top-k images are returned
+        """
+        return RetrievalPlan(rankings=[ranked_by],
+                             return_scores=return_scores,
+                             return_wra_matrices=return_wra_matrices or annotate_max_focus_region)
+
+    @staticmethod
+    def from_flags(return_separated_ranks: bool = False,
+                   return_scores: bool = False,
+                   return_wra_matrices: bool = False) -> 'RetrievalPlan':
+        """
+        Creates the plan from the flags of Retriever.find_top_k_images
+        """
+        rankings = RANKINGS if return_separated_ranks else ['combined']
+        return RetrievalPlan(rankings=rankings,
+                             return_scores=return_scores,
+                             return_wra_matrices=return_wra_matrices)
+
+    def __repr__(self):
+        return (f"RetrievalPlan(rankings={sorted(self.rankings)},"
+                f" return_scores={self.return_scores},"
+                f" return_wra_matrices={self.return_wra_matrices},"
+                f" needs_wra_matrices={self.needs_wra_matrices})")
@@ -1,20 +1,16 @@
 from abc import abstractmethod
 
 import numpy as np
-from enum import Enum, unique
 from loguru import logger
 from typing import List, Union, Tuple, Optional, Dict
 
 from backend.fineselection.data import ImageSearchSpace
+from backend.fineselection.retriever.retrieval_plan import RetrievalPlan
+from backend.fineselection.retriever.retriever_type import RetrieverType
+from backend.fineselection.retriever.tokenization_context import TokenizationContext
 from config import conf
 
 
-@unique
-class RetrieverType(str, Enum):
-    UNITER = 'uniter'
-    TERAN = 'teran'
-
-
 class Retriever(object):
     def __init__(self, retriever_type: RetrieverType, retriever_name: str):
         logger.info(f"Instantiating {retriever_name} {retriever_type.upper()} Retriever...")
@@ -33,7 +29,10 @@ class Retriever(object):
                           focus_weight: float = 0.5,
                           return_scores: bool = False,
                           return_wra_matrices: bool = False,
-                          return_separated_ranks: bool = False) -> Dict[str, Dict[str, Union[List[str], np.ndarray]]]:
+                          return_separated_ranks: bool = False,
+                          tok_ctx: Optional[TokenizationContext] = None,
+                          plan: Optional[RetrievalPlan] = None) \
+            -> Dict[str, Dict[str, Union[List[str], np.ndarray]]]:
         """
         finds the top-k matches from the pool of images in the search space
 
@@ -46,12 +45,38 @@ class Retriever(object):
         :param return_wra_matrices: if true the wra matrices of the top-k images are returned
         :param return_separated_ranks: if true, in addition to the combined ranked top-k image,
                also the context ranked and focus ranked top-k images are returned
+        :param tok_ctx: the tokenization of context and focus. If None, it gets created by the retriever
+        :param plan: the rankings and tensors to compute. If set, it takes precedence over return_scores,
+               return_wra_matrices and return_separated_ranks. Only the rankings of the plan are returned
         :return: A dict with the following structure: {'top_k': {'combined|focus|context': List[str]},
                                                        'scores' {'combined|focus|context': np.ndarray},
                                                        'wra' {'combined|focus|context': np.ndarray}}
         """
         pass
 
+    @abstractmethod
+    def find_top_k_images_batch(self,
+                                focuses: List[str],
+                                contexts: List[str],
+                                top_k: int,
+                                iss: ImageSearchSpace,
+                                focus_weight: float = 0.5,
+                                return_scores: bool = False,
+                                return_wra_matrices: bool = False,
+                                return_separated_ranks: bool = False,
+                                plan: Optional[RetrievalPlan] = None) \
+            -> List[Dict[str, Dict[str, Union[List[str], np.ndarray]]]]:
+        """
+        finds the top-k matches from the pool of images in the search space for multiple queries at once. The
+        queries share the same image search space, e.g., because they share the same preselected images.
+
+        :param focuses: focus texts (one per context)
+        :param contexts: context texts
+        :return: A list with one dict per query with the same structure as returned by find_top_k_images
+        (see find_top_k_images for the other params)
+        """
+        pass
+
     @abstractmethod
     def find_focus_span_in_context(self, context: str, focus: str) -> Tuple[int, int]:
         """
@@ -62,6 +87,16 @@ class Retriever(object):
         """
         pass
 
+    @abstractmethod
+    def create_tokenization_context(self, context: str, focus: str) -> TokenizationContext:
+        """
+        Tokenizes context and focus and finds the span of the focus in the context.
+        :param context: context text
+        :param focus: focus text
+        :return: the TokenizationContext that should be reused for all subsequent operations of a request
+        """
+        pass
+
     @abstractmethod
     def tokenize(self, text: str, remove_sep_cls: bool) -> Tuple[List[str], List[int]]:
         """
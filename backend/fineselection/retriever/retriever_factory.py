@@ -2,6 +2,7 @@ from loguru import logger
 from typing import List
 
 from backend.fineselection.retriever import Retriever, TeranRetriever, UniterRetriever
+from backend.util.lazy_dict import LazyDict
 from config import conf
 
 
@@ -17,7 +18,10 @@ class RetrieverFactory(object):
 
             # TODO also store the type of the retrieve instead of just the name
             cls.available_retrievers = cls._conf.keys()
-            cls.retriever_cache = {}
+            # the retrievers get created on their first use
+            cls.retriever_cache = LazyDict(keys=cls.available_retrievers,
+                                           load=cls.__singleton.__create_retriever,
+                                           name='Retrievers')
 
         return cls.__singleton
 
@@ -25,35 +29,34 @@ class RetrieverFactory(object):
         if retriever_name not in self.available_retrievers:
             raise NotImplementedError(f"Retriever with name {retriever_name} is not implemented!")
 
-        if retriever_name in self.retriever_cache:
-            return self.retriever_cache[retriever_name]
+        return self.retriever_cache[retriever_name]
 
+    def __create_retriever(self, retriever_name: str) -> Retriever:
         retriever_conf = self._conf[retriever_name]
 
         if retriever_conf.retriever_type.lower() == 'teran':
-            self.retriever_cache[retriever_name] = TeranRetriever(retriever_name=retriever_name,
-                                                                  device=retriever_conf.device,
-                                                                  model=retriever_conf.model,
-                                                                  model_config=retriever_conf.model_config)
-            return self.retriever_cache[retriever_name]
+            return TeranRetriever(retriever_name=retriever_name,
+                                  device=retriever_conf.device,
+                                  model=retriever_conf.model,
+                                  model_config=retriever_conf.model_config)
         elif retriever_conf.retriever_type.lower() == 'uniter':
-            self.retriever_cache[retriever_name] = UniterRetriever(retriever_name=retriever_name,
-                                                                   n_gpu=retriever_conf.n_gpu,
-                                                                   uniter_dir=retriever_conf.uniter_dir,
-                                                                   model_config=retriever_conf.model_config,
-                                                                   num_imgs=retriever_conf.num_imgs,
-                                                                   batch_size=retriever_conf.batch_size,
-                                                                   n_data_workers=retriever_conf.n_data_workers,
-                                                                   fp16=retriever_conf.fp16,
-                                                                   pin_mem=retriever_conf.pin_mem)
+            return UniterRetriever(retriever_name=retriever_name,
+                                   n_gpu=retriever_conf.n_gpu,
+                                   uniter_dir=retriever_conf.uniter_dir,
+                                   model_config=retriever_conf.model_config,
+                                   num_imgs=retriever_conf.num_imgs,
+                                   batch_size=retriever_conf.batch_size,
+                                   n_data_workers=retriever_conf.n_data_workers,
+                                   fp16=retriever_conf.fp16,
+                                   pin_mem=retriever_conf.pin_mem)
         else:
             raise NotImplementedError(f"Retrievers of type {retriever_conf.retriever_type} not implemented!")
 
-        return self.retriever_cache[retriever_name]
+    def is_retriever_loaded(self, retriever_name: str) -> bool:
+        return self.retriever_cache.is_loaded(retriever_name)
 
     def create_and_cache_all_available(self):
-        for ret in self.available_retrievers:
-            self.create_or_get_retriever(ret)
+        self.retriever_cache.load_all()
 
     def get_available_retrievers(self) -> List[str]:
         return list(self.available_retrievers)
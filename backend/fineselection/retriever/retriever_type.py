@@ -0,0 +1,7 @@
+from enum import Enum, unique
+
+
+@unique
+class RetrieverType(str, Enum):
+    UNITER = 'uniter'
+    TERAN = 'teran'
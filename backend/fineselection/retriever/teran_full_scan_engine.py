@@ -0,0 +1,141 @@
+import heapq
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Optional, Union
+
+import numpy as np
+import torch
+from loguru import logger
+
+from backend.fineselection.data import TeranImageEmbeddingsMemmap
+from backend.util.mmirs_timer import MMIRSTimer
+
+
+def pad_query_embeddings(query_embs: List[torch.Tensor]) -> torch.Tensor:
+    """
+    Pads the token embeddings of multiple queries to a single tensor.
+    :param query_embs: list of query token embeddings each with shape (1, num_tok, emb_dim) or (num_tok, emb_dim)
+    :return: tensor with shape (num_queries, max_num_tok, emb_dim) where the padded tokens are zero
+    """
+    query_embs = [qe.squeeze(0) if qe.dim() == 3 else qe for qe in query_embs]
+    return torch.nn.utils.rnn.pad_sequence(query_embs, batch_first=True)
+
+
+def compute_mrsw_scores(img_embs: torch.Tensor,
+                        query_embs: torch.Tensor,
+                        query_lengths: List[int],
+                        return_wra_matrices: bool = False) -> \
+        Union[torch.Tensor, Tuple[torch.Tensor, torch.Tensor]]:
+    """
+    Computes the MrSw (max over regions, sum over words) similarity of B queries and N images in a single pass.
+    Like TERAN's AlignmentContrastiveLoss, the global image token as well as the CLS and the last two tokens of
+    the queries are not considered.
+
+    :param img_embs: precomputed image embeddings with shape (N, num_roi + 1, emb_dim)
+    :param query_embs: padded query token embeddings with shape (B, max_num_tok, emb_dim)
+    :param query_lengths: the number of (non-padded) tokens of the B queries
+    :param return_wra_matrices: if true the WRA matrices with shape (B, N, num_roi, max_num_tok - 3) are returned
+    :return: the similarity scores with shape (B, N) (and the WRA matrices)
+    """
+    img_set = img_embs[:, 1:, :]
+    query_seq = query_embs[:, 1:-2, :]
+
+    # (B, N, num_roi, num_tok)
+    wra = torch.einsum('nrd,btd->bnrt', img_set, query_seq)
+
+    # mask the padded tokens so that they do not contribute to the sum
+    query_lengths = torch.as_tensor([ql - 3 for ql in query_lengths], device=wra.device)
+    token_mask = torch.arange(query_seq.shape[1], device=wra.device)[None, :] >= query_lengths[:, None]
+    wra.masked_fill_(token_mask[:, None, None, :], 0.)
+
+    scores = wra.max(dim=2)[0].sum(dim=2)
+    if return_wra_matrices:
+        return scores, wra
+    return scores
+
+
+class TeranFullScanEngine(object):
+    """
+    Brute-force retrieval over ALL images of a TeranImageEmbeddingsMemmap. The memmap is streamed in blocks and a
+    batch of queries is scored against every block while a top-k heap is kept per query. Hence, the memory
+    consumption is bounded by the block size and not by the size of the pool.
+    """
+
+    def __init__(self,
+                 memmap: TeranImageEmbeddingsMemmap,
+                 block_size: int = 1024,
+                 num_threads: Optional[int] = None,
+                 device: str = 'cpu'):
+        """
+        :param memmap: the memmap containing the image embeddings
+        :param block_size: number of images that are scored at once
+        :param num_threads: number of threads used by torch during the scans. If None, all cores are used
+        :param device: the device on which the scores are computed
+        """
+        logger.info(f"Instantiating TeranFullScanEngine for {memmap} with block size {block_size}...")
+        self.memmap = memmap
+        self.block_size = block_size
+        self.device = torch.device(device)
+
+        # only used during the scans (see find_top_k_images) since the number of threads of torch is process wide
+        self.num_threads = os.cpu_count() if num_threads is None else num_threads
+
+        self.timer = MMIRSTimer()
+
+    def _load_block(self, start: int) -> torch.Tensor:
+        block = self.memmap.get_block(start, start + self.block_size)
+        # copy from the page cache / disk into a contiguous float32 tensor
+        return torch.from_numpy(np.ascontiguousarray(block, dtype=np.float32)).to(self.device)
+
+    @staticmethod
+    def _push_into_heap(heap: List[Tuple[float, int]], score: float, idx: int, top_k: int):
+        if len(heap) < top_k:
+            heapq.heappush(heap, (score, idx))
+        elif score > heap[0][0]:
+            heapq.heapreplace(heap, (score, idx))
+
+    @torch.no_grad()
+    def find_top_k_images(self,
+                          query_embs: torch.Tensor,
+                          query_lengths: List[int],
+                          top_k: int) -> List[List[str]]:
+        """
+        finds the top-k matching images of ALL images in the memmap for every query
+
+        :param query_embs: padded query token embeddings with shape (B, max_num_tok, emb_dim)
+        :param query_lengths: the number of (non-padded) tokens of the B queries
+        :param top_k: how many images to return per query
+        :return: the ids of the top-k images of every query ranked by descending score
+        """
+        self.timer.start_measurement("TeranFullScanEngine::find_top_k_images")
+        query_embs = query_embs.to(self.device, dtype=torch.float32)
+        num_images = len(self.memmap)
+        heaps: List[List[Tuple[float, int]]] = [[] for _ in range(len(query_embs))]
+
+        prev_num_threads = torch.get_num_threads()
+        torch.set_num_threads(self.num_threads)
+        try:
+            # read the next block from the memmap while the current block is scored
+            with ThreadPoolExecutor(max_workers=1) as prefetcher:
+                next_block = prefetcher.submit(self._load_block, 0)
+                for start in range(0, num_images, self.block_size):
+                    block = next_block.result()
+                    if start + self.block_size < num_images:
+                        next_block = prefetcher.submit(self._load_block, start + self.block_size)
+
+                    scores = compute_mrsw_scores(block, query_embs, query_lengths)
+                    # only the block-local top-k can make it into the global top-k
+                    block_top_k_scores, block_top_k_indices = torch.topk(scores, min(top_k, len(block)), dim=1)
+                    for heap, q_scores, q_indices in zip(heaps,
+                                                         block_top_k_scores.tolist(),
+                                                         block_top_k_indices.tolist()):
+                        for score, idx in zip(q_scores, q_indices):
+                            self._push_into_heap(heap, score, start + idx, top_k)
+                    del block, scores
+        finally:
+            torch.set_num_threads(prev_num_threads)
+
+        top_k_image_ids = [self.memmap.get_image_ids([idx for _, idx in sorted(heap, reverse=True)])
+                           for heap in heaps]
+        self.timer.stop_measurement()
+        return top_k_image_ids
@@ -1,16 +1,22 @@
 import os
 import sys
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
 from types import SimpleNamespace
 
 import numpy as np
+import torch
 from loguru import logger
 from sklearn.preprocessing import minmax_scale
-from typing import Tuple, Dict, List, Union
+from typing import Tuple, Dict, List, Union, Optional
 
 from backend.fineselection.data import TeranISS
 from backend.fineselection.retriever import Retriever
+from backend.fineselection.retriever.retrieval_plan import RetrievalPlan
 from backend.fineselection.retriever.retriever import RetrieverType
+from backend.fineselection.retriever.teran_full_scan_engine import compute_mrsw_scores, pad_query_embeddings
+from backend.fineselection.retriever.tokenization_context import TokenizationContext
+from backend.util.compute_executor import ComputeExecutor
 from backend.util.mmirs_timer import MMIRSTimer
 
 TERAN_PATH = 'models/teran'
@@ -36,8 +42,11 @@ class TeranRetriever(Retriever):
 
         # load the tokenizer from TERAN
         self.tokenizer = get_tokenizer(teran_config)
+        # LRU cache (keyed by text) for the tokenization so that a text only gets tokenized once
+        self._tokenize_cached = lru_cache(maxsize=self._conf.get('tokenization_cache_size', 1024))(self.__tokenize)
 
-        self.dist_pool = ProcessPoolExecutor(max_workers=32)
+        # the process pool to compute the distances is shared by all retrievers
+        self.compute_executor = ComputeExecutor()
 
         self.teran = teran
         self.model_config = teran_config
@@ -55,10 +64,19 @@ class TeranRetriever(Retriever):
                           focus_weight: float = 0.5,
                           return_scores: bool = False,
                           return_wra_matrices: bool = False,
-                          return_separated_ranks: bool = False) -> Dict[str, Dict[str, Union[List[str], np.ndarray]]]:
+                          return_separated_ranks: bool = False,
+                          tok_ctx: Optional[TokenizationContext] = None,
+                          plan: Optional[RetrievalPlan] = None) \
+            -> Dict[str, Dict[str, Union[List[str], np.ndarray]]]:
         self.timer.start_measurement("TeranRetriever::find_top_k_images")
+        if plan is None:
+            plan = RetrievalPlan.from_flags(return_separated_ranks=return_separated_ranks,
+                                            return_scores=return_scores,
+                                            return_wra_matrices=return_wra_matrices)
         self.timer.start_measurement("TeranRetriever::find_top_k_images::compute_query_embedding")
-        # compute query embedding
+        # compute query embedding. unlike the contexts in the ContextPreselector, it is not micro-batched with the
+        # queries of concurrent requests since TERAN's QueryEncoder runs one forward pass per query anyway (see
+        # compute_query_embeddings), i.e., a batch would only add the wait time of the MicroBatcher.
         query_embs, query_lengths = self.query_encoder.compute_query_embedding(context)
         self.timer.stop_measurement()
 
@@ -70,71 +88,194 @@ class TeranRetriever(Retriever):
         global_similarity_scores: np.ndarray  # type hint. shape: (k)
 
         if focus is None:  # should only ever happen for l2 eval..
-            global_similarity_scores = compute_distances(img_embs,
-                                                         query_embs,
-                                                         img_length,
-                                                         query_lengths,
-                                                         self.model_config,
-                                                         return_wra_matrices=False,
-                                                         dist_pool=self.dist_pool)
+            global_similarity_scores = self.compute_distances(img_embs, query_embs, img_length, query_lengths)
             context_sorted_indices = np.argsort(global_similarity_scores)[::-1][:top_k]
             return iss.get_image_ids(context_sorted_indices)
 
         self.timer.start_measurement("TeranRetriever::find_top_k_images::compute_distances")
-        global_similarity_scores, wra_matrices = compute_distances(img_embs,
-                                                                   query_embs,
-                                                                   img_length,
-                                                                   query_lengths,
-                                                                   self.model_config,
-                                                                   return_wra_matrices=True)
+        if plan.needs_wra_matrices:
+            global_similarity_scores, wra_matrices = self.compute_distances(img_embs,
+                                                                            query_embs,
+                                                                            img_length,
+                                                                            query_lengths,
+                                                                            return_wra_matrices=True)
+        else:
+            # score-only fast path: the WRA matrices are neither required for ranking nor returned
+            global_similarity_scores = self.compute_distances(img_embs, query_embs, img_length, query_lengths)
+            wra_matrices = None
         self.timer.stop_measurement()
 
-        # compute the matching scores wrt the focus
-        focus_scores = self.compute_focus_scores(focus=focus,
-                                                 context=context,
-                                                 wra_matrices=wra_matrices,
-                                                 focus_pooling='avg')
+        return_dict = self._rank_images(focus=focus,
+                                        context=context,
+                                        top_k=top_k,
+                                        iss=iss,
+                                        global_similarity_scores=global_similarity_scores,
+                                        wra_matrices=wra_matrices,
+                                        focus_weight=focus_weight,
+                                        plan=plan,
+                                        tok_ctx=tok_ctx)
 
-        # compute the combined scores
-        combined_scores = self.compute_combined_scores(global_scores=global_similarity_scores,
-                                                       focus_scores=focus_scores,
-                                                       alpha=focus_weight)
+        self.timer.stop_measurement()
+        return return_dict
 
-        # argsort to get the indices of the images
+    def compute_distances(self,
+                          img_embs: torch.Tensor,
+                          query_embs: torch.Tensor,
+                          img_length: int,
+                          query_lengths: List[int],
+                          return_wra_matrices: bool = False) -> Union[np.ndarray, Tuple[np.ndarray, np.ndarray]]:
+        """
+        Computes the distances with TERAN on the shared ComputeExecutor (or in the calling process for small inputs).
+        If a worker of the pool crashed, the pool gets restarted and the distances are computed once more.
+        """
+        for attempt in range(2):
+            dist_pool = self.compute_executor.get_pool(img_embs)
+            try:
+                return compute_distances(img_embs,
+                                         query_embs,
+                                         img_length,
+                                         query_lengths,
+                                         self.model_config,
+                                         return_wra_matrices=return_wra_matrices,
+                                         dist_pool=dist_pool)
+            except BrokenProcessPool as e:
+                if attempt > 0:
+                    raise
+                logger.error(e)
+                self.compute_executor.restart(broken_pool=dist_pool)
+
+    @logger.catch
+    @torch.no_grad()
+    def find_top_k_images_batch(self,
+                                focuses: List[str],
+                                contexts: List[str],
+                                top_k: int,
+                                iss: TeranISS,
+                                focus_weight: float = 0.5,
+                                return_scores: bool = False,
+                                return_wra_matrices: bool = False,
+                                return_separated_ranks: bool = False,
+                                plan: Optional[RetrievalPlan] = None) \
+            -> List[Dict[str, Dict[str, Union[List[str], np.ndarray]]]]:
+        self.timer.start_measurement("TeranRetriever::find_top_k_images_batch")
+        if plan is None:
+            plan = RetrievalPlan.from_flags(return_separated_ranks=return_separated_ranks,
+                                            return_scores=return_scores,
+                                            return_wra_matrices=return_wra_matrices)
+        if len(focuses) != len(contexts):
+            raise ValueError("There must be a focus for every context!")
+
+        # compute the query embeddings of all contexts
+        query_embs, query_lengths = self.compute_query_embeddings(contexts)
+
+        # get the precomputed image embeddings once for all queries
+        img_embs, _ = iss.get_images()
+
+        # compute the matching scores of all queries in a single pass
+        self.timer.start_measurement("TeranRetriever::find_top_k_images_batch::compute_distances")
+        if plan.needs_wra_matrices:
+            global_similarity_scores, wra_matrices = compute_mrsw_scores(img_embs.to(query_embs.device),
+                                                                         query_embs,
+                                                                         query_lengths,
+                                                                         return_wra_matrices=True)
+            wra_matrices = wra_matrices.cpu().numpy()
+        else:
+            global_similarity_scores = compute_mrsw_scores(img_embs.to(query_embs.device),
+                                                           query_embs,
+                                                           query_lengths)
+            wra_matrices = None
+        global_similarity_scores = global_similarity_scores.cpu().numpy()
+        self.timer.stop_measurement()
+
+        return_dicts = []
+        for i, (focus, context, ql) in enumerate(zip(focuses, contexts, query_lengths)):
+            return_dicts.append(self._rank_images(focus=focus,
+                                                  context=context,
+                                                  top_k=top_k,
+                                                  iss=iss,
+                                                  global_similarity_scores=global_similarity_scores[i],
+                                                  # remove the padded tokens
+                                                  wra_matrices=wra_matrices[i, ..., :ql - 3]
+                                                  if wra_matrices is not None else None,
+                                                  focus_weight=focus_weight,
+                                                  plan=plan,
+                                                  tok_ctx=self.create_tokenization_context(context=context,
+                                                                                           focus=focus)
+                                                  if plan.needs_wra_matrices else None))
+
+        self.timer.stop_measurement()
+        return return_dicts
+
+    @torch.no_grad()
+    def compute_query_embeddings(self, contexts: List[str]) -> Tuple[torch.Tensor, List[int]]:
+        """
+        Computes the token embeddings of multiple contexts with TERAN's own text forward path and pads them to a
+        single tensor.
+        :param contexts: the contexts to encode
+        :return: the padded token embeddings with shape (num_contexts, max_num_tok, emb_dim) and the number of
+        (non-padded) tokens of each context
+        """
+        self.timer.start_measurement("TeranRetriever::compute_query_embeddings")
+        query_embs, query_lengths = [], []
+        for context in contexts:
+            qe, ql = self.query_encoder.compute_query_embedding(context)
+            query_embs.append(qe)
+            query_lengths.append(int(ql[0]))
+        query_embs = pad_query_embeddings(query_embs)
+        self.timer.stop_measurement()
+        return query_embs, query_lengths
+
+    def _rank_images(self,
+                     focus: str,
+                     context: str,
+                     top_k: int,
+                     iss: TeranISS,
+                     global_similarity_scores: np.ndarray,
+                     wra_matrices: Optional[np.ndarray],
+                     focus_weight: float,
+                     plan: RetrievalPlan,
+                     tok_ctx: Optional[TokenizationContext] = None) \
+            -> Dict[str, Dict[str, Union[List[str], np.ndarray]]]:
+        scores = {'context': global_similarity_scores}
+        if plan.needs_focus_scores:
+            # compute the matching scores wrt the focus
+            scores['focus'] = self.compute_focus_scores(focus=focus,
+                                                        context=context,
+                                                        wra_matrices=wra_matrices,
+                                                        focus_pooling='avg',
+                                                        tok_ctx=tok_ctx)
+            if 'combined' in plan.rankings:
+                # compute the combined scores
+                scores['combined'] = self.compute_combined_scores(global_scores=global_similarity_scores,
+                                                                  focus_scores=scores['focus'],
+                                                                  alpha=focus_weight)
+
+        # get the indices of the top-k images of the requested rankings
         self.timer.start_measurement("TeranRetriever::find_top_k_images::sort_scores")
-        context_sorted_indices = np.argsort(global_similarity_scores)[::-1][:top_k]
-        focus_sorted_indices = np.argsort(focus_scores)[::-1][:top_k]
-        combined_sorted_indices = np.argsort(combined_scores)[::-1][:top_k]
+        sorted_indices = {ranking: self.__top_k_indices(scores[ranking], top_k) for ranking in plan.rankings}
         self.timer.stop_measurement()
 
         # get the ranked image ids
         self.timer.start_measurement("TeranRetriever::find_top_k_images::build_return_dict")
-        context_ranked_top_k: List[str] = iss.get_image_ids(context_sorted_indices)
-        focus_ranked_top_k: List[str] = iss.get_image_ids(focus_sorted_indices)
-        combined_ranked_top_k: List[str] = iss.get_image_ids(combined_sorted_indices)
-
-        return_dict = {'top_k': {'combined': combined_ranked_top_k}}
-
-        if return_separated_ranks:
-            return_dict['top_k']['context'] = context_ranked_top_k
-            return_dict['top_k']['focus'] = focus_ranked_top_k
-
-        if return_scores:
-            return_dict['scores'] = {'combined': combined_scores[combined_sorted_indices]}
-            if return_separated_ranks:
-                return_dict['scores']['context'] = global_similarity_scores[context_sorted_indices]
-                return_dict['scores']['focus'] = focus_scores[focus_sorted_indices]
-
-        if return_wra_matrices:
-            return_dict['wra'] = {'combined': wra_matrices[combined_sorted_indices, ...]}
-            if return_separated_ranks:
-                return_dict['wra']['context'] = wra_matrices[context_sorted_indices, ...]
-                return_dict['wra']['focus'] = wra_matrices[focus_sorted_indices, ...]
-        self.timer.stop_measurement()
+        return_dict = {'top_k': {ranking: iss.get_image_ids(indices) for ranking, indices in sorted_indices.items()}}
 
+        if plan.return_scores:
+            return_dict['scores'] = {ranking: scores[ranking][indices] for ranking, indices in sorted_indices.items()}
+
+        if plan.return_wra_matrices:
+            return_dict['wra'] = {ranking: wra_matrices[indices, ...] for ranking, indices in sorted_indices.items()}
         self.timer.stop_measurement()
+
         return return_dict
 
+    @staticmethod
+    def __top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+        if top_k >= len(scores):
+            return np.argsort(scores)[::-1]
+        # only sort the top-k instead of all scores
+        top_k_indices = np.argpartition(scores, -top_k)[-top_k:]
+        return top_k_indices[np.argsort(scores[top_k_indices])[::-1]]
+
     def compute_combined_scores(self,
                                 global_scores: np.ndarray,
                                 focus_scores: np.ndarray,
@@ -170,9 +311,12 @@ class TeranRetriever(Retriever):
                              focus: str,
                              context: str,
                              wra_matrices: np.ndarray,
-                             focus_pooling: str = 'avg') -> np.ndarray:
+                             focus_pooling: str = 'avg',
+                             tok_ctx: Optional[TokenizationContext] = None) -> np.ndarray:
         self.timer.start_measurement("TeranRetriever::compute_focus_scores")
-        focus_span = self.find_focus_span_in_context(focus, context)
+        if tok_ctx is None:
+            tok_ctx = self.create_tokenization_context(context=context, focus=focus)
+        focus_span = tok_ctx.focus_span
         focus_scores = np.array([self.compute_focus_score(wra, focus_span, focus_pooling) for wra in wra_matrices])
         self.timer.stop_measurement()
         return focus_scores
@@ -203,32 +347,36 @@ class TeranRetriever(Retriever):
         return max_focus_region_idx
 
     def find_focus_span_in_context(self, focus: str, context: str) -> Tuple[int, int]:
-        self.timer.start_measurement("TeranRetriever::find_focus_span_in_context")
-        logger.debug(f"Searching focus span in context...")
+        return self.create_tokenization_context(context=context, focus=focus).focus_span
+
+    def create_tokenization_context(self, context: str, focus: str) -> TokenizationContext:
+        """
+        Tokenizes context and focus (or gets their tokenization from the cache) and finds the focus span.
+        The TokenizationContext should be reused for all subsequent operations of a request.
+        """
+        self.timer.start_measurement("TeranRetriever::create_tokenization_context")
         # TODO move removal of sep and cls token to config
         ctx_tokens, ctx_token_ids = self.tokenize(context, remove_sep_cls=True)
         focus_tokens, focus_token_ids = self.tokenize(focus, remove_sep_cls=True)
-
-        begin_idx = ctx_token_ids.index(focus_token_ids[0])
-        if len(focus_tokens) > 1:
-            end_idx = ctx_token_ids.index(focus_token_ids[-1], begin_idx)
-        else:
-            end_idx = begin_idx
-
-        logger.debug(f"Found focus span in context: {(begin_idx, end_idx)}!")
+        tok_ctx = TokenizationContext(context_tokens=ctx_tokens,
+                                      context_token_ids=ctx_token_ids,
+                                      focus_tokens=focus_tokens,
+                                      focus_token_ids=focus_token_ids)
+        logger.debug(f"Found focus span in context: {tok_ctx.focus_span}!")
         self.timer.stop_measurement()
-
-        return begin_idx, end_idx
+        return tok_ctx
 
     def tokenize(self, text: str, remove_sep_cls: bool = True) -> Tuple[List[str], List[int]]:
-        self.timer.start_measurement("TeranRetriever::tokenize")
-        token_ids = self.tokenizer.encode(text)
-        tokens = self.tokenizer.convert_ids_to_tokens(token_ids)
+        tokens, token_ids = self._tokenize_cached(text)
         if remove_sep_cls:
             tokens = tokens[1:-1]
             token_ids = token_ids[1:-1]
-        self.timer.stop_measurement()
-        return tokens, token_ids
+        return list(tokens), list(token_ids)
+
+    def __tokenize(self, text: str) -> Tuple[Tuple[str, ...], Tuple[int, ...]]:
+        token_ids = self.tokenizer.encode(text)
+        tokens = self.tokenizer.convert_ids_to_tokens(token_ids)
+        return tuple(tokens), tuple(token_ids)
 
     @staticmethod
     def __build_retrieval_opts(device: str, model: str, model_config: str):
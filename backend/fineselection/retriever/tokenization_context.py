@@ -0,0 +1,57 @@
+from typing import List, Sequence, Tuple
+
+
+def find_sub_list(sub: Sequence[int], lst: Sequence[int]) -> Tuple[int, int]:
+    """
+    Finds the first occurrence of sub as a contiguous sub-list of lst.
+    :param sub: the sub-list to search for
+    :param lst: the list to search in
+    :return: the span of sub in lst. (start, end) where end is inclusive
+    """
+    if len(sub) == 0:
+        raise ValueError("Cannot search for an empty sub-list!")
+    first = sub[0]
+    for start in range(len(lst) - len(sub) + 1):
+        if lst[start] == first and list(lst[start:start + len(sub)]) == list(sub):
+            return start, start + len(sub) - 1
+    raise ValueError(f"{sub} is not a sub-list of {lst}!")
+
+
+def find_focus_span(focus_token_ids: Sequence[int], context_token_ids: Sequence[int]) -> Tuple[int, int]:
+    """
+    Finds the span of the focus tokens in the context tokens.
+    :param focus_token_ids: the token ids of the focus
+    :param context_token_ids: the token ids of the context
+    :return: the span of the focus tokens in the context tokens. (start, end) where end is inclusive
+    """
+    try:
+        return find_sub_list(focus_token_ids, context_token_ids)
+    except ValueError:
+        # the focus might get tokenized differently on its own (e.g. different word pieces at its boundaries).
+        # fall back to the first occurrence of its first token and the following occurrence of its last token.
+        begin_idx = list(context_token_ids).index(focus_token_ids[0])
+        end_idx = list(context_token_ids).index(focus_token_ids[-1], begin_idx)
+        return begin_idx, end_idx
+
+
+class TokenizationContext(object):
+    """
+    Holds the tokenization of the context and focus of a single request so that they only get tokenized once.
+    The CLS and SEP tokens are removed.
+    """
+
+    def __init__(self,
+                 context_tokens: List[str],
+                 context_token_ids: List[int],
+                 focus_tokens: List[str],
+                 focus_token_ids: List[int]):
+        self.context_tokens = context_tokens
+        self.context_token_ids = context_token_ids
+        self.focus_tokens = focus_tokens
+        self.focus_token_ids = focus_token_ids
+        self.focus_span = find_focus_span(focus_token_ids, context_token_ids)
+
+    def __repr__(self):
+        return (f"TokenizationContext(context_tokens={self.context_tokens},"
+                f" focus_tokens={self.focus_tokens},"
+                f" focus_span={self.focus_span})")
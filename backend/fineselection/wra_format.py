@@ -0,0 +1,3 @@
+# formats of the wra matrices in the responses of the retrieval
+WRA_FORMATS = ('plot', 'npz')
+NPZ_MEDIA_TYPE = 'application/x-npz'
@@ -1,33 +1,141 @@
-import glob
 import os
+import pickle
+import threading
+from typing import Dict, Optional
 
 from loguru import logger
 
 
 # TODO make superclass or interface (see BBoxesDatasource)
 class ImageDatasource(object):
-    def __init__(self, dataset: str, images_root: str, image_prefix: str, image_suffix: str):
+    def __init__(self,
+                 dataset: str,
+                 images_root: str,
+                 image_prefix: str,
+                 image_suffix: str,
+                 index_cache_dir: Optional[str] = None):
+        """
+        :param dataset: the dataset of the images
+        :param images_root: the directory containing the images
+        :param image_prefix: prefix of the file names of the images
+        :param image_suffix: suffix of the file names of the images
+        :param index_cache_dir: the directory where the id -> file name index gets persisted. If None, the index is
+        not persisted, i.e., the images root gets scanned on every startup.
+        """
         self.dataset = dataset
         self.images_root = images_root
         self.image_prefix = image_prefix if image_prefix is not None else ''
         self.image_suffix = image_suffix if image_suffix is not None else ''
+        self.index_cache_dir = index_cache_dir
 
         if not os.path.lexists(images_root) or not os.path.isdir(images_root):
             logger.error(f"Cannot read Image Datasource at {images_root}!")
             raise FileNotFoundError(f"Cannot read Image Datasource at {images_root}!")
 
+        # in-memory id -> file name index (see build_index)
+        self.__index: Optional[Dict[str, str]] = None
+        self.__index_lock = threading.Lock()
+
+    def get_index_cache_file(self) -> Optional[str]:
+        if self.index_cache_dir is None:
+            return None
+        return os.path.join(self.index_cache_dir, f"{self.dataset}.index.pkl")
+
+    def __load_index_from_cache(self, root_mtime_ns: int) -> Optional[Dict[str, str]]:
+        cache_file = self.get_index_cache_file()
+        if cache_file is None or not os.path.lexists(cache_file):
+            return None
+        try:
+            with open(cache_file, 'rb') as f:
+                cached = pickle.load(f)
+        except Exception as e:
+            logger.warning(f"Cannot read image index cache at {cache_file}! {e}")
+            return None
+        # the mtime of a directory changes whenever files get added or removed
+        if (cached['images_root'] != self.images_root
+                or cached['image_prefix'] != self.image_prefix
+                or cached['image_suffix'] != self.image_suffix
+                or cached['root_mtime_ns'] != root_mtime_ns):
+            logger.info(f"Image index cache at {cache_file} is outdated!")
+            return None
+        return cached['index']
+
+    def __persist_index(self, index: Dict[str, str], root_mtime_ns: int):
+        cache_file = self.get_index_cache_file()
+        if cache_file is None:
+            return
+        os.makedirs(self.index_cache_dir, exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({'images_root': self.images_root,
+                         'image_prefix': self.image_prefix,
+                         'image_suffix': self.image_suffix,
+                         'root_mtime_ns': root_mtime_ns,
+                         'index': index}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+        logger.info(f"Persisted image index of Datasource {self.dataset} at {cache_file}!")
+
+    def __scan(self) -> Dict[str, str]:
+        index = {}
+        prefix_len, suffix_len = len(self.image_prefix), len(self.image_suffix)
+        with os.scandir(self.images_root) as it:
+            for e in it:
+                fn = e.name
+                if (len(fn) > prefix_len + suffix_len
+                        and fn.startswith(self.image_prefix)
+                        and fn.endswith(self.image_suffix)):
+                    index[fn[prefix_len:len(fn) - suffix_len]] = fn
+        return index
+
+    def build_index(self, force_rescan: bool = False):
+        """
+        Builds the in-memory id -> file name index of all images so that the images can be looked up without I/O.
+        The index is loaded from the index cache if the images root did not change since the index was persisted.
+        """
+        with self.__index_lock:
+            root_mtime_ns = os.stat(self.images_root).st_mtime_ns
+            index = None if force_rescan else self.__load_index_from_cache(root_mtime_ns)
+            if index is not None:
+                logger.info(f"Loaded image index of Datasource {self.dataset} with {len(index)} images from cache!")
+            else:
+                logger.info(f"Scanning {self.images_root} to build the image index of Datasource {self.dataset}...")
+                index = self.__scan()
+                logger.info(f"Indexed {len(index)} images of Datasource {self.dataset}!")
+                self.__persist_index(index, root_mtime_ns)
+            self.__index = index
+
+    @property
+    def index(self) -> Dict[str, str]:
+        if self.__index is None:
+            self.build_index()
+        return self.__index
+
+    def lookup_image_path(self, img_id: str) -> Optional[str]:
+        """
+        Stat-free lookup for the request handling.
+        :return: the path of the image from the in-memory index or None if the image is not in the index
+        """
+        fn = self.index.get(img_id, None)
+        return None if fn is None else os.path.join(self.images_root, fn)
+
     def get_image_file_name(self, img_id: str):
         return self.image_prefix + img_id + self.image_suffix
 
     def get_image_path(self, img_id: str) -> str:
+        img_p = self.lookup_image_path(img_id)
+        if img_p is not None:
+            return img_p
+
+        # the image might have been added after the index was built
         img_p = os.path.join(self.images_root, self.get_image_file_name(img_id))
-        if not (os.path.lexists(img_p) or os.path.isfile(img_p)):
+        if not os.path.isfile(img_p):
             logger.error(f"Cannot read image at {img_p}!")
             raise FileNotFoundError(f"Cannot read image at {img_p}!")
+        self.index[img_id] = os.path.basename(img_p)
         return img_p
 
     def get_number_of_images(self):
-        return len(glob.glob(os.path.join(self.images_root, self.get_image_file_name("*"))))
+        return len(self.index)
 
     def __repr__(self):
         return (f"ImageDatasource(dataset={self.dataset},\n"
@@ -1,4 +1,5 @@
 from abc import abstractmethod
+from typing import Optional
 
 from loguru import logger
 
@@ -9,6 +10,9 @@ from config import conf
 class ImageServer(object):
 
     def __init__(self):
+        # the subclasses are singletons, i.e., __init__ gets called every time the singleton is requested
+        if getattr(self, 'datasources', None) is not None:
+            return
         # FIXME very strange bug: can't create the dict via list or dict comprehension
         self.datasources = {}
         datasources_conf = conf.image_server.datasources
@@ -16,15 +20,16 @@ class ImageServer(object):
             self.datasources[ds] = ImageDatasource(dataset=str(ds),
                                                    images_root=datasources_conf[ds].images_root,
                                                    image_prefix=datasources_conf[ds].image_prefix,
-                                                   image_suffix=datasources_conf[ds].image_suffix)
+                                                   image_suffix=datasources_conf[ds].image_suffix,
+                                                   index_cache_dir=conf.image_server.get('index_cache_dir', None))
         logger.info(f"Image Server has datasources: {self.datasources}")
 
     @abstractmethod
-    def get_img_url(self, img_id: str, dataset: str, annotated: bool = False) -> str:
+    def get_img_url(self, img_id: str, dataset: str, width: Optional[int] = None) -> str:
         """
         :param img_id: the ID of the image to be served
         :param dataset: the datasource to load the image from (e.g. teran, uniter, coco_val_14, etc)
-        :param annotated: if true, returns the image URL for the image with the MaxFocusRegion annotated (if it exists)
+        :param width: if set, returns the URL of a resized variant of the image (if supported by the server)
         :return: URL to the image
         """
         raise NotImplementedError()
@@ -39,25 +44,12 @@ class ImageServer(object):
         raise NotImplementedError()
 
     @abstractmethod
-    def register_annotated_image(self,
-                                 img_id: str,
-                                 dataset: str,
-                                 annotated_path: str):
+    def get_artifact_url(self, artifact_path: str, fragment: Optional[str] = None) -> str:
         """
-        Registers, i.e., makes the annotated image at the provided path available so that it can be served via URL
-        :param img_id: the ID of the image
-        :param dataset: the datasource / dataset of the annotated image
-        :param annotated_path: the path to the annotated image
-        """
-        raise NotImplementedError()
-
-    @abstractmethod
-    def register_wra_plot(self,
-                          img_id: str,
-                          wra_plot_path: str):
-        """
-        Registers, i.e., makes the wra plot at the provided path available so that it can be served via URL
-        :param img_id: the ID of the image
-        :param wra_plot_path: the path to the wra plot for the image
+        Returns the URL of an artifact of a request, e.g. an annotated image or a wra plot. The artifacts are
+        identified by their path (and not by the image) since every request renders its own artifacts.
+        :param artifact_path: the path to the artifact
+        :param fragment: the fragment of the URL, e.g. the tile of the image in a sprite sheet (xywh=x,y,w,h)
+        :return: URL to the artifact
         """
         raise NotImplementedError()
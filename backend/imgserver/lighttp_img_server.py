@@ -1,7 +1,7 @@
 import urllib.parse as url
 
 from loguru import logger
-from typing import List
+from typing import List, Optional
 
 from backend.imgserver.image_server import ImageServer
 from config import conf
@@ -31,14 +31,18 @@ class LighttpImgServer(ImageServer):
         base_url += cls._conf.context_path
         return base_url
 
-    def get_img_url(self, img_id: str, dataset: str, annotated: bool = False) -> str:
+    # resized variants (width) are not supported by lighttp
+    def get_img_url(self, img_id: str, dataset: str, width: Optional[int] = None) -> str:
         if dataset not in self.datasources:
             logger.error(f"Images for Dataset {dataset} not available!")
             return 'NoImagesAvailable'
         return url.urljoin(self._base_url, self.datasources[dataset].get_image_file_name(img_id))
 
-    def get_img_urls(self, img_ids: str, dataset: str, annotated: bool = False) -> List[str]:
-        return [self.get_img_url(img_id, dataset, annotated) for img_id in img_ids]
+    def get_img_urls(self,
+                     img_ids: str,
+                     dataset: str,
+                     width: Optional[int] = None) -> List[str]:
+        return [self.get_img_url(img_id, dataset) for img_id in img_ids]
 
     def get_image_path(self, img_id: str, dataset: str) -> str:
         if dataset not in self.datasources:
@@ -46,5 +50,5 @@ class LighttpImgServer(ImageServer):
             raise KeyError(f"Image Datasource for dataset {dataset} is not registered!")
         return self.datasources[dataset].get_image_path(img_id)
 
-    def register_annotated_image(self, img_id: str, dataset: str, annotated_path: str):
-        raise NotImplemented("This is not (yet) implemented!")
+    def get_artifact_url(self, artifact_path: str, fragment: Optional[str] = None) -> str:
+        raise NotImplementedError("This is not (yet) implemented!")
@@ -1,35 +1,66 @@
-import glob
 import http.server
 import os.path
+import re
 import socketserver
+import threading
+import time
 import urllib.parse as url
-from concurrent.futures import ThreadPoolExecutor
-from typing import List
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Callable, Optional
 
 from loguru import logger
 
 from backend.imgserver.image_server import ImageServer
+from backend.imgserver.threaded_http_server import threaded_http_server_task
+from backend.imgserver.thumbnails import ThumbnailCache
 # TODO improve architecture wrt ImageServer superclass -> datasource instantiation
 from backend.util.mmirs_timer import MMIRSTimer
 from config import conf
 
+# suffixes of the annotated images and wra plots. (see RenderCache)
+_ARTIFACT_SUFFIX_PATTERN = re.compile(r'_(annotated|wra)(_[0-9a-f]+)?$')
 
-def http_server_task(http_server_root_dir: str, port: int, host: str):
-    # https://stackoverflow.com/a/52531444
-    def handler_from(directory):
-        def _init(self, *args, **kwargs):
-            return http.server.SimpleHTTPRequestHandler.__init__(self,
-                                                                 *args,
-                                                                 directory=self.directory,
-                                                                 **kwargs)
 
-        return type(f'HandlerFrom<{directory}>',
-                    (http.server.SimpleHTTPRequestHandler,),
-                    {'__init__': _init, 'directory': directory})
+class PendingArtifact(object):
+    """
+    An artifact (annotated image or WRA plot) that gets rendered when it is requested for the first time.
+    """
 
+    def __init__(self, render: Callable[[], Future], on_rendered: Optional[Callable[[str], None]] = None):
+        """
+        :param render: submits the rendering task and returns its future. The result of the future is a tuple
+        (image_id, path, task) (see MaxFocusRegionAnnotator and WRAPlotter)
+        :param on_rendered: called with the path of the artifact after it got rendered
+        """
+        self.render = render
+        self.on_rendered = on_rendered
+        self.future: Optional[Future] = None
+
+
+def handler_from(resolve_path: Callable[[str, str], Optional[str]]):
+    def _init(self, *args, **kwargs):
+        return http.server.SimpleHTTPRequestHandler.__init__(self, *args, **kwargs)
+
+    def translate_path(self, path: str) -> str:
+        # the URL paths are virtual, i.e., they are resolved to the files of the datasources (see resolve_path).
+        # an empty path is returned for unknown URLs which results in a 404
+        parts = url.urlsplit(path)
+        resolved = resolve_path(url.unquote(parts.path), parts.query)
+        return resolved if resolved is not None else ''
+
+    return type('VirtualPathHandler',
+                (http.server.SimpleHTTPRequestHandler,),
+                {'__init__': _init,
+                 'translate_path': translate_path})
+
+
+def http_server_task(port: int,
+                     host: str,
+                     resolve_path: Callable[[str, str], Optional[str]]):
     # TODO SSL support: https://gist.github.com/dergachev/7028596#gistcomment-3708957
-    with socketserver.TCPServer((host, port), handler_from(http_server_root_dir)) as httpd:
-        logger.info(f"Serving {http_server_root_dir} at {host}:{port} ...")
+    with socketserver.TCPServer((host, port), handler_from(resolve_path)) as httpd:
+        logger.info(f"Serving at {host}:{port} ...")
         httpd.serve_forever()
 
 
@@ -45,33 +76,52 @@ class PyHttpImageServer(ImageServer):
             cls._conf = conf.image_server['pyhttp']
             cls._base_url = cls.__get_img_server_base_url()
 
-            cls.link_root_dir = cls._conf.link_root_dir
-            if not os.path.lexists(cls.link_root_dir):
-                os.makedirs(cls.link_root_dir, exist_ok=True)
+            # setup the datasources (this is a no-op when __init__ gets called after __new__)
+            ImageServer.__init__(cls.__singleton)
+            # build the in-memory id -> path index of every datasource once so that the URLs can be resolved
+            # without touching the file system
+            for ds in cls.__singleton.datasources.values():
+                ds.build_index()
 
-            if cls._conf.flush_link_dir:
-                logger.info(f"Flushing link root directory {cls.link_root_dir}!")
-                for f in glob.glob(os.path.join(cls.link_root_dir, "*")):
-                    os.remove(f)
+            # directories of the cached artifacts that are served directly (see register_artifact_dir)
+            cls.artifact_dirs = dict()
+            # artifacts that get rendered on their first request (see register_pending_artifact)
+            cls.pending_artifacts: 'OrderedDict[str, PendingArtifact]' = OrderedDict()
+            cls.max_pending_artifacts = cls._conf.get('max_pending_artifacts', 10000)
+            cls.render_timeout = cls._conf.get('render_timeout', 30)
+            cls.pending_artifacts_lock = threading.Lock()
 
-            cls.annotated_images_filename_cache = dict()
-            cls.wra_plot_filename_cache = dict()
+            # resized variants of the images that are requested via ?w={width}
+            thumbnails_conf = cls._conf.get('thumbnails', None)
+            cls.thumbnail_cache = None
+            if thumbnails_conf is not None:
+                cls.thumbnail_cache = ThumbnailCache(cache_dir=thumbnails_conf.cache_dir,
+                                                     widths=list(thumbnails_conf.get('widths', [128, 256, 512])),
+                                                     quality=thumbnails_conf.get('quality', 85),
+                                                     max_size_mb=thumbnails_conf.get('cache_max_size_mb', 4096))
 
             # setup http server thread
             logger.info("Starting PyHttpImageServer Thread...")
             cls.http_server_thread = ThreadPoolExecutor(max_workers=1)
-            cls.http_server_thread.submit(http_server_task,
-                                          http_server_root_dir=cls.link_root_dir,
-                                          port=cls._conf.port,
-                                          host=cls._conf.host)
+            if conf.mmirs.get('img_server', 'pyhttp') == 'pyhttp_threaded':
+                # concurrent connections, keep-alive, sendfile, caching headers and range requests
+                cls.http_server_thread.submit(threaded_http_server_task,
+                                              port=cls._conf.port,
+                                              host=cls._conf.host,
+                                              resolve_path=cls.__singleton.resolve_path,
+                                              cache_max_age=cls._conf.get('cache_max_age', 3600))
+            else:
+                cls.http_server_thread.submit(http_server_task,
+                                              port=cls._conf.port,
+                                              host=cls._conf.host,
+                                              resolve_path=cls.__singleton.resolve_path)
             cls.timer = MMIRSTimer()
         return cls.__singleton
 
-    def clear_cache(self, annotated: bool = True, wra: bool = True):
-        if annotated:
-            self.annotated_images_filename_cache.clear()
-        if wra:
-            self.wra_plot_filename_cache.clear()
+    def clear_cache(self):
+        # forget the registered but not yet rendered artifacts
+        with self.pending_artifacts_lock:
+            self.pending_artifacts.clear()
 
     # noinspection PyUnresolvedReferences,PyProtectedMember
     def shutdown(self):
@@ -90,50 +140,30 @@ class PyHttpImageServer(ImageServer):
         base_url += cls._conf.context_path
         return base_url
 
-    def __hard_link_into_link_root_dir(self, image_path: str, force: bool = False) -> str:
-        link_dst = str(os.path.join(self.link_root_dir, os.path.basename(image_path)))
-        if not os.path.lexists(image_path):
-            logger.warning(f"Cannot read {image_path}!")
-        elif not os.path.lexists(link_dst):
-            os.link(image_path, link_dst)
-            logger.debug(f"Hard-linked {image_path} to {link_dst} !")
-        elif os.path.lexists(link_dst) and os.path.isfile(link_dst) and force:
-            logger.debug(f"Force overwrite {link_dst} with {image_path}!")
-            os.remove(link_dst)
-            os.link(image_path, link_dst)
-            logger.debug(f"Hard-linked {image_path} to {link_dst} !")
-        else:
-            logger.warning(f"Cannot hard-link to {link_dst}! File already exists!")
-
-        return link_dst
-
-    def get_img_url(self, img_id: str, dataset: str, annotated: bool = False) -> str:
-        # get the path of the image
-        img_p = self.get_image_path(img_id, dataset)
-        if not annotated:
-            # hard link into serving directory
-            link = self.__hard_link_into_link_root_dir(img_p)  # image is now available via url
-            return url.urljoin(self._base_url, os.path.basename(link))
-        else:
-            # the annotated images get registered in the MaxFocusRegionAnnotator, so we do not have to link them again
-            return url.urljoin(self._base_url, self.annotated_images_filename_cache[(img_id, dataset)])
-
-    def get_wra_url(self, img_id: str) -> str:
-        # the wra plots get registered in the WRAPlotter, so we do not have to link them again
-        return url.urljoin(self._base_url, self.wra_plot_filename_cache[img_id])
-
-    def get_img_urls(self, img_ids: List[str], dataset: str, annotated: bool = False) -> List[str]:
-        self.timer.start_measurement("PyHttpImageServer::get_img_urls")
-        urls = [self.get_img_url(img_id, dataset, annotated) for img_id in img_ids]
-        self.timer.stop_measurement()
-        return urls
+    def get_img_url(self, img_id: str, dataset: str, width: Optional[int] = None) -> str:
+        # the URL is virtual and gets resolved to the image of the datasource when it is requested
+        if dataset not in self.datasources:
+            logger.error(f"Images for Dataset {dataset} are not available!")
+            raise KeyError(f"Images for Dataset {dataset} are not available!")
+        img_url = url.urljoin(self._base_url, f"{dataset}/{url.quote(img_id)}")
+        if width is not None and self.thumbnail_cache is not None:
+            img_url += f"?w={self.thumbnail_cache.get_width(width)}"
+        return img_url
 
-    def get_wra_urls(self, img_ids: List[str]) -> List[str]:
+    def get_img_urls(self,
+                     img_ids: List[str],
+                     dataset: str,
+                     width: Optional[int] = None) -> List[str]:
         self.timer.start_measurement("PyHttpImageServer::get_img_urls")
-        urls = [self.get_wra_url(img_id) for img_id in img_ids]
+        urls = [self.get_img_url(img_id, dataset, width) for img_id in img_ids]
         self.timer.stop_measurement()
         return urls
 
+    def get_artifact_url(self, artifact_path: str, fragment: Optional[str] = None) -> str:
+        # the artifacts (e.g. annotated images) are served from their registered artifact directory
+        artifact_url = url.urljoin(self._base_url, self.__get_artifact_rel_path(artifact_path))
+        return artifact_url if fragment is None else f"{artifact_url}#{fragment}"
+
     def get_image_path(self, img_id: str, dataset: str) -> str:
         if dataset not in self.datasources:
             logger.error(f"Images for Dataset {dataset} are not available!")
@@ -142,17 +172,128 @@ class PyHttpImageServer(ImageServer):
 
     @staticmethod
     def get_image_id(img_url: str) -> str:
-        return os.path.splitext(os.path.basename(img_url))[0].replace("_annotated", "").replace("_wra", "")
+        img_path = url.urlsplit(img_url).path
+        return _ARTIFACT_SUFFIX_PATTERN.sub('', os.path.splitext(os.path.basename(img_path))[0])
 
     def get_image_ids(self, img_urls: List[str]) -> List[str]:
         return [self.get_image_id(img_url) for img_url in img_urls]
 
-    def register_annotated_image(self, img_id: str, dataset: str, annotated_image_path: str):
-        self.__hard_link_into_link_root_dir(annotated_image_path, force=True)
-        self.annotated_images_filename_cache[(img_id, dataset)] = os.path.basename(annotated_image_path)
-        logger.debug(f"Registered annotated image for Image {img_id} of dataset {dataset}!")
+    def register_artifact_dir(self, name: str, artifact_dir: str):
+        """
+        Makes all files in the artifact directory (e.g. the RenderCache of the annotated images) available under
+        {base_url}/{name}/. Hence, evicted artifacts are not served anymore.
+        :param name: the name of the directory in the URLs. Must not be the name of a dataset.
+        :param artifact_dir: the directory containing the artifacts
+        """
+        if name in self.datasources:
+            raise KeyError(f"Cannot register artifact directory {name} since there is a dataset with the same name!")
+        self.artifact_dirs[name] = os.path.abspath(artifact_dir)
+
+    def __get_artifact_rel_path(self, artifact_path: str) -> str:
+        artifact_dir = os.path.dirname(os.path.abspath(artifact_path))
+        for name, d in self.artifact_dirs.items():
+            if d == artifact_dir:
+                return f"{name}/{os.path.basename(artifact_path)}"
+        raise ValueError(f"{artifact_path} is not in a registered artifact directory!")
+
+    def resolve_path(self, url_path: str, query: str = '') -> Optional[str]:
+        """
+        Resolves the (unquoted) path of a URL to the file that gets served. This is called by the http server.
+         - {context_path}/{dataset}/{image_id} -> the image of the datasource (in-memory lookup, no I/O)
+         - {context_path}/{dataset}/{image_id}?w={width} -> the (cached) thumbnail of the image
+         - {context_path}/{artifact_dir}/{file_name} -> the artifact. Pending artifacts get rendered first.
+        :param url_path: the unquoted path of the URL
+        :param query: the query string of the URL
+        :return: the path of the file or None if the URL path is unknown
+        """
+        context_path = self._conf.context_path
+        if url_path.startswith(context_path):
+            url_path = url_path[len(context_path):]
+        parts = url_path.strip('/').split('/')
+        if len(parts) != 2:
+            return None
+        prefix, name = parts
+
+        if prefix in self.datasources:
+            img_path = self.datasources[prefix].lookup_image_path(name)
+            width = self.__parse_width(query)
+            if img_path is None or width is None or self.thumbnail_cache is None:
+                return img_path
+            # fall back to the original image if the thumbnail cannot be created
+            return self.thumbnail_cache.get_or_create(prefix, name, img_path, width) or img_path
+        if prefix in self.artifact_dirs and name not in ('', '.', '..'):
+            self.render_pending_artifact(f"{prefix}/{name}")
+            return os.path.join(self.artifact_dirs[prefix], name)
+        return None
+
+    @staticmethod
+    def __parse_width(query: str) -> Optional[int]:
+        if not query:
+            return None
+        w = url.parse_qs(query).get('w', None)
+        if w is None:
+            return None
+        try:
+            w = int(w[0])
+        except ValueError:
+            return None
+        return w if w > 0 else None
+
+    def register_pending_artifact(self,
+                                  artifact_path: str,
+                                  render: Callable[[], Future],
+                                  on_rendered: Optional[Callable[[str], None]] = None):
+        """
+        Registers an artifact that is not rendered yet. It gets rendered when its URL is requested for the first time.
+        :param artifact_path: the path of the artifact. Has to be in a registered artifact directory.
+        :param render: submits the rendering task and returns its future
+        :param on_rendered: called with the path of the artifact after it got rendered
+        """
+        rel_path = self.__get_artifact_rel_path(artifact_path)
+        with self.pending_artifacts_lock:
+            if rel_path in self.pending_artifacts:
+                self.pending_artifacts.move_to_end(rel_path)
+                return
+            self.pending_artifacts[rel_path] = PendingArtifact(render=render, on_rendered=on_rendered)
+            # forget the oldest artifacts that were never requested
+            while len(self.pending_artifacts) > self.max_pending_artifacts:
+                self.pending_artifacts.popitem(last=False)
+
+    def render_pending_artifact(self, rel_path: str) -> bool:
+        """
+        Renders the pending artifact and blocks until it is rendered. Concurrent requests of the same artifact wait
+        for the same rendering task.
+        :param rel_path: the path of the artifact relative to the base URL
+        :return: true if the artifact was pending and got rendered
+        """
+        with self.pending_artifacts_lock:
+            pa = self.pending_artifacts.get(rel_path, None)
+            if pa is None:
+                return False
+            if pa.future is None:
+                pa.future = pa.render()
+            future = pa.future
+
+        # no MMIRSTimer measurement here since this runs in the http server thread and not in the request thread
+        start = time.time()
+        try:
+            _, dst, _ = future.result(timeout=self.render_timeout)
+        except Exception as e:
+            if not future.done():
+                # the task is still running, i.e., the next request waits for it instead of rendering it again
+                logger.error(f"Rendering pending artifact {rel_path} takes longer than {self.render_timeout}s!")
+                return False
+            logger.error(f"Cannot render pending artifact {rel_path}! {e}")
+            with self.pending_artifacts_lock:
+                # the task failed. allow a retry with the next request
+                if pa.future is future:
+                    pa.future = None
+            return False
 
-    def register_wra_plot(self, img_id: str, wra_plot_path: str):
-        self.__hard_link_into_link_root_dir(wra_plot_path, force=True)
-        self.wra_plot_filename_cache[img_id] = os.path.basename(wra_plot_path)
-        logger.debug(f"Registered WRA Plot for Image {img_id}!")
+        with self.pending_artifacts_lock:
+            if self.pending_artifacts.get(rel_path, None) is pa:
+                del self.pending_artifacts[rel_path]
+        if pa.on_rendered is not None:
+            pa.on_rendered(dst)
+        logger.debug(f"Rendered pending artifact {rel_path} in {time.time() - start:.3f}s!")
+        return True
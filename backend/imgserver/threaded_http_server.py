@@ -0,0 +1,197 @@
+import email.utils
+import http.server
+import os
+import re
+import urllib.parse as url
+from typing import Callable, Optional, Tuple
+
+from loguru import logger
+
+_RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Parses a single byte range of a Range header.
+    :param range_header: the value of the Range header, e.g. bytes=0-499, bytes=500- or bytes=-500
+    :param size: the size of the file in bytes
+    :return: the (inclusive) range (start, end) or None if the range is not satisfiable
+    """
+    m = _RANGE_PATTERN.match(range_header.strip())
+    if m is None:
+        return None
+    start, end = m.group(1), m.group(2)
+    if start == '' and end == '':
+        return None
+    if start == '':
+        # suffix range, i.e., the last n bytes
+        n = int(end)
+        if n == 0:
+            return None
+        return max(0, size - n), size - 1
+    start = int(start)
+    end = size - 1 if end == '' else min(int(end), size - 1)
+    if start >= size or start > end:
+        return None
+    return start, end
+
+
+class StaticFileRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """
+    Request handler that serves the (image) files the virtual URL paths get resolved to (see create_handler).
+     - HTTP/1.1 with keep-alive
+     - ETag / Last-Modified validation (304) and Cache-Control headers
+     - single byte range requests (206 / 416)
+     - the file content is sent via os.sendfile (zero-copy) if available
+     - no directory listings
+    """
+    protocol_version = 'HTTP/1.1'
+    # see create_handler
+    resolve_path: Optional[Callable[[str, str], Optional[str]]] = None
+    cache_max_age: int = 3600
+
+    def __init__(self, *args, **kwargs):
+        # (offset, count) of the file content that gets sent
+        self._content_range = (0, 0)
+        super().__init__(*args, **kwargs)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+    def translate_path(self, path: str) -> str:
+        # the URL paths (and query strings) are virtual, i.e., they are resolved to the files of the datasources (see
+        # PyHttpImageServer.resolve_path). an empty path is returned for unknown URLs which results in a 404
+        parts = url.urlsplit(path)
+        resolved = self.resolve_path(url.unquote(parts.path), parts.query)
+        return resolved if resolved is not None else ''
+
+    def do_GET(self):
+        f = self.send_head()
+        if f:
+            try:
+                self.copyfile(f, self.wfile)
+            finally:
+                f.close()
+
+    def do_HEAD(self):
+        f = self.send_head()
+        if f:
+            f.close()
+
+    def __is_not_modified(self, etag: str, mtime: float) -> bool:
+        if 'If-None-Match' in self.headers:
+            # If-None-Match takes precedence over If-Modified-Since
+            tags = [t.strip() for t in self.headers['If-None-Match'].split(',')]
+            return etag in tags or '*' in tags
+        if 'If-Modified-Since' in self.headers:
+            try:
+                since = email.utils.parsedate_to_datetime(self.headers['If-Modified-Since'])
+            except (TypeError, IndexError, OverflowError, ValueError):
+                return False
+            return since is not None and int(mtime) <= since.timestamp()
+        return False
+
+    def __send_validators(self, etag: str, mtime: float):
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.date_time_string(int(mtime)))
+        self.send_header('Cache-Control', f'public, max-age={self.cache_max_age}')
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if os.path.isdir(path):
+            self.send_error(http.HTTPStatus.NOT_FOUND, "File not found")
+            return None
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(http.HTTPStatus.NOT_FOUND, "File not found")
+            return None
+
+        try:
+            fs = os.fstat(f.fileno())
+            size = fs.st_size
+            etag = f'"{fs.st_mtime_ns:x}-{size:x}"'
+
+            if self.__is_not_modified(etag, fs.st_mtime):
+                self.send_response(http.HTTPStatus.NOT_MODIFIED)
+                self.__send_validators(etag, fs.st_mtime)
+                self.end_headers()
+                f.close()
+                return None
+
+            start, end = 0, size - 1
+            status = http.HTTPStatus.OK
+            range_header = self.headers.get('Range', None)
+            # a Range request with an outdated If-Range gets the full content
+            if range_header is not None and self.headers.get('If-Range', etag) == etag:
+                if ',' in range_header:
+                    # multiple ranges are not supported -> full content
+                    pass
+                else:
+                    rng = parse_range(range_header, size)
+                    if rng is None:
+                        self.send_response(http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                        self.send_header('Content-Range', f'bytes */{size}')
+                        self.send_header('Content-Length', '0')
+                        self.end_headers()
+                        f.close()
+                        return None
+                    start, end = rng
+                    status = http.HTTPStatus.PARTIAL_CONTENT
+
+            self.send_response(status)
+            self.send_header('Content-Type', self.guess_type(path))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            if status == http.HTTPStatus.PARTIAL_CONTENT:
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            self.__send_validators(etag, fs.st_mtime)
+            self.end_headers()
+            self._content_range = (start, end - start + 1)
+            return f
+        except:
+            f.close()
+            raise
+
+    def copyfile(self, source, outputfile):
+        offset, count = self._content_range
+        if hasattr(os, 'sendfile'):
+            # the headers are already flushed (the socket writer is unbuffered), so we can write to the socket directly
+            sock_fd, file_fd = self.connection.fileno(), source.fileno()
+            while count > 0:
+                sent = os.sendfile(sock_fd, file_fd, offset, count)
+                if sent == 0:
+                    break
+                offset += sent
+                count -= sent
+        else:
+            source.seek(offset)
+            while count > 0:
+                buf = source.read(min(count, 64 * 1024))
+                if not buf:
+                    break
+                outputfile.write(buf)
+                count -= len(buf)
+
+
+def create_handler(resolve_path: Callable[[str, str], Optional[str]], cache_max_age: int = 3600):
+    return type('VirtualPathStaticFileRequestHandler',
+                (StaticFileRequestHandler,),
+                {'resolve_path': staticmethod(resolve_path),
+                 'cache_max_age': cache_max_age})
+
+
+class ThreadingImageHTTPServer(http.server.ThreadingHTTPServer):
+    # every connection is handled by its own (daemon) thread
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+def threaded_http_server_task(port: int,
+                              host: str,
+                              resolve_path: Callable[[str, str], Optional[str]],
+                              cache_max_age: int = 3600):
+    with ThreadingImageHTTPServer((host, port), create_handler(resolve_path, cache_max_age)) as httpd:
+        logger.info(f"Serving at {host}:{port} with a threaded server...")
+        httpd.serve_forever()
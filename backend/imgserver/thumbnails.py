@@ -0,0 +1,87 @@
+import os
+import threading
+from typing import List, Optional
+
+from PIL import Image
+from loguru import logger
+
+from backend.util.render_cache import RenderCache
+
+
+def create_thumbnail(src: str, dst: str, width: int, quality: int = 85) -> str:
+    """
+    Creates a JPEG thumbnail with the given width (the aspect ratio is kept). Images are never upscaled.
+    :param src: the path of the original image
+    :param dst: the path of the thumbnail
+    :param width: the (max) width of the thumbnail
+    :param quality: the JPEG quality of the thumbnail
+    :return: the path of the thumbnail
+    """
+    with Image.open(src) as im:
+        if im.width > width:
+            # JPEG draft mode: the decoder directly downscales by 1/2, 1/4 or 1/8 (as far as the result is still
+            # larger than the requested size), so the full-resolution image never gets decoded
+            im.draft('RGB', (width, max(1, round(im.height * width / im.width))))
+        im = im.convert('RGB')
+
+    if im.width > width:
+        im = im.resize((width, max(1, round(im.height * width / im.width))), Image.LANCZOS)
+
+    # write into a temporary file and rename it afterwards so that the thumbnail is never read half-written.
+    # the file is unique per thread since the http server threads may create the same thumbnail concurrently
+    tmp_dst = f"{RenderCache.get_tmp_path(dst)}.{threading.get_ident()}"
+    im.save(tmp_dst, format='JPEG', quality=quality)
+    os.replace(tmp_dst, dst)
+    return dst
+
+
+class ThumbnailCache(object):
+    """
+    Size-bounded disk cache of the resized variants (e.g. ?w=256) of the images of the datasources.
+    """
+
+    def __init__(self, cache_dir: str, widths: List[int], quality: int = 85, max_size_mb: float = 4096):
+        """
+        :param cache_dir: the directory containing the thumbnails
+        :param widths: the supported widths. Requested widths are snapped to the next supported width.
+        :param quality: the JPEG quality of the thumbnails
+        :param max_size_mb: the disk budget of the thumbnails. The least recently used thumbnails get evicted.
+        """
+        if len(widths) == 0:
+            raise ValueError("At least one thumbnail width is required!")
+        self.widths = sorted(int(w) for w in widths)
+        self.quality = quality
+        self.render_cache = RenderCache(cache_dir=cache_dir, max_size_mb=max_size_mb, name='thumbnails')
+        logger.info(f"ThumbnailCache with widths {self.widths} has {self.render_cache}")
+
+    def get_width(self, requested_width: int) -> int:
+        """
+        :return: the smallest supported width that is at least the requested width (or the largest supported width)
+        """
+        for w in self.widths:
+            if w >= requested_width:
+                return w
+        return self.widths[-1]
+
+    def get_thumbnail_path(self, dataset: str, img_id: str, width: int) -> str:
+        key = RenderCache.compute_key(dataset, img_id, width, self.quality)
+        return self.render_cache.get_path(f"{dataset}_{img_id}", f"w{width}", key, 'jpg')
+
+    def get_or_create(self, dataset: str, img_id: str, src: str, requested_width: int) -> Optional[str]:
+        """
+        :return: the path of the (cached) thumbnail of the image or None if it cannot be created
+        """
+        width = self.get_width(requested_width)
+        dst = self.get_thumbnail_path(dataset, img_id, width)
+        if self.render_cache.lookup(dst):
+            return dst
+        try:
+            create_thumbnail(src, dst, width, self.quality)
+        except Exception as e:
+            logger.error(f"Cannot create thumbnail of {src} with width {width}! {e}")
+            return None
+        self.render_cache.add(dst)
+        return dst
+
+    def __repr__(self):
+        return f"ThumbnailCache(widths={self.widths}, quality={self.quality}, cache={self.render_cache})"
@@ -1,12 +1,14 @@
+import queue
+import threading
+
 from loguru import logger
-from typing import List, Tuple, Set, Union, Optional
+from typing import List, Tuple, Set, Union, Optional, Dict, Callable, Any
 
 # from api.model import RetrievalRequest
 from backend.fineselection import FineSelectionStage
-from backend.fineselection.data import ImageFeaturePoolFactory
-from backend.fineselection.retriever import RetrieverFactory
 from backend.imgserver.py_http_image_server import PyHttpImageServer
 from backend.preselection import PreselectionStage
+from backend.util import availability
 from backend.util.mmirs_timer import MMIRSTimer
 from config import conf
 
@@ -22,7 +24,7 @@ class MMIRS(object):
             cls._conf = conf.mmirs
 
             # start the image server
-            if conf.mmirs.img_server == 'pyhttp':
+            if conf.mmirs.img_server in ('pyhttp', 'pyhttp_threaded'):
                 cls.img_srv = PyHttpImageServer()
             else:
                 raise NotImplementedError(f"Image Server {conf.mmirs.img_server} not available!")
@@ -31,15 +33,100 @@ class MMIRS(object):
             cls.pss = PreselectionStage()
             cls.fss = FineSelectionStage()
 
+            # number of PSS candidates that are sent to the client when the results are streamed
+            cls.max_streamed_candidates = cls._conf.get('streaming', {}).get('max_pss_candidates', 100)
+
             cls.timer = MMIRSTimer()
 
+            # lazy initialization: the models and indices are loaded on their first use per dataset. the datasets
+            # (and retrievers) to warm up are loaded by a background thread
+            lazy_conf = conf.get('lazy_init', {})
+            cls.lazy_init = lazy_conf.get('enabled', False)
+            cls.warm_up_queue = queue.Queue()
+            cls.pending_warm_ups: Set[Tuple[str, str]] = set()
+            cls.pending_warm_ups_lock = threading.Lock()
+            if cls.lazy_init:
+                threading.Thread(target=cls.__singleton.__warm_up_worker, name='mmirs_warm_up', daemon=True).start()
+                for target in lazy_conf.get('warm_up', []):
+                    cls.__singleton.request_warm_up(dataset=target.dataset, retriever_name=target.retriever)
+
         return cls.__singleton
 
+    def warm_up(self, dataset: str, retriever_name: str):
+        """
+        Loads the models and indices of the PSS and FSS that are required to retrieve images of the dataset with the
+        retriever. Blocks until everything is loaded.
+        """
+        if (dataset, retriever_name) not in self.get_available_image_feature_pools():
+            raise KeyError(f"{dataset} ImagePool for {retriever_name} Retriever is not available!")
+        self.pss.load_dataset(dataset)
+        self.fss.load(dataset, retriever_name)
+
+    def request_warm_up(self, dataset: str, retriever_name: str):
+        """
+        Warms up the dataset and retriever in the background (see warm_up).
+        """
+        with self.pending_warm_ups_lock:
+            if (dataset, retriever_name) in self.pending_warm_ups or self.is_ready(dataset, retriever_name):
+                return
+            self.pending_warm_ups.add((dataset, retriever_name))
+        self.warm_up_queue.put((dataset, retriever_name))
+
+    def __warm_up_worker(self):
+        while True:
+            dataset, retriever_name = self.warm_up_queue.get()
+            logger.info(f"Warming up {dataset} for {retriever_name}...")
+            try:
+                self.warm_up(dataset, retriever_name)
+                logger.info(f"Warmed up {dataset} for {retriever_name}!")
+            except Exception as e:
+                logger.error(f"Cannot warm up {dataset} for {retriever_name}! {e}")
+            finally:
+                with self.pending_warm_ups_lock:
+                    self.pending_warm_ups.discard((dataset, retriever_name))
+
+    def is_ready(self, dataset: str, retriever_name: str) -> bool:
+        """
+        :return: True if everything that is required to retrieve images of the dataset with the retriever is loaded
+        """
+        return self.pss.is_dataset_loaded(dataset) and self.fss.is_loaded(dataset, retriever_name)
+
+    def is_warming_up(self) -> bool:
+        with self.pending_warm_ups_lock:
+            return len(self.pending_warm_ups) > 0
+
+    def get_ready_datasets(self) -> List[Tuple[str, str]]:
+        """
+        :return: the (dataset, retriever) pairs that are ready (see is_ready)
+        """
+        return sorted(pair for pair in self.get_available_image_feature_pools() if self.is_ready(*pair))
+
+    @staticmethod
+    def __fix_image_ids(image_ids: List[str], dataset: str) -> List[str]:
+        # FIXME do this elsewhere!
+        if dataset == 'coco':
+            fixed_tk = []
+            for tk in image_ids:
+                while len(str(tk)) != 6:
+                    tk = '0' + tk
+                fixed_tk.append(tk)
+            return fixed_tk
+        return image_ids
+
     # FIXME we cannot give a type hint for req: RetrievalRequest b
-    def retrieve_top_k_images(self, req) -> Union[List[str], Tuple[List[str], List[str]]]:
+    def retrieve_top_k_images(self,
+                              req,
+                              on_event: Optional[Callable[[str, Dict[str, Any]], None]] = None) \
+            -> Union[List[str], Tuple[List[str], Union[List[str], Dict]]]:
         """
         Retrieves the top-k matching images according to focus and context in the specified image pool with the specified
         retriever.
+        :param on_event: optional callback to report the progress (e.g. to stream the results). Gets called with
+         - 'pss' and the number and (some) URLs of the PSS candidates
+         - 'top_k' and the URLs of the ranked top-k (not annotated) images
+         - 'annotated' / 'wra_plot' and the rank and URL of every annotated image / wra plot as soon as it is available
+        :return: the URLs of the top-k images. If return_wra_matrices is true, additionally the URLs of the wra plots
+        or, if wra_format is 'npz', a dict with the wra matrices (see FineSelectionStage.find_top_k_images)
         """
         self.timer.start_measurement("MMIRS::top_k_images")
         focus = req.focus
@@ -53,6 +140,8 @@ class MMIRS(object):
         focus_weight = req.focus_weight
         return_scores = req.return_scores
         return_wra_matrices = req.return_wra_matrices
+        thumbnail_width = req.thumbnail_width
+        wra_format = req.wra_format
 
         # find relevant images via PreselectionStage
         pss_imgs = self.pss.retrieve_relevant_images(focus=focus,
@@ -65,6 +154,20 @@ class MMIRS(object):
                                                      min_num_relevant=self._conf.pss.min_num_relevant,
                                                      focus_weight_by_sim=self._conf.pss.focus_weight_by_sim,
                                                      exact_context_retrieval=self._conf.pss.exact_context_retrieval)
+        if on_event is not None:
+            candidates = self.__fix_image_ids(pss_imgs[:self.max_streamed_candidates], dataset)
+            on_event('pss', {'num_candidates': len(pss_imgs),
+                             'urls': self.img_srv.get_img_urls(candidates, dataset, width=thumbnail_width)})
+
+        def on_fss_event(event: str, data: Dict[str, Any]):
+            # translate the image ids of the FSS into URLs
+            if event == 'top_k':
+                on_event(event, {'urls': self.img_srv.get_img_urls(data['image_ids'], dataset, width=thumbnail_width)})
+            elif event == 'annotated':
+                on_event(event, {'rank': data['rank'], 'url': self.img_srv.get_artifact_url(data['path'])})
+            elif event == 'wra_plot':
+                on_event(event, {'rank': data['rank'],
+                                 'url': self.img_srv.get_artifact_url(data['path'], data['fragment'])})
 
         # find the top-k images in the relevant images via FineSelectionStage
         top_k_img_ids = self.fss.find_top_k_images(focus=focus,
@@ -77,12 +180,27 @@ class MMIRS(object):
                                                    annotate_max_focus_region=annotate_max_focus_region,
                                                    focus_weight=focus_weight,
                                                    return_scores=return_scores,
-                                                   return_wra_matrices=return_wra_matrices)
+                                                   return_wra_matrices=return_wra_matrices,
+                                                   wra_format=wra_format,
+                                                   on_event=on_fss_event if on_event is not None else None)
+        # the artifacts (annotated images, wra plots) of this request
+        artifacts = {}
+        if annotate_max_focus_region or return_wra_matrices:
+            top_k_img_ids, artifacts = top_k_img_ids
 
         # get URLs
-        top_k_img_urls = self.img_srv.get_img_urls(top_k_img_ids, dataset, annotated=annotate_max_focus_region)
+        if annotate_max_focus_region:
+            top_k_img_urls = [self.img_srv.get_artifact_url(path) for path in artifacts['annotated_images']]
+        else:
+            # thumbnails are only available for the original images
+            top_k_img_urls = self.img_srv.get_img_urls(top_k_img_ids, dataset, width=thumbnail_width)
+        if 'wra_payload' in artifacts:
+            # the raw wra matrices instead of the URLs of the plots
+            self.timer.stop_measurement()
+            return top_k_img_urls, artifacts['wra_payload']
         if return_wra_matrices:
-            top_k_wra_urls = self.img_srv.get_wra_urls(top_k_img_ids)
+            top_k_wra_urls = [self.img_srv.get_artifact_url(path, fragment)
+                              for path, fragment in artifacts['wra_plots']]
             self.timer.stop_measurement()
             return top_k_img_urls, top_k_wra_urls
 
@@ -104,17 +222,10 @@ class MMIRS(object):
                                                                         k=k,
                                                                         exact=exact)
 
-        # FIXME do this elsewhere!
-        if dataset == 'coco':
-            fixed_tk = []
-            for tk in top_k_img_ids:
-                while len(str(tk)) != 6:
-                    tk = '0' + tk
-                fixed_tk.append(tk)
-            top_k_img_ids = fixed_tk
+        top_k_img_ids = self.__fix_image_ids(top_k_img_ids, dataset)
 
         # get URLs
-        top_k_img_urls = self.img_srv.get_img_urls(top_k_img_ids, dataset, annotated=False)
+        top_k_img_urls = self.img_srv.get_img_urls(top_k_img_ids, dataset)
         self.timer.stop_measurement()
         return top_k_img_urls
 
@@ -147,17 +258,10 @@ class MMIRS(object):
             top_k_image_ids = list(focus_relevant.keys())
             similar_terms = None
 
-        # FIXME do this elsewhere!
-        if dataset == 'coco':
-            fixed_tk = []
-            for tk in top_k_image_ids:
-                while len(str(tk)) != 6:
-                    tk = '0' + tk
-                fixed_tk.append(tk)
-            top_k_image_ids = fixed_tk
+        top_k_image_ids = self.__fix_image_ids(top_k_image_ids, dataset)
 
         # get URLs
-        top_k_img_urls = self.img_srv.get_img_urls(top_k_image_ids, dataset, annotated=False)
+        top_k_img_urls = self.img_srv.get_img_urls(top_k_image_ids, dataset)
         self.timer.stop_measurement()
         if return_similar_terms:
             return top_k_img_urls, similar_terms
@@ -166,16 +270,12 @@ class MMIRS(object):
 
     @staticmethod
     def get_available_image_feature_pools() -> Set[Tuple[str, str]]:
-        return ImageFeaturePoolFactory().get_available_pools()
+        return set(availability.get_available_image_feature_pools())
 
     @staticmethod
     def dataset_is_available(dataset: str) -> bool:
-        pools = MMIRS.get_available_image_feature_pools()
-        for ds, target_ret in pools:
-            if ds == dataset:
-                return True
-        return False
+        return availability.dataset_is_available(dataset)
 
     @staticmethod
     def get_available_retrievers() -> List[str]:
-        return RetrieverFactory().get_available_retrievers()
+        return sorted(availability.get_available_retrievers())
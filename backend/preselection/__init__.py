@@ -1,5 +1,15 @@
-from .focus.visual_vocab import VisualVocab
-from .focus.image_metadata import ImageMetadata, ROI
-from .focus.focus_preselector import FocusPreselector
-from .context.context_preselector import ContextPreselector, verify_embedding_structure, load_sentence_embeddings
-from .preselection_stage import PreselectionStage, MergeOp
+from backend.util.lazy_import import lazy_attributes
+
+# the attributes are imported from the submodules on their first access (see lazy_attributes)
+__getattr__, __dir__ = lazy_attributes(__name__, {
+    'VisualVocab': '.focus.visual_vocab',
+    'ImageMetadata': '.focus.image_metadata',
+    'ROI': '.focus.image_metadata',
+    'FocusPreselector': '.focus.focus_preselector',
+    'ContextPreselector': '.context.context_preselector',
+    'verify_embedding_structure': '.context.context_preselector',
+    'load_sentence_embeddings': '.context.context_preselector',
+    'PreselectionStage': '.preselection_stage',
+    'MergeOp': '.preselection_stage',
+})
+__all__ = ['VisualVocab', 'ImageMetadata', 'ROI', 'FocusPreselector', 'ContextPreselector', 'verify_embedding_structure', 'load_sentence_embeddings', 'PreselectionStage', 'MergeOp']
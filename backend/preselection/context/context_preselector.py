@@ -1,13 +1,16 @@
 import pickle
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, List, Tuple
 
 import faiss
 import numpy as np
 from loguru import logger
 from sentence_transformers import util, SentenceTransformer
 
+from backend.util.lazy_dict import LazyDict
+from backend.util.micro_batcher import MicroBatcher
 from backend.util.mmirs_timer import MMIRSTimer
+from backend.util.request_executor import RequestExecutor
 from config import conf
 
 
@@ -46,44 +49,83 @@ class ContextPreselector(object):
                 logger.error("Both, use_symmetric and use_asymmetric are set to False!")
                 SystemError("Both, use_symmetric and use_asymmetric are set to False!")
 
-            logger.info("Loading SentenceEmbeddings into Memory...")
+            # the embeddings, models and indices get loaded on their first use (per dataset) if lazy_init is enabled
             if pssc_conf.use_symmetric:
-                cls.symmetric_embeddings = {
-                    ds_name: load_sentence_embeddings(Path(embs_path))
-                    for ds_name, embs_path in pssc_conf.sbert.symmetric_embeddings.items()
-                }
+                cls.symmetric_embeddings = LazyDict(
+                    keys=pssc_conf.sbert.symmetric_embeddings.keys(),
+                    load=lambda ds: load_sentence_embeddings(Path(pssc_conf.sbert.symmetric_embeddings[ds])),
+                    name='symmetric SentenceEmbeddings')
             if pssc_conf.use_asymmetric:
-                cls.asymmetric_embeddings = {
-                    ds_name: load_sentence_embeddings(Path(embs_path))
-                    for ds_name, embs_path in pssc_conf.sbert.asymmetric_embeddings.items()
-                }
+                cls.asymmetric_embeddings = LazyDict(
+                    keys=pssc_conf.sbert.asymmetric_embeddings.keys(),
+                    load=lambda ds: load_sentence_embeddings(Path(pssc_conf.sbert.asymmetric_embeddings[ds])),
+                    name='asymmetric SentenceEmbeddings')
 
-            logger.info("Loading SentenceTransformer Models into Memory...")
-            cls.sembedders = {}
+            models = {}
             if pssc_conf.use_symmetric:
-                cls.sembedders['symm'] = SentenceTransformer(cls.symmetric_model)
+                models['symm'] = cls.symmetric_model
             if pssc_conf.use_asymmetric:
-                cls.sembedders['asym'] = SentenceTransformer(cls.asymmetric_model)
+                models['asym'] = cls.asymmetric_model
+            cls.sembedders = LazyDict(keys=models.keys(),
+                                      load=lambda m: SentenceTransformer(models[m]),
+                                      name='SentenceTransformer Models')
 
             # setup faiss
             # TODO check comment regarding nprobe for FlatIPIndex quantizer on github
             cls.faiss_nprobe = pssc_conf.faiss.nprobe
-            logger.info("Loading FAISS Indices into Memory...")
             if pssc_conf.use_symmetric:
-                cls.symmetric_indices = {
-                    ds_name: faiss.read_index(idx_path)
-                    for ds_name, idx_path in pssc_conf.faiss.symmetric_indices.items()
-                }
+                cls.symmetric_indices = LazyDict(keys=pssc_conf.faiss.symmetric_indices.keys(),
+                                                 load=lambda ds: faiss.read_index(pssc_conf.faiss.symmetric_indices[ds]),
+                                                 name='symmetric FAISS Indices')
             if pssc_conf.use_asymmetric:
-                cls.asymmetric_indices = {
-                    ds_name: faiss.read_index(idx_path)
-                    for ds_name, idx_path in pssc_conf.faiss.asymmetric_indices.items()
-                }
+                cls.asymmetric_indices = LazyDict(keys=pssc_conf.faiss.asymmetric_indices.keys(),
+                                                  load=lambda ds: faiss.read_index(
+                                                      pssc_conf.faiss.asymmetric_indices[ds]),
+                                                  name='asymmetric FAISS Indices')
+
+            if not conf.get('lazy_init', {}).get('enabled', False):
+                logger.info("Loading SentenceEmbeddings, SentenceTransformer Models and FAISS Indices into Memory...")
+                cls.sembedders.load_all()
+                if pssc_conf.use_symmetric:
+                    cls.symmetric_embeddings.load_all()
+                    cls.symmetric_indices.load_all()
+                if pssc_conf.use_asymmetric:
+                    cls.asymmetric_embeddings.load_all()
+                    cls.asymmetric_indices.load_all()
+
+            # micro-batching of the contexts of concurrent requests
+            batching_conf = pssc_conf.get('batching', {})
+            cls.batcher = None
+            if batching_conf.get('enabled', False):
+                executor = RequestExecutor()
+                cls.batcher = MicroBatcher(name='context_preselector',
+                                           batch_fn=cls.__singleton.__retrieve_batch,
+                                           max_batch_size=batching_conf.get('max_batch_size', 16),
+                                           max_wait_ms=batching_conf.get('max_wait_ms', 5),
+                                           # only wait for contexts of requests that are running concurrently
+                                           concurrency=lambda: min(executor.num_pending, executor.max_workers))
 
             cls.timer = MMIRSTimer()
 
         return cls.__singleton
 
+    def load_dataset(self, dataset: str):
+        """
+        Loads the (symmetric) sentence embeddings and FAISS index of the dataset and the SentenceTransformer model.
+        """
+        self.sembedders['symm']
+        if self.sentence_embeddings_available_for_dataset(dataset, symmetric=True):
+            self.symmetric_embeddings[dataset]
+        if self.faiss_index_available_for_dataset(dataset, symmetric=True):
+            self.symmetric_indices[dataset]
+
+    def is_dataset_loaded(self, dataset: str) -> bool:
+        return self.sembedders.is_loaded('symm') and \
+               (not self.sentence_embeddings_available_for_dataset(dataset, symmetric=True)
+                or self.symmetric_embeddings.is_loaded(dataset)) and \
+               (not self.faiss_index_available_for_dataset(dataset, symmetric=True)
+                or self.symmetric_indices.is_loaded(dataset))
+
     def faiss_index_available_for_dataset(self, dataset: str, symmetric: bool):
         indices = self.symmetric_indices if symmetric else self.asymmetric_indices
         return dataset in indices.keys()
@@ -92,17 +134,16 @@ class ContextPreselector(object):
         embs = self.symmetric_embeddings if symmetric else self.asymmetric_embeddings
         return dataset in embs.keys()
 
-    def __compute_context_embedding(self, context: str):
-        self.timer.start_measurement('PSS::CPS::__compute_context_embedding')
-        # compute context embedding
-        context_embedding = self.sembedders['symm'].encode(context)
+    def __compute_context_embeddings(self, contexts: List[str]) -> np.ndarray:
+        self.timer.start_measurement('PSS::CPS::__compute_context_embeddings')
+        # compute the context embeddings in a single forward pass
+        context_embeddings = self.sembedders['symm'].encode(contexts)
 
-        # normalize vector to unit length, so that inner product is equal to cosine similarity
-        context_embedding = context_embedding / np.linalg.norm(context_embedding)
-        context_embedding = np.expand_dims(context_embedding, axis=0)
+        # normalize vectors to unit length, so that inner product is equal to cosine similarity
+        context_embeddings = context_embeddings / np.linalg.norm(context_embeddings, axis=1, keepdims=True)
         self.timer.stop_measurement()
 
-        return context_embedding
+        return context_embeddings
 
     def retrieve_top_k_relevant_images(self,
                                        context: str,
@@ -123,12 +164,46 @@ class ContextPreselector(object):
         :return: a dictionary containing the top-k relevant images. Keys are image ids. Values are relevance scores.
         :rtype:
         """
-        # TODO for now we only use symmetric
-        #   in later versions we want to decide this dynamically by analysing the query (embedding)
         self.timer.start_measurement('PSS::CPS::retrieve_top_k_relevant_images')
         logger.debug(
             f"Retrieving top-{k} relevant images with exact={exact} in dataset {dataset} for context {context}")
-        context_embedding = self.__compute_context_embedding(context)
+        if self.batcher is not None:
+            # the context gets encoded and searched together with the contexts of concurrent requests
+            top_k_matches = self.batcher.submit((dataset, exact), (context, k))
+        else:
+            top_k_matches = self.retrieve_top_k_relevant_images_batch([context], [k], dataset=dataset, exact=exact)[0]
+        self.timer.stop_measurement()
+        return top_k_matches
+
+    def __retrieve_batch(self, key: Tuple[str, bool], items: List[Tuple[str, int]]) -> List[Dict[str, float]]:
+        dataset, exact = key
+        contexts, ks = zip(*items)
+        return self.retrieve_top_k_relevant_images_batch(list(contexts), list(ks), dataset=dataset, exact=exact)
+
+    def retrieve_top_k_relevant_images_batch(self,
+                                             contexts: List[str],
+                                             ks: List[int],
+                                             dataset: str,
+                                             exact: bool = False) -> List[Dict[str, float]]:
+        """
+        Retrieves the top-k relevant images of multiple contexts. The contexts are encoded in a single forward pass and
+        searched with a single FAISS (or exact) search.
+        :param contexts: the contexts
+        :param ks: the number of relevant images to return for each context
+        :param dataset: the contexts will be compared to the dataset specified by this parameter
+        :param exact: if True, the contexts are compared to every caption in the dataset. If False an approximated
+        search is done.
+        :return: a dictionary containing the top-k relevant images for each context (see
+        retrieve_top_k_relevant_images)
+        """
+        # TODO for now we only use symmetric
+        #   in later versions we want to decide this dynamically by analysing the query (embedding)
+        if len(contexts) != len(ks):
+            raise ValueError("There must be a k for every context!")
+        self.timer.start_measurement('PSS::CPS::retrieve_top_k_relevant_images_batch')
+        context_embeddings = self.__compute_context_embeddings(contexts)
+        # search once with the largest k. the top-k of the smaller ks are prefixes of the (sorted) hits
+        max_k = max(ks)
         if not exact:
             self.timer.start_measurement('PSS::CPS::retrieve_top_k_relevant_images.approx')
             if not self.faiss_index_available_for_dataset(dataset, symmetric=True):
@@ -138,12 +213,13 @@ class ContextPreselector(object):
             index = self.symmetric_indices[dataset]
 
             # Approximate Nearest Neighbor (ANN) on FAISS INV Index (Voronoi Cells)
-            # returns a matrix with distances and corpus ids.
+            # returns a matrix with distances and corpus ids (one row per query).
             index.nprobe = self.faiss_nprobe
-            distances, cids = index.search(context_embedding, k)
+            distances, cids = index.search(context_embeddings, max_k)
 
-            # We extract corpus ids and scores for the first query
-            hits = [{'corpus_id': cid, 'score': score} for cid, score in zip(cids[0], distances[0])]
+            # We extract corpus ids and scores for every query
+            batch_hits = [[{'corpus_id': cid, 'score': score} for cid, score in zip(q_cids, q_distances)]
+                          for q_cids, q_distances in zip(cids, distances)]
             self.timer.stop_measurement()
         else:
             self.timer.start_measurement('PSS::CPS::retrieve_top_k_relevant_images.exact')
@@ -155,19 +231,21 @@ class ContextPreselector(object):
 
             # Approximate Nearest Neighbor (ANN) is not exact, it might miss entries with high cosine similarity / dot p
             # --> use exact search from sbert
-            hits = util.semantic_search(context_embedding,
-                                        embs,
-                                        top_k=k)[0]
+            batch_hits = util.semantic_search(context_embeddings,
+                                              embs,
+                                              top_k=max_k)
             self.timer.stop_measurement()
 
         # sort by score
         self.timer.start_measurement('PSS::CPS::sort_scores')
-        hits = sorted(hits, key=lambda x: x['score'], reverse=True)
         # look up the document ids of the hits (the hits contain indices but we need the document id)
         corpus_ids = self.symmetric_embeddings[dataset]['corpus_ids']
-        top_k_matches = {str(corpus_ids[hit['corpus_id']]): hit['score'] for hit in hits[:k]}
+        batch_top_k_matches = []
+        for hits, k in zip(batch_hits, ks):
+            hits = sorted(hits, key=lambda x: x['score'], reverse=True)
+            batch_top_k_matches.append({str(corpus_ids[hit['corpus_id']]): hit['score'] for hit in hits[:k]})
         self.timer.stop_measurement()
 
         self.timer.stop_measurement()
         # TODO add option to return the caption texts -> load the dataset dataframes and return the caps by id
-        return top_k_matches
+        return batch_top_k_matches
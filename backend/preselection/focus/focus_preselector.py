@@ -9,6 +9,7 @@ from typing import Dict, List, Optional, Union, Tuple
 
 from backend.preselection import VisualVocab
 from backend.preselection.focus.wtf_idf import WTFIDF
+from backend.util.lazy_dict import LazyDict
 from config import conf
 
 
@@ -28,24 +29,20 @@ class FocusPreselector(object):
             cls.vocab = VisualVocab()
             pssf_conf = conf.preselection.focus
 
-            # load magnitude
-            logger.info(f"Loading Magnitude Embeddings {pssf_conf.magnitude.embeddings}!")
-            cls.magnitude = Magnitude(pssf_conf.magnitude.embeddings)
+            # magnitude and spacy (see __load_model) and the wtf-idf indices get loaded on their first use (per
+            # dataset) if lazy_init is enabled
+            cls.models = LazyDict(keys=['magnitude', 'spacy_nlp'],
+                                  load=cls.__singleton.__load_model,
+                                  name='Focus Preselector Models')
             cls.top_k_similar = pssf_conf.magnitude.top_k_similar
             cls.max_similar = pssf_conf.magnitude.max_similar
 
-            # load wtf-idf indices
-            logger.info(f"Loading WTF-IDF Indices!")
-            cls.wtf_idf = {}
-            for ds in pssf_conf.wtf_idf.keys():
-                cls.wtf_idf[ds] = WTFIDF(file=pssf_conf.wtf_idf[ds].file,
-                                         dataset=ds,
-                                         doc_id_prefix=pssf_conf.wtf_idf[ds].doc_id_prefix)
-
-            # setup spacy
-            # TODO can we disable some pipeline components to be faster? e.g. ner
-            logger.info(f"Loading spaCy model {pssf_conf.spacy_model}!")
-            cls.spacy_nlp = spacy.load(pssf_conf.spacy_model)
+            # wtf-idf indices
+            cls.wtf_idf = LazyDict(keys=pssf_conf.wtf_idf.keys(),
+                                   load=lambda ds: WTFIDF(file=pssf_conf.wtf_idf[ds].file,
+                                                          dataset=ds,
+                                                          doc_id_prefix=pssf_conf.wtf_idf[ds].doc_id_prefix),
+                                   name='WTF-IDF Indices')
 
             cls.focus_max_tokens = pssf_conf.max_tokens
             cls.focus_remove_stopwords = pssf_conf.remove_stopwords
@@ -53,12 +50,48 @@ class FocusPreselector(object):
             cls.focus_lemmatize = pssf_conf.lemmatize
             cls.focus_pos_tags = pssf_conf.pos_tags
 
-            # perform warm up (first time takes about 20s)
-            logger.info(f"Performing warmup...")
-            cls.find_top_k_similar_focus_terms(cls.__singleton, "warmup")
+            if not conf.get('lazy_init', {}).get('enabled', False):
+                logger.info(f"Loading Magnitude Embeddings, spaCy model and WTF-IDF Indices!")
+                cls.models.load_all()
+                cls.wtf_idf.load_all()
 
         return cls.__singleton
 
+    def __load_model(self, name: str):
+        pssf_conf = conf.preselection.focus
+        if name == 'magnitude':
+            logger.info(f"Loading Magnitude Embeddings {pssf_conf.magnitude.embeddings}!")
+            magnitude = Magnitude(pssf_conf.magnitude.embeddings)
+            # perform warm up (first time takes about 20s)
+            logger.info(f"Performing warmup...")
+            magnitude.similarity("warmup", self.vocab.full_vocab)
+            return magnitude
+        elif name == 'spacy_nlp':
+            # TODO can we disable some pipeline components to be faster? e.g. ner
+            logger.info(f"Loading spaCy model {pssf_conf.spacy_model}!")
+            return spacy.load(pssf_conf.spacy_model)
+        raise KeyError(name)
+
+    @property
+    def magnitude(self) -> Magnitude:
+        return self.models['magnitude']
+
+    @property
+    def spacy_nlp(self):
+        return self.models['spacy_nlp']
+
+    def load_dataset(self, dataset: str):
+        """
+        Loads the wtf-idf index of the dataset and the models (incl. the warm up).
+        """
+        self.models.load_all()
+        if dataset in self.wtf_idf:
+            self.wtf_idf[dataset]
+
+    def is_dataset_loaded(self, dataset: str) -> bool:
+        return all(self.models.is_loaded(m) for m in self.models) and \
+               (dataset not in self.wtf_idf or self.wtf_idf.is_loaded(dataset))
+
     def pre_process_focus(self, focus: str) -> List[str]:
         logger.debug(f"Preprocessing focus term: {focus}")
         focus_terms = []
@@ -6,6 +6,7 @@ from typing import Dict, List, Optional, Tuple, Union
 
 from backend.preselection import ContextPreselector
 from backend.preselection import FocusPreselector
+from backend.util.metrics import MetricsRegistry, SIZE_BUCKETS
 from backend.util.mmirs_timer import MMIRSTimer
 from config import conf
 
@@ -31,14 +32,35 @@ class PreselectionStage(object):
 
             cls.timer = MMIRSTimer()
 
+            metrics = MetricsRegistry()
+            cls.num_relevant_metric = metrics.histogram('mmirs_pss_relevant_images',
+                                                        'Number of relevant images found by the PSS',
+                                                        label_names=('dataset', 'kind'),
+                                                        buckets=SIZE_BUCKETS)
+            cls.merge_fallback_metric = metrics.counter('mmirs_pss_merge_fallbacks_total',
+                                                        'Intersections of the PSS that fell back to the union',
+                                                        label_names=('dataset',))
+
         return cls.__singleton
 
+    def load_dataset(self, dataset: str):
+        """
+        Loads the models and indices of the context and focus preselectors that are required for the dataset.
+        """
+        self.__context_preselector.load_dataset(dataset)
+        self.__focus_preselector.load_dataset(dataset)
+
+    def is_dataset_loaded(self, dataset: str) -> bool:
+        return self.__context_preselector.is_dataset_loaded(dataset) and \
+               self.__focus_preselector.is_dataset_loaded(dataset)
+
     def __merge_relevant_images(self,
                                 focus: Dict[str, float],
                                 context: Dict[str, float],
                                 max_num_relevant: int,
                                 min_num_relevant: int = 500,  # TODO do we want this?! what is a good number?
-                                merge_op: MergeOp = MergeOp.INTERSECTION) -> List[str]:
+                                merge_op: MergeOp = MergeOp.INTERSECTION,
+                                dataset: str = '') -> List[str]:
         self.timer.start_measurement('PSS::merge_relevant_images')
         logger.debug(f"Merging with {merge_op}")
 
@@ -57,6 +79,7 @@ class PreselectionStage(object):
             # union as fallback if (way) too less items got returned
             if len(merged) < min_num_relevant:
                 logger.debug(f"Too few merged images from intersection! Merging with UNION as fallback!")
+                self.merge_fallback_metric.inc(dataset=dataset)
                 merged = list(focus.keys() | context.keys())
         else:
             raise NotImplementedError(f"Merge Operation {merge_op} not implemented!")
@@ -69,7 +92,7 @@ class PreselectionStage(object):
             #  or discard context docs if more context docs are found (or vice versa for focus docs)
             #  - just take the top k//2 from context and focus !?
             random.shuffle(merged)
-            return merged[:max_num_relevant]
+            merged = merged[:max_num_relevant]
 
         self.timer.stop_measurement()
         return merged
@@ -132,7 +155,11 @@ class PreselectionStage(object):
                                               context=context_relevant,
                                               max_num_relevant=max_num_relevant,
                                               min_num_relevant=min_num_relevant,
-                                              merge_op=merge_op)
+                                              merge_op=merge_op,
+                                              dataset=dataset)
+        self.num_relevant_metric.observe(len(context_relevant), dataset=dataset, kind='context')
+        self.num_relevant_metric.observe(len(focus_relevant), dataset=dataset, kind='focus')
+        self.num_relevant_metric.observe(len(merged), dataset=dataset, kind='merged')
         self.timer.stop_measurement()
 
         return merged
@@ -0,0 +1,31 @@
+from functools import lru_cache
+from typing import FrozenSet, Tuple
+
+from config import conf
+
+
+# the available retrievers and datasets are derived from the config only, i.e., the lookups neither import nor
+# instantiate the (heavy) factories. they are cached since the API models validate every request against them.
+
+@lru_cache(maxsize=1)
+def get_available_retrievers() -> FrozenSet[str]:
+    return frozenset(conf.fine_selection.retrievers.keys())
+
+
+@lru_cache(maxsize=1)
+def get_available_image_feature_pools() -> FrozenSet[Tuple[str, str]]:
+    """
+    :return: the available (dataset, retriever name) pairs
+    """
+    pools_conf = conf.fine_selection.feature_pools
+    return frozenset((ds, ret) for ds in pools_conf.keys() for ret in pools_conf[ds].keys())
+
+
+@lru_cache(maxsize=1)
+def get_available_datasets() -> FrozenSet[str]:
+    return frozenset(ds for ds, _ in get_available_image_feature_pools())
+
+
+def dataset_is_available(dataset: str) -> bool:
+    # not cached itself since the dataset comes from the client
+    return dataset in get_available_datasets()
@@ -0,0 +1,112 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait
+from typing import Optional
+
+import torch
+import torch.multiprocessing as tmp
+from loguru import logger
+
+from config import conf
+
+
+def _init_worker(num_threads: int):
+    # pin the number of intra-op threads so that the workers do not oversubscribe the cores
+    torch.set_num_threads(num_threads)
+
+
+def _warmup():
+    return os.getpid()
+
+
+def get_num_plotting_workers() -> int:
+    """
+    :return: the number of workers of the FineSelectionStage pool that plots the annotated images and wra matrices.
+    The plotting workers and the ComputeExecutor share the cores, i.e., by default the plotting workers get a quarter
+    of the cores and the ComputeExecutor the rest.
+    """
+    return conf.fine_selection.get('max_workers', None) or max(1, os.cpu_count() // 4)
+
+
+class ComputeExecutor(object):
+    """
+    Process pool that is shared by all Retrievers to compute the distances.
+     - the workers use torch.multiprocessing so that tensors are handed off via shared memory instead of pickling
+     - the number of threads of each worker is pinned so that workers * threads does not exceed the cores that are
+       not used by the plotting workers (see get_num_plotting_workers)
+     - small inputs are computed in the calling process since the IPC would take longer than the computation
+    """
+    __singleton = None
+
+    def __new__(cls, *args, **kwargs):
+        if cls.__singleton is None:
+            logger.info("Instantiating ComputeExecutor...")
+            cls.__singleton = super(ComputeExecutor, cls).__new__(cls)
+
+            cls._conf = conf.fine_selection.get('compute_executor', {})
+
+            # the cores that are not used by the plotting workers
+            num_plotting_workers = get_num_plotting_workers()
+            num_cores = max(1, os.cpu_count() - num_plotting_workers)
+            cls.max_workers = cls._conf.get('max_workers', None) or max(1, num_cores // 4)
+            cls.threads_per_worker = cls._conf.get('threads_per_worker', None) or max(1, num_cores // cls.max_workers)
+            if cls.max_workers * cls.threads_per_worker + num_plotting_workers > os.cpu_count():
+                logger.warning(f"The ComputeExecutor ({cls.max_workers} workers * {cls.threads_per_worker} threads) "
+                               f"and the {num_plotting_workers} plotting workers oversubscribe the "
+                               f"{os.cpu_count()} cores!")
+            cls.min_pool_num_elements = cls._conf.get('min_pool_num_elements', 10_000_000)
+            cls.start_method = cls._conf.get('start_method', 'spawn')
+
+            cls.pool = None
+            cls.restart_lock = threading.Lock()
+            cls.__start_pool(cls.__singleton)
+
+        return cls.__singleton
+
+    def __start_pool(self):
+        logger.info(f"Starting ComputeExecutor pool with {self.max_workers} workers "
+                    f"and {self.threads_per_worker} threads per worker...")
+        self.pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                        mp_context=tmp.get_context(self.start_method),
+                                        initializer=_init_worker,
+                                        initargs=(self.threads_per_worker,))
+        # warm up the workers so that the first request does not pay for spawning the processes
+        wait([self.pool.submit(_warmup) for _ in range(self.max_workers)])
+
+    def get_pool(self, *tensors: torch.Tensor) -> Optional[ProcessPoolExecutor]:
+        """
+        Returns the pool if the computation on the tensors is large enough to be worth the IPC or None if it should
+        be computed in the calling process. The tensors are moved into shared memory if the pool is returned.
+        """
+        if sum(t.numel() for t in tensors) < self.min_pool_num_elements:
+            return None
+        for t in tensors:
+            self.share(t)
+        return self.pool
+
+    @staticmethod
+    def share(tensor: torch.Tensor) -> torch.Tensor:
+        """
+        Moves the (CPU) tensor into shared memory so that it is not copied when it gets handed to the workers.
+        This is a no-op if the tensor is already shared or on a GPU.
+        """
+        if not tensor.is_cuda and not tensor.is_shared():
+            tensor.share_memory_()
+        return tensor
+
+    def restart(self, broken_pool: Optional[ProcessPoolExecutor] = None):
+        """
+        Replaces the pool with a new one, e.g. after a worker crashed (BrokenProcessPool).
+        :param broken_pool: the broken pool. If the pool was already replaced (by a concurrent request), it does not
+        get restarted again.
+        """
+        with self.restart_lock:
+            if broken_pool is not None and broken_pool is not self.pool:
+                return
+            logger.warning("Restarting ComputeExecutor pool...")
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.__start_pool()
+
+    def shutdown(self):
+        logger.info(f'Shutting down ComputeExecutor!')
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,60 @@
+import asyncio
+import json
+import time
+from typing import Any, AsyncIterator, Optional, Tuple
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+# marks the end of the stream
+_CLOSED = object()
+
+
+def encode_ndjson_event(event: str, data: Any = None) -> str:
+    """
+    Encodes an event as a single line of newline delimited JSON, e.g. {"event": "top_k", "data": {"urls": [...]}}
+    """
+    return json.dumps({'event': event, 'data': data}, default=str) + '\n'
+
+
+class EventStream(object):
+    """
+    Stream of the (progress) events of a request. The events are emitted by the thread that runs the request (e.g. a
+    worker of the RequestExecutor) and consumed by the event loop that streams the response.
+    Has to be created in the event loop.
+    """
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.queue = asyncio.Queue()
+        self.created = time.perf_counter()
+
+    def emit(self, event: str, data: Any = None):
+        """
+        Emits an event. Can be called from any thread.
+        """
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (event, data))
+
+    def close(self):
+        """
+        Closes the stream after the events emitted so far. Can be called from any thread.
+        """
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, _CLOSED)
+
+    async def events(self, timeout: Optional[float] = None) -> AsyncIterator[Tuple[str, Any]]:
+        """
+        Yields the events in the order they were emitted until the stream gets closed.
+        :param timeout: the timeout of the whole stream in seconds. If exceeded, an asyncio.TimeoutError is raised.
+        """
+        deadline = self.created + timeout if timeout is not None else None
+        while True:
+            remaining = deadline - time.perf_counter() if deadline is not None else None
+            if remaining is not None and remaining <= 0:
+                raise asyncio.TimeoutError()
+            item = await asyncio.wait_for(self.queue.get(), timeout=remaining)
+            if item is _CLOSED:
+                return
+            yield item
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.created
@@ -0,0 +1,69 @@
+import threading
+import time
+from collections.abc import Mapping
+from typing import Callable, Dict, Hashable, Iterable, Iterator, List, Any
+
+from loguru import logger
+
+_MISSING = object()
+
+
+class LazyDict(Mapping):
+    """
+    Read-only dict with a fixed set of keys whose values (e.g. models or indices of a dataset) get loaded on their first
+    access. Loading is thread-safe, i.e., every value is loaded exactly once, even if concurrent requests access it.
+    Values of different keys are loaded concurrently.
+    """
+
+    def __init__(self, keys: Iterable[Hashable], load: Callable[[Hashable], Any], name: str = 'LazyDict'):
+        """
+        :param keys: the available keys
+        :param load: loads the value of a key
+        :param name: the name used in the logs
+        """
+        self.available_keys = list(keys)
+        self.load = load
+        self.name = name
+        self._values: Dict[Hashable, Any] = dict()
+        self.__key_locks: Dict[Hashable, threading.Lock] = dict()
+        self.__lock = threading.Lock()
+
+    def __getitem__(self, key: Hashable) -> Any:
+        value = self._values.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        if key not in self.available_keys:
+            raise KeyError(key)
+
+        with self.__lock:
+            key_lock = self.__key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            # another thread might have loaded the value while this thread was waiting for the lock
+            value = self._values.get(key, _MISSING)
+            if value is _MISSING:
+                logger.info(f"Loading {key} of {self.name}...")
+                start = time.time()
+                value = self.load(key)
+                self._values[key] = value
+                logger.info(f"Loaded {key} of {self.name} in {time.time() - start:.2f}s")
+        return value
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.available_keys
+
+    def __iter__(self) -> Iterator[Hashable]:
+        return iter(self.available_keys)
+
+    def __len__(self) -> int:
+        return len(self.available_keys)
+
+    def is_loaded(self, key: Hashable) -> bool:
+        return key in self._values
+
+    def loaded_keys(self) -> List[Hashable]:
+        return list(self._values.keys())
+
+    def load_all(self) -> 'LazyDict':
+        for key in self.available_keys:
+            self[key]
+        return self
@@ -0,0 +1,27 @@
+import importlib
+from typing import Any, Callable, Dict, List, Tuple
+
+
+def lazy_attributes(package: str, attributes: Dict[str, str]) -> Tuple[Callable[[str], Any], Callable[[], List[str]]]:
+    """
+    Creates the module level __getattr__ and __dir__ (PEP 562) of a package whose attributes are imported from its
+    submodules on their first access, e.g.
+        __getattr__, __dir__ = lazy_attributes(__name__, {'MMIRS': '.mmirs'})
+    Importing a (light) submodule of the package then does not import all (heavy) submodules, e.g. torch or TERAN.
+    :param package: the name of the package
+    :param attributes: attribute name -> (relative) name of the submodule that defines it
+    """
+
+    def __getattr__(name: str) -> Any:
+        module = attributes.get(name, None)
+        if module is None:
+            raise AttributeError(f"module {package!r} has no attribute {name!r}")
+        value = getattr(importlib.import_module(module, package), name)
+        # cache the attribute in the package so that __getattr__ is only called once per attribute
+        setattr(importlib.import_module(package), name, value)
+        return value
+
+    def __dir__() -> List[str]:
+        return sorted(set(vars(importlib.import_module(package)).keys()) | set(attributes.keys()))
+
+    return __getattr__, __dir__
@@ -0,0 +1,196 @@
+import bisect
+import math
+import threading
+from typing import Dict, List, Tuple, Optional, Sequence
+
+from loguru import logger
+
+from config import conf
+
+# buckets (upper bounds) of the latency histograms in seconds
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30., 60.)
+# buckets of the histograms of the number of images (e.g. candidate sets of the PSS or image search spaces)
+SIZE_BUCKETS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+def _format_labels(label_names: Sequence[str], label_values: Sequence[str], **extra: str) -> str:
+    labels = list(zip(label_names, label_values)) + list(extra.items())
+    if len(labels) == 0:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+
+class Metric(object):
+    type_name = 'untyped'
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels.keys()) != set(self.label_names):
+            raise ValueError(f"Metric {self.name} requires the labels {self.label_names} but got {list(labels.keys())}!")
+        return tuple(str(labels[n]) for n in self.label_names)
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type_name}"]
+        return '\n'.join(lines + self._samples())
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = ()):
+        super().__init__(name, description, label_names)
+        self.values: Dict[LabelValues, float] = dict()
+
+    def inc(self, value: float = 1., **labels: str):
+        lv = self._label_values(labels)
+        with self._lock:
+            self.values[lv] = self.values.get(lv, 0.) + value
+
+    def get(self, **labels: str) -> float:
+        return self.values.get(self._label_values(labels), 0.)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(self.label_names, lv)} {_format_value(v)}"
+                    for lv, v in sorted(self.values.items())]
+
+
+class Gauge(Counter):
+    type_name = 'gauge'
+
+    def set(self, value: float, **labels: str):
+        lv = self._label_values(labels)
+        with self._lock:
+            self.values[lv] = value
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name: str, description: str, label_names: Sequence[str] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # per label values: (counts per bucket (not cumulative, the last one is +Inf), sum)
+        self.values: Dict[LabelValues, Tuple[List[int], float]] = dict()
+
+    def observe(self, value: float, **labels: str):
+        lv = self._label_values(labels)
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self.values.get(lv, ([0] * (len(self.buckets) + 1), 0.))
+            counts[idx] += 1
+            self.values[lv] = (counts, total + value)
+
+    def get_count(self, **labels: str) -> int:
+        counts, _ = self.values.get(self._label_values(labels), ([0], 0.))
+        return sum(counts)
+
+    def get_quantile(self, q: float, **labels: str) -> Optional[float]:
+        """
+        Estimates the quantile by linear interpolation within the buckets (like histogram_quantile of Prometheus).
+        :return: the estimated quantile or None if there are no observations
+        """
+        counts, _ = self.values.get(self._label_values(labels), (None, 0.))
+        if counts is None or sum(counts) == 0:
+            return None
+        rank = q * sum(counts)
+        cumulative = 0
+        for i, c in enumerate(counts):
+            if cumulative + c >= rank and c > 0:
+                if i == len(self.buckets):
+                    # the quantile is in the +Inf bucket
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else 0.
+                return lower + (self.buckets[i] - lower) * (rank - cumulative) / c
+            cumulative += c
+        return self.buckets[-1]
+
+    def _samples(self) -> List[str]:
+        samples = []
+        with self._lock:
+            for lv, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for upper, c in zip(list(self.buckets) + [math.inf], counts):
+                    cumulative += c
+                    labels = _format_labels(self.label_names, lv, le=_format_value(upper))
+                    samples.append(f"{self.name}_bucket{labels} {cumulative}")
+                samples.append(f"{self.name}_sum{_format_labels(self.label_names, lv)} {_format_value(total)}")
+                samples.append(f"{self.name}_count{_format_labels(self.label_names, lv)} {cumulative}")
+        return samples
+
+
+class MetricsRegistry(object):
+    """
+    In-process registry of the metrics (latencies of the stages, candidate set sizes, cache hit rates, ...) that are
+    exposed in the Prometheus text format (see the /metrics endpoint).
+    The stage latencies are fed by the timing sessions of the MMIRSTimer (see observe_timing_session).
+    """
+    __singleton = None
+
+    def __new__(cls, *args, **kwargs):
+        if cls.__singleton is None:
+            logger.info("Instantiating MetricsRegistry...")
+            cls.__singleton = super(MetricsRegistry, cls).__new__(cls)
+
+            cls.enabled = conf.get('metrics', {}).get('enabled', False)
+            cls.metrics: Dict[str, Metric] = dict()
+            cls.registry_lock = threading.Lock()
+
+            cls.stage_duration = cls.__singleton.histogram('mmirs_stage_duration_seconds',
+                                                           'Duration of the stages (MMIRSTimer measurements)',
+                                                           label_names=('stage',))
+        return cls.__singleton
+
+    def __get_or_create(self, metric_cls, name: str, *args, **kwargs):
+        with self.registry_lock:
+            metric = self.metrics.get(name, None)
+            if metric is None:
+                metric = metric_cls(name, *args, **kwargs)
+                self.metrics[name] = metric
+            elif not isinstance(metric, metric_cls):
+                raise TypeError(f"Metric {name} is already registered as {metric.type_name}!")
+            return metric
+
+    def counter(self, name: str, description: str, label_names: Sequence[str] = ()) -> Counter:
+        return self.__get_or_create(Counter, name, description, label_names)
+
+    def gauge(self, name: str, description: str, label_names: Sequence[str] = ()) -> Gauge:
+        return self.__get_or_create(Gauge, name, description, label_names)
+
+    def histogram(self,
+                  name: str,
+                  description: str,
+                  label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self.__get_or_create(Histogram, name, description, label_names, buckets=buckets)
+
+    def observe_timing_session(self, session):
+        """
+        Observes the measurements of a (finished) TimingSession. The stage is the name of the measurement without its
+        callers, e.g. MMIRS::top_k_images>PSS::retrieve_relevant_images -> PSS::retrieve_relevant_images
+        """
+        for measurements in session.get_measurements().values():
+            for name, duration in measurements.items():
+                self.stage_duration.observe(duration, stage=name.rsplit('>', 1)[-1])
+
+    def render(self) -> str:
+        with self.registry_lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(m.render() for m in metrics) + '\n'
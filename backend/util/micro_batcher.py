@@ -0,0 +1,130 @@
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable, List, Optional, TypeVar
+
+from loguru import logger
+
+from backend.util.metrics import MetricsRegistry
+
+I = TypeVar('I')
+R = TypeVar('R')
+
+# buckets of the histogram of the batch sizes
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+class _Batch(object):
+    def __init__(self):
+        self.items: List = list()
+        self.futures: List[Future] = list()
+        self.created = time.perf_counter()
+
+
+class MicroBatcher(object):
+    """
+    Collects the items that are submitted concurrently (by the threads of concurrent requests) into batches and
+    processes each batch with a single call of the batch function, e.g. to encode the contexts of concurrent requests
+    in a single forward pass.
+    Items are only batched with items of the same key (e.g. the dataset). The first thread that submits an item for a
+    key becomes the leader of the batch: it waits until the batch is full or max_wait_ms have passed, runs the batch
+    function and fans the results out to the threads waiting for the other items of the batch.
+    To not delay requests that run alone, the leader only waits for as many items as there are concurrent callers
+    (see concurrency).
+    """
+
+    def __init__(self,
+                 name: str,
+                 batch_fn: Callable[[Hashable, List[I]], List[R]],
+                 max_batch_size: int = 16,
+                 max_wait_ms: float = 5.,
+                 concurrency: Optional[Callable[[], int]] = None):
+        """
+        :param name: the name of the batcher (used as label of the metrics)
+        :param batch_fn: the function that processes a batch. Gets the key and the items of the batch and has to return
+        the results in the order of the items.
+        :param max_batch_size: the maximum number of items of a batch
+        :param max_wait_ms: the maximum time the leader waits for further items
+        :param concurrency: returns the number of callers that may currently submit items, e.g. the number of running
+        requests. If None, the leader always waits until the batch is full or max_wait_ms have passed.
+        """
+        if max_batch_size < 1:
+            raise ValueError("The max_batch_size has to be at least 1!")
+        self.name = name
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.concurrency = concurrency
+
+        self.open_batches: Dict[Hashable, _Batch] = dict()
+        self.batches_cond = threading.Condition()
+
+        metrics = MetricsRegistry()
+        self.batch_size_metric = metrics.histogram('mmirs_batch_size',
+                                                   'Number of items processed in a single batch',
+                                                   label_names=('batcher',),
+                                                   buckets=BATCH_SIZE_BUCKETS)
+        self.batch_wait_metric = metrics.histogram('mmirs_batch_wait_seconds',
+                                                   'Time the leader waited for further items of a batch',
+                                                   label_names=('batcher',))
+
+    def __expected_batch_size(self) -> int:
+        if self.concurrency is None:
+            return self.max_batch_size
+        return max(1, min(self.max_batch_size, self.concurrency()))
+
+    def __close(self, key: Hashable, batch: _Batch):
+        # has to be called with the batches_cond lock held
+        if self.open_batches.get(key, None) is batch:
+            del self.open_batches[key]
+
+    def submit(self, key: Hashable, item: I) -> R:
+        """
+        Submits the item and blocks until the batch that contains the item was processed.
+        :param key: only items with equal keys are processed in the same batch
+        :param item: the item
+        :return: the result of the item
+        """
+        future = Future()
+        with self.batches_cond:
+            batch = self.open_batches.get(key, None)
+            is_leader = batch is None
+            if is_leader:
+                batch = _Batch()
+                self.open_batches[key] = batch
+            batch.items.append(item)
+            batch.futures.append(future)
+            if len(batch.items) >= self.max_batch_size:
+                self.__close(key, batch)
+            # wake up the leader so that it can check if the batch is complete
+            self.batches_cond.notify_all()
+
+        if is_leader:
+            self.__lead(key, batch)
+        return future.result()
+
+    def __lead(self, key: Hashable, batch: _Batch):
+        with self.batches_cond:
+            deadline = batch.created + self.max_wait
+            while len(batch.items) < self.__expected_batch_size():
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.batches_cond.wait(timeout=remaining)
+            self.__close(key, batch)
+        self.batch_wait_metric.observe(time.perf_counter() - batch.created, batcher=self.name)
+        self.batch_size_metric.observe(len(batch.items), batcher=self.name)
+
+        # the batch is closed, i.e., no further items get added
+        try:
+            results = self.batch_fn(key, batch.items)
+            if len(results) != len(batch.items):
+                raise ValueError(f"Batch function of {self.name} returned {len(results)} results "
+                                 f"for {len(batch.items)} items!")
+        except Exception as e:
+            logger.error(f"Cannot process batch of {len(batch.items)} items in {self.name}! {e}")
+            for future in batch.futures:
+                future.set_exception(e)
+            return
+        for future, result in zip(batch.futures, results):
+            future.set_result(result)
@@ -1,14 +1,28 @@
+import contextlib
+import threading
 import time
+from contextvars import ContextVar
 
 from loguru import logger
+
+from backend.util.metrics import MetricsRegistry
 # TODO these util classes require knowledge how to use and do not cover or prevent error cases
-from typing import Optional, Dict, List, Tuple
+from typing import Optional, Dict, List, Tuple, Callable, TypeVar
+
+T = TypeVar('T')
 
 
 class TimingSession(object):
-    def __init__(self):
+    def __init__(self, root_name: Optional[str] = None, root_level: int = 0):
+        """
+        :param root_name: name of the measurement the measurements of this session are nested in (see MMIRSTimer.bind)
+        :param root_level: level of the root measurement
+        """
+        self.root_name = root_name
+        self.root_level = root_level
         self.measurements: Dict[int, Dict[str, float]] = dict()
         self.measurements_stack: List[Tuple[str, float]] = list()
+        self.__merge_lock = threading.Lock()
 
     def start_timing_measurement(self, name) -> None:
         if len(self.measurements_stack) != 0 and name == self.measurements_stack[-1][0]:
@@ -16,18 +30,18 @@ class TimingSession(object):
             raise KeyError(f"Timing with name {name} already started!")
 
         # push name and start time
-        if len(self.measurements_stack) > 0:
-            caller = self.measurements_stack[-1][0]
-            self.measurements_stack.append((f"{caller}>{name}", time.time()))
+        caller = self.get_current_measurement_name()
+        if caller is not None:
+            self.measurements_stack.append((f"{caller}>{name}", time.perf_counter()))
         else:
-            self.measurements_stack.append((name, time.time()))
+            self.measurements_stack.append((name, time.perf_counter()))
 
     def stop_timing_measurement(self) -> float:
         # pop name and start time
-        current_level = len(self.measurements_stack)
+        current_level = self.root_level + len(self.measurements_stack)
         name, start = self.measurements_stack.pop()
         # stop time
-        stop = time.time() - start
+        stop = time.perf_counter() - start
         # save in measurements dict
         if current_level not in self.measurements:
             self.measurements[current_level] = dict()
@@ -35,11 +49,36 @@ class TimingSession(object):
 
         return stop
 
+    def get_current_measurement_name(self) -> Optional[str]:
+        if len(self.measurements_stack) > 0:
+            return self.measurements_stack[-1][0]
+        return self.root_name
+
+    def get_current_level(self) -> int:
+        return self.root_level + len(self.measurements_stack)
+
+    def merge(self, other: 'TimingSession'):
+        """
+        Merges the measurements of a (child) session into this session.
+        """
+        with self.__merge_lock:
+            for level, measurements in other.measurements.items():
+                self.measurements.setdefault(level, dict()).update(measurements)
+
     def get_measurements(self) -> Dict[int, Dict[str, float]]:
         return {k: v for k, v in sorted(self.measurements.items(), key=lambda i: i[0], reverse=False)}
 
 
+# the timing session of the current request. Every thread (and every asyncio task) has its own context, i.e., the
+# timing sessions of concurrent requests do not interfere. If there is no session, measuring is a no-op.
+_current_timing_session = ContextVar('timing_session', default=None)  # type: ContextVar[Optional[TimingSession]]
+
+
 class MMIRSTimer(object):
+    """
+    Measures the timings of a request. The timing session is request-scoped (see _current_timing_session), i.e., the
+    timer only measures if a session was started in the current context (see start_new_timing_session).
+    """
     __singleton = None
 
     def __new__(cls, *args, **kwargs):
@@ -47,25 +86,94 @@ class MMIRSTimer(object):
             logger.info("Instantiating MMIRSTimer ...")
             cls.__singleton = super(MMIRSTimer, cls).__new__(cls)
 
-            cls.current_timing_session: Optional[TimingSession] = None
-
         return cls.__singleton
 
+    @property
+    def current_timing_session(self) -> Optional[TimingSession]:
+        return _current_timing_session.get()
+
     def start_new_timing_session(self) -> TimingSession:
-        self.current_timing_session = TimingSession()
+        session = TimingSession()
+        _current_timing_session.set(session)
         logger.debug(f"Starting new TimingSession!")
-        return self.current_timing_session
+        return session
+
+    def end_timing_session(self) -> Optional[TimingSession]:
+        """
+        Ends the timing session of the current context. Its measurements are fed into the MetricsRegistry.
+        """
+        session = _current_timing_session.get()
+        _current_timing_session.set(None)
+        if session is not None:
+            MetricsRegistry().observe_timing_session(session)
+        return session
+
+    @contextlib.contextmanager
+    def timing_session(self, enabled: bool = True):
+        """
+        Runs the enclosed block (i.e. a request) in a new timing session. If not enabled, nothing gets measured and
+        the session is None.
+        """
+        if not enabled:
+            yield None
+            return
+        session = self.start_new_timing_session()
+        try:
+            yield session
+        finally:
+            self.end_timing_session()
 
     def start_measurement(self, name):
-        if self.current_timing_session is None:
-            self.start_new_timing_session()
-        self.current_timing_session.start_timing_measurement(name)
-
-    def stop_measurement(self):
-        if self.current_timing_session is None:
-            logger.error(f"TimingSession did not start yet!")
-            raise KeyError(f"TimingSession did not start yet!")
-        self.current_timing_session.stop_timing_measurement()
-
-    def get_current_timing_session(self) -> TimingSession:
-        return self.current_timing_session
+        session = _current_timing_session.get()
+        if session is not None:
+            session.start_timing_measurement(name)
+
+    def stop_measurement(self) -> float:
+        session = _current_timing_session.get()
+        if session is None:
+            return 0.
+        return session.stop_timing_measurement()
+
+    @contextlib.contextmanager
+    def measure(self, name: str):
+        """
+        Measures the enclosed block. Can also be used as decorator, e.g.
+            with timer.measure("PSS::retrieve_relevant_images"):
+                ...
+            @timer.measure("PSS::retrieve_relevant_images")
+            def retrieve_relevant_images(...):
+        """
+        session = _current_timing_session.get()
+        if session is None:
+            yield
+            return
+        session.start_timing_measurement(name)
+        try:
+            yield
+        finally:
+            session.stop_timing_measurement()
+
+    def bind(self, fn: Callable[..., T]) -> Callable[..., T]:
+        """
+        Binds the function to the timing session of the current context so that it can be run in another thread
+        (e.g. to run the branches of a stage in parallel). The function gets its own (child) session whose measurements
+        are nested in the current measurement and merged into the current session when the function returns.
+        """
+        parent = _current_timing_session.get()
+        if parent is None:
+            return fn
+        root_name, root_level = parent.get_current_measurement_name(), parent.get_current_level()
+
+        def run_with_child_session(*args, **kwargs) -> T:
+            child = TimingSession(root_name=root_name, root_level=root_level)
+            token = _current_timing_session.set(child)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _current_timing_session.reset(token)
+                parent.merge(child)
+
+        return run_with_child_session
+
+    def get_current_timing_session(self) -> Optional[TimingSession]:
+        return _current_timing_session.get()
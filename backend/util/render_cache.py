@@ -0,0 +1,161 @@
+import hashlib
+import os
+import threading
+from typing import List, Tuple, Optional
+
+import numpy as np
+from loguru import logger
+
+from backend.util.metrics import MetricsRegistry
+
+
+class RenderCache(object):
+    """
+    Content-addressed cache of rendered artifacts (annotated images, WRA plots) in a directory.
+     - the file names contain a hash of everything that influences the rendering, so a cached file never gets
+       overwritten by a rendering with different inputs (e.g. another focus text for the same image)
+     - files are written atomically, i.e., rendered into a temporary file which then gets renamed
+     - if the files exceed the disk budget, the least recently used files (by mtime) get evicted
+    """
+
+    def __init__(self,
+                 cache_dir: str,
+                 max_size_mb: float = 2048,
+                 low_watermark: float = 0.9,
+                 name: Optional[str] = None):
+        """
+        :param cache_dir: the directory containing the cached files
+        :param max_size_mb: the disk budget of the cache in MB
+        :param low_watermark: fraction of the disk budget the cache gets reduced to when evicting
+        :param name: the name of the cache in the metrics. Defaults to the name of the cache directory.
+        """
+        self.cache_dir = cache_dir
+        self.name = name if name is not None else os.path.basename(os.path.normpath(cache_dir))
+        if not (os.path.lexists(self.cache_dir) and os.path.isdir(self.cache_dir)):
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+            except:
+                raise FileNotFoundError(f"Cannot read RenderCache directory at {self.cache_dir}!")
+
+        self.max_size_bytes = int(max_size_mb * 1024 ** 2)
+        self.low_watermark = low_watermark
+        self.__lock = threading.Lock()
+
+        metrics = MetricsRegistry()
+        self.__lookups_metric = metrics.counter('mmirs_render_cache_lookups_total',
+                                                'Lookups of the render caches',
+                                                label_names=('cache', 'result'))
+        self.__evictions_metric = metrics.counter('mmirs_render_cache_evictions_total',
+                                                  'Files evicted from the render caches',
+                                                  label_names=('cache',))
+        self.__size_metric = metrics.gauge('mmirs_render_cache_size_bytes',
+                                           'Size of the render caches',
+                                           label_names=('cache',))
+
+        self.__size_bytes = sum(size for _, _, size in self.__scan())
+        self.evict()
+
+    @staticmethod
+    def compute_key(*parts) -> str:
+        """
+        Computes the hash of the parts, i.e., the inputs of the rendering. Numpy arrays are hashed by their data.
+        """
+        h = hashlib.sha1()
+        for p in parts:
+            if isinstance(p, np.ndarray):
+                h.update(str(p.shape).encode('utf-8'))
+                h.update(np.ascontiguousarray(p).tobytes())
+            else:
+                h.update(repr(p).encode('utf-8'))
+            h.update(b'\x1f')
+        return h.hexdigest()[:16]
+
+    def get_path(self, image_id: str, kind: str, key: str, ext: str) -> str:
+        return os.path.join(self.cache_dir, f"{image_id}_{kind}_{key}.{ext}")
+
+    @staticmethod
+    def get_tmp_path(dst: str) -> str:
+        # hidden and unique per process so that concurrent renderings of the same file do not interfere
+        return os.path.join(os.path.dirname(dst), f".{os.path.basename(dst)}.{os.getpid()}.tmp")
+
+    def lookup(self, path: str) -> bool:
+        """
+        :return: true if the file is cached. The file gets marked as recently used.
+        """
+        try:
+            os.utime(path)
+            self.__lookups_metric.inc(cache=self.name, result='hit')
+            return True
+        except FileNotFoundError:
+            self.__lookups_metric.inc(cache=self.name, result='miss')
+            return False
+
+    def add(self, path: str):
+        """
+        Adds a freshly rendered file to the cache and evicts old files if the cache exceeds the disk budget.
+        """
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return
+        with self.__lock:
+            self.__size_bytes += size
+            if self.__size_bytes > self.max_size_bytes:
+                self.__evict()
+            self.__size_metric.set(self.__size_bytes, cache=self.name)
+
+    def evict(self) -> int:
+        """
+        Evicts the least recently used files until the cache fits into the disk budget.
+        :return: the number of evicted files
+        """
+        with self.__lock:
+            return self.__evict()
+
+    def __scan(self) -> List[Tuple[str, float, int]]:
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for e in it:
+                # skip temporary files that are still being written
+                if e.name.startswith('.') or not e.is_file():
+                    continue
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((e.path, st.st_mtime, st.st_size))
+        return entries
+
+    def __evict(self) -> int:
+        entries = self.__scan()
+        size = sum(s for _, _, s in entries)
+        if size <= self.max_size_bytes:
+            self.__size_bytes = size
+            self.__size_metric.set(size, cache=self.name)
+            return 0
+
+        target = self.max_size_bytes * self.low_watermark
+        num_evicted = 0
+        for path, _, s in sorted(entries, key=lambda e: e[1]):
+            if size <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= s
+            num_evicted += 1
+        self.__size_bytes = size
+        self.__size_metric.set(size, cache=self.name)
+        self.__evictions_metric.inc(num_evicted, cache=self.name)
+        logger.info(f"Evicted {num_evicted} files from RenderCache at {self.cache_dir}!")
+        return num_evicted
+
+    @property
+    def size_bytes(self) -> int:
+        return self.__size_bytes
+
+    def __repr__(self):
+        return (f"RenderCache(cache_dir={self.cache_dir},"
+                f" size={self.__size_bytes / 1024 ** 2:.1f}MB,"
+                f" max_size={self.max_size_bytes / 1024 ** 2:.1f}MB)")
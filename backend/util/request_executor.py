@@ -0,0 +1,86 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from functools import partial
+from typing import Callable, TypeVar, Optional
+
+from loguru import logger
+
+from config import conf
+
+T = TypeVar('T')
+
+
+class RequestRejectedError(Exception):
+    """
+    Raised if a request cannot be admitted since too many requests are already running or queued.
+    """
+    pass
+
+
+class RequestExecutor(object):
+    """
+    Bounded executor that runs the (blocking) MMIRS calls of the API handlers off the event loop.
+     - at most max_workers requests run concurrently, at most max_queue_size requests wait for a worker
+     - requests that exceed the queue are rejected immediately (see RequestRejectedError)
+     - requests that do not finish within the timeout raise an asyncio.TimeoutError. Queued requests get cancelled,
+       running requests cannot be interrupted but occupy their worker until they are finished.
+    """
+    __singleton = None
+
+    def __new__(cls, *args, **kwargs):
+        if cls.__singleton is None:
+            logger.info("Instantiating RequestExecutor...")
+            cls.__singleton = super(RequestExecutor, cls).__new__(cls)
+
+            cls._conf = conf.api.get('request_executor', {})
+            cls.max_workers = cls._conf.get('max_workers', 1)
+            cls.max_queue_size = cls._conf.get('max_queue_size', 8)
+            cls.timeout = cls._conf.get('timeout', 60)
+
+            cls.executor = ThreadPoolExecutor(max_workers=cls.max_workers, thread_name_prefix='mmirs_request')
+            cls.num_admitted = 0
+            cls.admission_lock = threading.Lock()
+
+        return cls.__singleton
+
+    def __release(self, _: Future):
+        with self.admission_lock:
+            self.num_admitted -= 1
+
+    def submit(self, fn: Callable[..., T], *args, **kwargs) -> Future:
+        """
+        Admits and submits the request or raises a RequestRejectedError if the executor is full.
+        """
+        with self.admission_lock:
+            if self.num_admitted >= self.max_workers + self.max_queue_size:
+                raise RequestRejectedError(f"Too many requests! {self.num_admitted} requests are running or queued.")
+            self.num_admitted += 1
+        try:
+            # every request runs in a copy of the caller's context so that context variables (e.g. the timing session)
+            # set by one request do not leak into the next request of the same worker thread
+            future = self.executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+        except:
+            self.__release(None)
+            raise
+        # called when the request finished or got cancelled while it was queued
+        future.add_done_callback(self.__release)
+        return future
+
+    async def run(self, fn: Callable[..., T], *args, timeout: Optional[float] = None, **kwargs) -> T:
+        """
+        Runs the (blocking) function in the executor and awaits its result without blocking the event loop.
+        :param timeout: the timeout in seconds. If None, the timeout of the config is used.
+        """
+        future = self.submit(partial(fn, *args, **kwargs))
+        # cancelling the asyncio future (e.g. on timeout) also cancels the future of the executor if it is queued
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout=timeout or self.timeout)
+
+    @property
+    def num_pending(self) -> int:
+        return self.num_admitted
+
+    def shutdown(self):
+        logger.info(f'Shutting down RequestExecutor!')
+        self.executor.shutdown(wait=False, cancel_futures=True)
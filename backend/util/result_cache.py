@@ -0,0 +1,247 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from loguru import logger
+
+from backend.util.metrics import MetricsRegistry
+from config import conf
+
+RESULT_CACHE_BACKENDS = ('memory', 'sqlite')
+# the name of the response header that tells if the response was served from the cache (HIT, MISS or BYPASS)
+CACHE_STATUS_HEADER = 'X-MMIRS-Cache'
+
+# (media type, body) of a cached response
+CachedResult = Tuple[str, bytes]
+
+# the file in a data directory that gets touched when the data in the directory is rebuilt in place
+DATA_VERSION_MARKER = 'VERSION'
+
+
+def _stat_data_path(path: Optional[str]) -> str:
+    """
+    :return: the size and modification time of the file or, if the path is a directory (e.g. the feature pool with one
+    file per image), the modification time of the directory and of its DATA_VERSION_MARKER file. The files in the
+    directory are not scanned since there are too many. Hence, data that gets rebuilt in place (without adding, removing
+    or renaming files) has to touch the marker to invalidate the results.
+    """
+    if path is None:
+        return 'none'
+    path = str(path)
+    try:
+        st = os.stat(path)
+        version = f"{path}:{st.st_size}:{st.st_mtime_ns}"
+        if os.path.isdir(path):
+            marker_path = os.path.join(path, DATA_VERSION_MARKER)
+            if os.path.isfile(marker_path):
+                version += f":{os.stat(marker_path).st_mtime_ns}"
+        return version
+    except OSError:
+        return f"{path}:missing"
+
+
+class _MemoryStore(object):
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        # key -> (created, media type, body). ordered by the last access
+        self.entries: 'OrderedDict[str, Tuple[float, str, bytes]]' = OrderedDict()
+
+    def get(self, key: str) -> Optional[Tuple[float, str, bytes]]:
+        entry = self.entries.get(key, None)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, created: float, media_type: str, body: bytes) -> int:
+        self.entries[key] = (created, media_type, body)
+        self.entries.move_to_end(key)
+        num_evicted = 0
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            num_evicted += 1
+        return num_evicted
+
+    def delete(self, key: str):
+        self.entries.pop(key, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class _SqliteStore(object):
+    def __init__(self, path: str, max_entries: int):
+        self.max_entries = max_entries
+        if os.path.dirname(path) != '':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # the store is guarded by the lock of the ResultCache, so the connection can be shared by the threads
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS results '
+                        '(key TEXT PRIMARY KEY, created REAL, accessed REAL, media_type TEXT, body BLOB)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)')
+        self.db.commit()
+
+    def get(self, key: str) -> Optional[Tuple[float, str, bytes]]:
+        row = self.db.execute('SELECT created, media_type, body FROM results WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            self.db.execute('UPDATE results SET accessed = ? WHERE key = ?', (time.time(), key))
+            self.db.commit()
+            return row[0], row[1], bytes(row[2])
+        return None
+
+    def put(self, key: str, created: float, media_type: str, body: bytes) -> int:
+        self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                        (key, created, created, media_type, sqlite3.Binary(body)))
+        # evict the least recently used results
+        num_evicted = self.db.execute('DELETE FROM results WHERE key IN '
+                                      '(SELECT key FROM results ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+                                      (self.max_entries,)).rowcount
+        self.db.commit()
+        return num_evicted
+
+    def delete(self, key: str):
+        self.db.execute('DELETE FROM results WHERE key = ?', (key,))
+        self.db.commit()
+
+    def clear(self):
+        self.db.execute('DELETE FROM results')
+        self.db.commit()
+
+    def __len__(self) -> int:
+        return self.db.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+
+
+class ResultCache(object):
+    """
+    Cache of the (serialized) responses of retrieval requests, e.g. for repeated queries in user studies, demos or
+    evaluation runs.
+     - the key is a hash of the canonical request parameters and the version of the data the result depends on, i.e.,
+       rebuilt FAISS indices, sentence embeddings, feature pools, models or changed PSS settings invalidate the results
+       (see get_data_version)
+     - results expire after the TTL, the least recently used results get evicted if there are more than max_entries
+     - results are kept in memory or persisted in a SQLite database
+    """
+    __singleton = None
+
+    def __new__(cls, *args, **kwargs):
+        if cls.__singleton is None:
+            logger.info("Instantiating ResultCache...")
+            cls.__singleton = super(ResultCache, cls).__new__(cls)
+
+            cls._conf = conf.api.get('result_cache', {})
+            cls.enabled = cls._conf.get('enabled', False)
+            cls.ttl = cls._conf.get('ttl', 3600)
+            cls.max_entries = cls._conf.get('max_entries', 10000)
+            # seconds after which the data versions are re-checked
+            cls.version_check_interval = cls._conf.get('version_check_interval', 60)
+
+            backend = cls._conf.get('backend', 'memory')
+            if backend == 'memory':
+                cls.store = _MemoryStore(max_entries=cls.max_entries)
+            elif backend == 'sqlite':
+                cls.store = _SqliteStore(path=cls._conf.get('sqlite_path', 'cache/result_cache.sqlite'),
+                                         max_entries=cls.max_entries)
+            else:
+                raise NotImplementedError(f"ResultCache backend {backend} is not available! "
+                                          f"Use one of {RESULT_CACHE_BACKENDS}")
+            cls.store_lock = threading.Lock()
+
+            # (dataset, retriever) -> (time of the check, version)
+            cls.data_versions: Dict[Tuple[str, str], Tuple[float, str]] = dict()
+            # only one thread re-checks the versions, the others keep using the current versions in the meantime
+            cls.version_lock = threading.Lock()
+
+            metrics = MetricsRegistry()
+            cls.lookups_metric = metrics.counter('mmirs_result_cache_lookups_total',
+                                                 'Lookups of the result cache',
+                                                 label_names=('result',))
+            cls.evictions_metric = metrics.counter('mmirs_result_cache_evictions_total',
+                                                   'Results evicted from the result cache')
+
+        return cls.__singleton
+
+    def get_data_version(self, dataset: str, retriever: str) -> str:
+        """
+        Computes the version of the data the results of the dataset and retriever depend on from the (size and
+        modification time of the files of the) FAISS index, the sentence embeddings, the feature pool, the model and the
+        settings of the PSS. The versions are re-checked every version_check_interval seconds. While a thread re-checks
+        the versions, the other threads use the current versions.
+        """
+        checked, version = self.data_versions.get((dataset, retriever), (0., None))
+        if version is not None and time.time() - checked < self.version_check_interval:
+            return version
+
+        # only block if there is no version yet
+        if not self.version_lock.acquire(blocking=version is None):
+            return version
+        try:
+            return self.__check_data_version(dataset, retriever)
+        finally:
+            self.version_lock.release()
+
+    def __check_data_version(self, dataset: str, retriever: str) -> str:
+        checked, version = self.data_versions.get((dataset, retriever), (0., None))
+        now = time.time()
+        # the version might have been checked while waiting for the lock
+        if version is not None and now - checked < self.version_check_interval:
+            return version
+
+        pssc_conf = conf.preselection.context
+        pool_conf = conf.fine_selection.feature_pools.get(dataset, {}).get(retriever, {})
+        retriever_conf = conf.fine_selection.retrievers.get(retriever, {})
+        parts = [_stat_data_path(pssc_conf.faiss.symmetric_indices.get(dataset, None)),
+                 _stat_data_path(pssc_conf.sbert.symmetric_embeddings.get(dataset, None)),
+                 _stat_data_path(pool_conf.get('feats_root', None)),
+                 _stat_data_path(retriever_conf.get('model', None)),
+                 repr(conf.mmirs.pss)]
+        version = hashlib.sha1('\x1f'.join(parts).encode('utf-8')).hexdigest()[:16]
+        self.data_versions[(dataset, retriever)] = (now, version)
+        return version
+
+    def compute_key(self, namespace: str, params: Dict[str, Any], dataset: str, retriever: str) -> str:
+        """
+        Computes the key of a request.
+        :param namespace: the kind of the request, e.g. the endpoint
+        :param params: the parameters of the request that influence the result. They have to be JSON serializable.
+        :param dataset: the dataset of the request
+        :param retriever: the retriever of the request
+        """
+        canonical = json.dumps({'namespace': namespace,
+                                'params': params,
+                                'version': self.get_data_version(dataset, retriever)},
+                               sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[CachedResult]:
+        with self.store_lock:
+            entry = self.store.get(key)
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                self.store.delete(key)
+                entry = None
+        self.lookups_metric.inc(result='hit' if entry is not None else 'miss')
+        if entry is None:
+            return None
+        return entry[1], entry[2]
+
+    def put(self, key: str, media_type: str, body: bytes):
+        with self.store_lock:
+            num_evicted = self.store.put(key, time.time(), media_type, body)
+        if num_evicted > 0:
+            self.evictions_metric.inc(num_evicted)
+
+    def clear(self):
+        with self.store_lock:
+            self.store.clear()
+        logger.info("Cleared the ResultCache!")
+
+    def __len__(self) -> int:
+        with self.store_lock:
+            return len(self.store)
@@ -0,0 +1,120 @@
+import glob
+import json
+import os
+import re
+import time
+from typing import Dict, List, Optional, Set
+
+import pandas as pd
+from loguru import logger
+from pandas import DataFrame
+
+_PART_PATTERN = re.compile(r'^part-(\d+)-(\d+)\.parquet$')
+
+
+class ShardResultsWriter(object):
+    """
+    Appends the results of an evaluation shard incrementally to a directory of parquet part files (one row group per
+    part), so that persisting the results does not rewrite all previous results. Every part is written atomically and
+    doubles as the checkpoint of the shard, i.e., a crashed run resumes by skipping the samples of its existing parts.
+    """
+
+    def __init__(self, parts_dir: str, shard_id: int = 0, persist_step: int = 100):
+        """
+        :param parts_dir: the directory of the part files of all shards
+        :param shard_id: the id of the shard. The shards of a run share the parts directory.
+        :param persist_step: number of results that are buffered before they get written to a new part
+        """
+        self.parts_dir = parts_dir
+        self.shard_id = shard_id
+        self.persist_step = max(1, persist_step)
+        os.makedirs(self.parts_dir, exist_ok=True)
+
+        self.buffer: List[Dict] = []
+        parts = self.get_part_files(self.parts_dir, shard_id=self.shard_id)
+        self.next_seq = max([self.__parse_part_file(p)[1] for p in parts], default=-1) + 1
+        self.done_indices: Set[int] = set()
+        for p in parts:
+            self.done_indices.update(pd.read_parquet(p, columns=['idx'])['idx'].tolist())
+        if len(self.done_indices) > 0:
+            logger.info(f"Resuming shard {self.shard_id} with {len(self.done_indices)} finished samples")
+
+        self.num_written = 0
+        self.start = time.time()
+
+    @staticmethod
+    def __parse_part_file(path: str):
+        m = _PART_PATTERN.match(os.path.basename(path))
+        return int(m.group(1)), int(m.group(2))
+
+    @staticmethod
+    def get_part_files(parts_dir: str, shard_id: Optional[int] = None) -> List[str]:
+        """
+        :return: the part files of the shard (or of all shards) in the order they were written
+        """
+        parts = [p for p in glob.glob(os.path.join(parts_dir, 'part-*.parquet'))
+                 if _PART_PATTERN.match(os.path.basename(p))]
+        if shard_id is not None:
+            parts = [p for p in parts if ShardResultsWriter.__parse_part_file(p)[0] == shard_id]
+        return sorted(parts, key=ShardResultsWriter.__parse_part_file)
+
+    def is_done(self, idx: int) -> bool:
+        return idx in self.done_indices
+
+    def append(self, idx: int, top_k: List[str]):
+        self.buffer.append({'idx': idx, 'top_k': top_k})
+        if len(self.buffer) >= self.persist_step:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        part = os.path.join(self.parts_dir, f"part-{self.shard_id:03d}-{self.next_seq:06d}.parquet")
+        # write to a temporary file first so that a crash never leaves a partially written part behind
+        tmp = part + '.tmp'
+        DataFrame(self.buffer).to_parquet(tmp, index=False)
+        os.replace(tmp, part)
+
+        self.done_indices.update(r['idx'] for r in self.buffer)
+        self.num_written += len(self.buffer)
+        self.next_seq += 1
+        self.buffer = []
+        self.__write_checkpoint()
+        logger.info(f"Shard {self.shard_id}: {len(self.done_indices)} samples done "
+                    f"({self.samples_per_sec:.2f} samples/sec)")
+
+    @property
+    def samples_per_sec(self) -> float:
+        elapsed = time.time() - self.start
+        return self.num_written / elapsed if elapsed > 0 else 0.
+
+    def __write_checkpoint(self):
+        checkpoint = os.path.join(self.parts_dir, f"shard-{self.shard_id:03d}.json")
+        tmp = checkpoint + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'shard_id': self.shard_id,
+                       'num_done': len(self.done_indices),
+                       'num_parts': self.next_seq,
+                       'samples_per_sec': self.samples_per_sec,
+                       'updated_at': time.time()}, f)
+        os.replace(tmp, checkpoint)
+
+    def close(self):
+        self.flush()
+
+    @staticmethod
+    def merge(parts_dir: str, df: DataFrame) -> DataFrame:
+        """
+        Merges the parts of all shards with the samples of the dataset.
+        :param parts_dir: the directory of the part files
+        :param df: the dataset. The idx column of the parts refers to the positions of its rows.
+        :return: the samples that have results with their top_k column in the order of the dataset
+        """
+        parts = ShardResultsWriter.get_part_files(parts_dir)
+        if len(parts) == 0:
+            return df[:0].assign(top_k=[])
+        results = pd.concat([pd.read_parquet(p) for p in parts], ignore_index=True)
+        results = results.drop_duplicates(subset='idx', keep='last').sort_values('idx')
+        merged = df.iloc[results['idx'].tolist()].reset_index(drop=True)
+        merged['top_k'] = [list(top_k) for top_k in results['top_k']]
+        return merged
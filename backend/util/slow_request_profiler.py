@@ -0,0 +1,136 @@
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Optional, Any
+
+from loguru import logger
+
+from config import conf
+
+
+class _ProfiledRequest(object):
+    def __init__(self, name: str, params: Dict[str, Any], thread_id: int):
+        self.name = name
+        self.params = params
+        self.thread_id = thread_id
+        self.start = time.perf_counter()
+        self.started_at = datetime.now()
+        # collapsed stacks (root;...;leaf) -> number of samples
+        self.samples: Counter = Counter()
+
+
+def _collapse_stack(frame) -> str:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(stack))
+
+
+class SlowRequestProfiler(object):
+    """
+    Sampling profiler for slow requests. A watchdog thread samples the stacks of the threads that run the requests
+    at a low rate from the start of the requests, so that the profile of a slow request also covers the stages before
+    it exceeded the latency threshold (e.g. the PSS). Once a request that exceeded the threshold finishes, its samples
+    are written as collapsed stacks (e.g. for flamegraph.pl or speedscope) together with the request parameters to the
+    profiles directory. The samples of requests that finish before the threshold are discarded.
+    Without running requests, the watchdog sleeps until the next request gets registered.
+    """
+    __singleton = None
+
+    def __new__(cls, *args, **kwargs):
+        if cls.__singleton is None:
+            logger.info("Instantiating SlowRequestProfiler...")
+            cls.__singleton = super(SlowRequestProfiler, cls).__new__(cls)
+
+            cls._conf = conf.get('profiling', {})
+            cls.enabled = cls._conf.get('enabled', False)
+            cls.threshold = cls._conf.get('slow_request_threshold', 2.)
+            cls.sampling_interval = cls._conf.get('sampling_interval', 0.01)
+            cls.profiles_dir = cls._conf.get('profiles_dir', 'logs/profiles')
+
+            cls.active_requests: Dict[int, _ProfiledRequest] = dict()
+            cls.active_requests_lock = threading.Lock()
+            # set while there are active requests
+            cls.has_active_requests = threading.Event()
+            cls.watchdog = None
+            if cls.enabled:
+                cls.__singleton.start_watchdog()
+
+        return cls.__singleton
+
+    def start_watchdog(self):
+        if self.watchdog is not None and self.watchdog.is_alive():
+            return
+        self.watchdog = threading.Thread(target=self.__watch, name='slow_request_profiler', daemon=True)
+        self.watchdog.start()
+
+    def __watch(self):
+        while True:
+            with self.active_requests_lock:
+                active = list(self.active_requests.values())
+                if len(active) == 0:
+                    self.has_active_requests.clear()
+            if len(active) == 0:
+                self.has_active_requests.wait()
+                continue
+
+            frames = sys._current_frames()
+            for r in active:
+                frame = frames.get(r.thread_id, None)
+                if frame is not None:
+                    r.samples[_collapse_stack(frame)] += 1
+            del frames
+            time.sleep(self.sampling_interval)
+
+    @contextlib.contextmanager
+    def profile(self, name: str, params: Optional[Dict[str, Any]] = None):
+        """
+        Profiles the enclosed block (i.e. a request). The profile is only persisted if it exceeds the latency threshold.
+        :param name: the name of the request, e.g. the endpoint
+        :param params: the parameters of the request that get stored with the profile
+        """
+        if not self.enabled:
+            yield
+            return
+
+        thread_id = threading.get_ident()
+        req = _ProfiledRequest(name=name, params=params if params is not None else {}, thread_id=thread_id)
+        with self.active_requests_lock:
+            self.active_requests[thread_id] = req
+            self.has_active_requests.set()
+        try:
+            yield
+        finally:
+            with self.active_requests_lock:
+                del self.active_requests[thread_id]
+            duration = time.perf_counter() - req.start
+            if duration >= self.threshold:
+                try:
+                    self.__persist_profile(req, duration)
+                except Exception as e:
+                    logger.error(f"Cannot persist profile of slow request {name}! {e}")
+
+    def __persist_profile(self, req: _ProfiledRequest, duration: float) -> str:
+        os.makedirs(self.profiles_dir, exist_ok=True)
+        fn = os.path.join(self.profiles_dir, f"{req.started_at.strftime('%Y-%m-%d_%H-%M-%S-%f')}_{req.name}")
+        with open(fn + '.collapsed', 'w') as f:
+            for stack, count in req.samples.most_common():
+                f.write(f"{stack} {count}\n")
+        with open(fn + '.json', 'w') as f:
+            json.dump({'name': req.name,
+                       'started_at': req.started_at.isoformat(),
+                       'duration': duration,
+                       'threshold': self.threshold,
+                       'sampling_interval': self.sampling_interval,
+                       'num_samples': sum(req.samples.values()),
+                       'params': req.params}, f, indent=2, default=str)
+        logger.warning(f"Request {req.name} took {duration:.3f}s! Persisted profile with "
+                       f"{sum(req.samples.values())} samples at {fn}.collapsed")
+        return fn
@@ -0,0 +1,51 @@
+import io
+import json
+from typing import List, Dict, Tuple, Optional, Union
+
+import numpy as np
+
+
+def encode_wra_payload(image_urls: List[str],
+                       wra_matrices: np.ndarray,
+                       context_tokens: List[str],
+                       focus_span: Tuple[int, int],
+                       max_focus_region_indices: List[int],
+                       timings: Optional[Dict] = None) -> bytes:
+    """
+    Encodes the top-k wra matrices (and everything that is required to interpret them) as an uncompressed npz archive.
+    The archive can be read with np.load (see decode_wra_payload). The wra matrices are stored as float16.
+    :param image_urls: the URLs of the top-k images
+    :param wra_matrices: the wra matrices of the top-k images with shape (k, num_regions, num_tokens)
+    :param context_tokens: the tokens of the context (the columns of the wra matrices)
+    :param focus_span: the (inclusive) span of the focus in the context tokens
+    :param max_focus_region_indices: the index of the max focus region (the row in the wra matrix) of every image
+    :param timings: optional timings of the request
+    :return: the bytes of the npz archive
+    """
+    wra_matrices = np.asarray(wra_matrices, dtype=np.float16)
+    arrays = dict(image_urls=np.array(image_urls, dtype=str),
+                  wra=wra_matrices,
+                  # FIXME LAST TOKEN MISSING (see plot_wra), i.e., only the tokens that have a column in the wras
+                  context_tokens=np.array(context_tokens[:wra_matrices.shape[-1]], dtype=str),
+                  focus_span=np.array(focus_span, dtype=np.int32),
+                  max_focus_region_indices=np.array(max_focus_region_indices, dtype=np.int32))
+    if timings is not None:
+        arrays['timings'] = np.array(json.dumps(timings))
+
+    buf = io.BytesIO()
+    # savez (no compression) since random-ish float16 values hardly compress and compression costs latency
+    np.savez(buf, **arrays)
+    return buf.getvalue()
+
+
+def decode_wra_payload(payload: bytes) -> Dict[str, Union[np.ndarray, List[str], Dict]]:
+    """
+    Decodes the npz archive created by encode_wra_payload.
+    """
+    with np.load(io.BytesIO(payload), allow_pickle=False) as npz:
+        decoded = {k: npz[k] for k in npz.files}
+    decoded['image_urls'] = decoded['image_urls'].tolist()
+    decoded['context_tokens'] = decoded['context_tokens'].tolist()
+    if 'timings' in decoded:
+        decoded['timings'] = json.loads(str(decoded['timings']))
+    return decoded
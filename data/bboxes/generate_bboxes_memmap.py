@@ -0,0 +1,28 @@
+import argparse
+
+from backend.fineselection.plot.bboxes_datasource import BBoxesDatasource
+from config import conf
+
+
+def generate_bboxes_memmap(dataset: str, out_path: str, num_bboxes: int, num_workers: int) -> BBoxesDatasource:
+    ds_conf = conf.fine_selection.max_focus_annotator.datasources[dataset]
+    ds = BBoxesDatasource(dataset=dataset,
+                          bboxes_root=ds_conf.bbox_root,
+                          fn_prefix=ds_conf.fn_prefix,
+                          fn_suffix=ds_conf.fn_suffix)
+    ds.build_memmap(bboxes_memmap_root=out_path, num_bboxes=num_bboxes, num_workers=num_workers)
+    return ds
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, choices=['wicsmmir', 'coco', 'f30k'], required=True,
+                        help='The image dataset of the bboxes (see max_focus_annotator datasources in the config)')
+    parser.add_argument('--out_path', default='data/bboxes', type=str,
+                        help='Output path. Has to match bboxes_memmap_root of the max_focus_annotator config.')
+    parser.add_argument('--num_bboxes', default=36, type=int, help='The (max) number of bboxes per image')
+    parser.add_argument('--num_workers', default=16, type=int,
+                        help='Number of threads that read the feature archives')
+    opts = parser.parse_args()
+
+    generate_bboxes_memmap(opts.dataset, opts.out_path, opts.num_bboxes, opts.num_workers)
@@ -0,0 +1,38 @@
+import argparse
+
+import numpy as np
+
+from backend.fineselection.data import ImageFeaturePoolFactory, TeranImageEmbeddingsMemmap
+
+
+def generate_teran_image_emb_memmap(dataset: str,
+                                    retriever_name: str,
+                                    out_path: str,
+                                    chunk_size: int,
+                                    fp16: bool) -> TeranImageEmbeddingsMemmap:
+    pool = ImageFeaturePoolFactory().create_or_get_pool(dataset, retriever_name)
+    return TeranImageEmbeddingsMemmap.build(pool=pool,
+                                            retriever_name=retriever_name,
+                                            memmap_root=out_path,
+                                            chunk_size=chunk_size,
+                                            dtype=np.float16 if fp16 else np.float32)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, choices=['wicsmmir', 'coco', 'f30k'], required=True,
+                        help='The image dataset of the precomputed embeddings')
+    parser.add_argument('--retriever_name', type=str, choices=['teran_wicsmmir', 'teran_coco', 'teran_f30k'],
+                        required=True, help='The retriever that precomputed the image embeddings')
+    parser.add_argument('--out_path', default='data/memmap', type=str, help='Output path')
+    parser.add_argument('--chunk_size', default=10000, type=int,
+                        help='Number of images that are loaded into memory at once')
+    parser.add_argument('--fp16', default=False, action='store_true',
+                        help='If True, the embeddings are stored as float16 to halve the I/O of a full scan.')
+    opts = parser.parse_args()
+
+    generate_teran_image_emb_memmap(opts.dataset,
+                                    opts.retriever_name,
+                                    opts.out_path,
+                                    opts.chunk_size,
+                                    opts.fp16)
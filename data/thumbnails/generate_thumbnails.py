@@ -0,0 +1,63 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import List
+
+from loguru import logger
+from tqdm import tqdm
+
+from backend.imgserver.image_datasource import ImageDatasource
+from backend.imgserver.thumbnails import ThumbnailCache, create_thumbnail
+from config import conf
+
+
+def _create_thumbnail(args):
+    src, dst, width, quality = args
+    try:
+        return create_thumbnail(src, dst, width, quality)
+    except Exception as e:
+        logger.error(f"Cannot create thumbnail of {src} with width {width}! {e}")
+        return None
+
+
+def generate_thumbnails(dataset: str, widths: List[int], num_workers: int):
+    ds_conf = conf.image_server.datasources[dataset]
+    ds = ImageDatasource(dataset=dataset,
+                         images_root=ds_conf.images_root,
+                         image_prefix=ds_conf.image_prefix,
+                         image_suffix=ds_conf.image_suffix,
+                         index_cache_dir=conf.image_server.get('index_cache_dir', None))
+    thumbnails_conf = conf.image_server.pyhttp.thumbnails
+    cache = ThumbnailCache(cache_dir=thumbnails_conf.cache_dir,
+                           widths=list(thumbnails_conf.get('widths', [128, 256, 512])),
+                           quality=thumbnails_conf.get('quality', 85),
+                           max_size_mb=thumbnails_conf.get('cache_max_size_mb', 4096))
+
+    tasks = []
+    for width in widths:
+        width = cache.get_width(width)
+        for img_id in ds.index.keys():
+            dst = cache.get_thumbnail_path(dataset, img_id, width)
+            if not cache.render_cache.lookup(dst):
+                tasks.append((ds.lookup_image_path(img_id), dst, width, cache.quality))
+    logger.info(f"Generating {len(tasks)} thumbnails for dataset {dataset} with widths {widths}...")
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        for dst in tqdm(executor.map(_create_thumbnail, tasks, chunksize=64),
+                        total=len(tasks),
+                        desc="Generating thumbnails"):
+            if dst is not None:
+                # the least recently used thumbnails get evicted if the thumbnails exceed the disk budget
+                cache.render_cache.add(dst)
+    logger.info(f"Generated thumbnails for dataset {dataset}! {cache}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', type=str, choices=['wicsmmir', 'coco', 'f30k'], required=True,
+                        help='The image dataset (see image_server datasources in the config)')
+    parser.add_argument('--widths', type=int, nargs='+', default=[256],
+                        help='The widths of the thumbnails. Snapped to the widths of the thumbnails config.')
+    parser.add_argument('--num_workers', default=16, type=int, help='Number of processes that create the thumbnails')
+    opts = parser.parse_args()
+
+    generate_thumbnails(opts.dataset, opts.widths, opts.num_workers)
@@ -1,9 +1,12 @@
 import argparse
 import gc
-import glob
+import multiprocessing as mp
 import os
 import shutil
 import sys
+import time
+import urllib.parse as url
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Optional
 
 import pandas as pd
@@ -13,9 +16,11 @@ from tqdm import tqdm
 
 from api.model import RetrievalRequest
 from backend import MMIRS
-from backend.fineselection.data import ImageFeaturePoolFactory
-from backend.fineselection.retriever import RetrieverFactory
+from backend.fineselection.data import ImageFeaturePoolFactory, TeranImageEmbeddingsMemmap
+from backend.fineselection.retriever import RetrieverFactory, TeranFullScanEngine
 from backend.imgserver.py_http_image_server import PyHttpImageServer
+from backend.util.request_executor import RequestExecutor
+from backend.util.shard_results_writer import ShardResultsWriter
 from config import conf
 
 
@@ -34,29 +39,38 @@ def load_dataset(path: str, use_focus: bool = False) -> DataFrame:
     return df
 
 
-def persist_top_k_results_in_result_dataframe(top_k_results: List[List[str]],
-                                              df: DataFrame,
-                                              opts: argparse.Namespace) -> str:
-    # generate filename for results df
+def get_results_filename(opts: argparse.Namespace) -> str:
     if opts.use_focus:
         fn = f'top_k_images_{opts.retriever_name}_{opts.image_dataset}_fw_{opts.focus_weight}.df.feather'
     else:
         fn = f'top_k_images_{opts.retriever_name}_{opts.image_dataset}.df.feather'
+    return os.path.join(opts.output_path, fn)
+
+
+def get_parts_dir(opts: argparse.Namespace) -> str:
+    # the (resumable) parquet parts of all shards are stored next to the results dataframe
+    return get_results_filename(opts)[:-len('.df.feather')] + '.parts'
+
+
+def persist_top_k_results_in_result_dataframe(df: DataFrame, opts: argparse.Namespace) -> str:
+    fn = get_results_filename(opts)
     os.makedirs(opts.output_path, exist_ok=True)
-    fn = os.path.join(opts.output_path, fn)
 
-    # save the top k in the results dataframe
-    new_df = df[:len(top_k_results)]
-    new_df['top_k'] = top_k_results
+    # merge the top k of all shards into the results dataframe
+    new_df = ShardResultsWriter.merge(get_parts_dir(opts), df)
+    if len(new_df) < len(df):
+        logger.warning(f"Only {len(new_df)} of {len(df)} samples have results!")
 
     # persist
     logger.info(f"Persisting results at {fn}")
-    new_df.reset_index(drop=True).to_feather(os.path.join(opts.output_path, fn))
+    tmp = fn + '.tmp'
+    new_df.reset_index(drop=True).to_feather(tmp)
+    os.replace(tmp, fn)
 
     return fn
 
 
-def prepare_mmirs_config(opts: argparse.Namespace) -> None:
+def prepare_mmirs_config(opts: argparse.Namespace, shard_id: int = 0) -> None:
     logger.info("Preparing MMIRS config...")
     not_selected_ds = []
     selected = opts.image_dataset
@@ -80,6 +94,21 @@ def prepare_mmirs_config(opts: argparse.Namespace) -> None:
     # prefetch the selected image dataset in RAM
     conf.fine_selection.feature_pools[selected][opts.retriever_name].pre_fetch = True
 
+    # the annotated images get linked into the output path right after the retrieval, so they must not be rendered
+    # lazily
+    conf.fine_selection.lazy_rendering = False
+
+    # the selected dataset gets loaded before the retrieval starts (see run_retrieval_shard)
+    if 'lazy_init' in conf:
+        conf.lazy_init.warm_up = []
+
+    # run batch_size requests concurrently so that their contexts get encoded and searched in batches
+    conf.api.request_executor.max_workers = opts.batch_size
+    conf.api.request_executor.max_queue_size = opts.batch_size
+
+    # every shard process runs its own image server
+    conf.image_server.pyhttp.port += shard_id
+
 
 def build_retrieval_requests(df: DataFrame, opts: argparse.Namespace) -> List[RetrievalRequest]:
     reqs = []
@@ -99,6 +128,15 @@ def build_retrieval_requests(df: DataFrame, opts: argparse.Namespace) -> List[Re
     return reqs
 
 
+def setup_logging(opts: argparse.Namespace, shard_id: Optional[int] = None) -> None:
+    logger.remove()
+    logger.add(sys.stdout, level=opts.log_level.upper())
+    log_fn = '{time}.log' if shard_id is None else f'shard_{shard_id:03d}_{{time}}.log'
+    logger.add(os.path.join(opts.output_path, 'logs', log_fn),
+               rotation=f"{conf.logging.max_file_size} MB",
+               level=opts.log_level.upper())
+
+
 @logger.catch(reraise=True)
 def run_no_pss_retrieval(df: DataFrame, opts: argparse.Namespace) -> str:
     # instantiate retriever and image pool
@@ -109,87 +147,136 @@ def run_no_pss_retrieval(df: DataFrame, opts: argparse.Namespace) -> str:
     pool_factory = ImageFeaturePoolFactory()
     pool = pool_factory.create_or_get_pool(opts.image_dataset, retriever.retriever_name)
 
-    # build and load the image search space (into memory!) containing ALL IMAGES OF THE POOL!
-    iss = pool.get_image_search_space(img_ids=None)
+    # load (or build once) the memmap containing ALL IMAGES OF THE POOL! It never gets loaded completely into memory.
+    memmap = TeranImageEmbeddingsMemmap.load_or_build(pool=pool,
+                                                      retriever_name=retriever.retriever_name,
+                                                      memmap_root=opts.memmap_root)
+    engine = TeranFullScanEngine(memmap=memmap,
+                                 block_size=opts.block_size,
+                                 num_threads=opts.num_threads)
 
-    top_k_results = []
-    # run IR for all captions
-    for idx, row in tqdm(df.iterrows(), desc="Running image retrieval on each caption", total=len(df)):
-        # do the retrieval
-        res = retriever.find_top_k_images(focus=row['focus'] if opts.use_focus else None,
-                                          context=row['caption'],
-                                          focus_weight=0.0 if opts.use_focus else opts.focus_weight,
-                                          top_k=opts.top_k,
-                                          iss=iss)
-        top_k_image_ids = res['top_k'][opts.ranking_method]
-        top_k_results.append(top_k_image_ids)
-        del res
+    if opts.use_focus:
+        logger.warning("The full scan ranks the images by context only! Focus is ignored.")
 
+    writer = ShardResultsWriter(get_parts_dir(opts), shard_id=0, persist_step=opts.persist_step)
+    indices = [idx for idx in range(len(df)) if not writer.is_done(idx)]
+    captions = df['caption'].tolist()
+    # run IR for batches of captions
+    for start in tqdm(range(0, len(indices), opts.query_batch_size),
+                      desc="Running image retrieval on batches of captions"):
+        batch = indices[start:start + opts.query_batch_size]
 
-        if idx % opts.persist_step == 0:
-            persist_top_k_results_in_result_dataframe(top_k_results=top_k_results,
-                                                      df=df,
-                                                      opts=opts)
+        query_embs, query_lengths = retriever.compute_query_embeddings([captions[idx] for idx in batch])
+        top_k_results = engine.find_top_k_images(query_embs=query_embs,
+                                                 query_lengths=query_lengths,
+                                                 top_k=opts.top_k)
+        for idx, top_k_img_ids in zip(batch, top_k_results):
+            writer.append(idx, top_k_img_ids)
+    writer.close()
+    logger.info(f"Retrieved {writer.num_written} samples with {writer.samples_per_sec:.2f} samples/sec")
 
-    return persist_top_k_results_in_result_dataframe(top_k_results=top_k_results,
-                                                     df=df,
-                                                     opts=opts)
+    return persist_top_k_results_in_result_dataframe(df=df, opts=opts)
 
 
-def save_annotated_images(top_k_img_ids: List[str],
+def save_annotated_images(top_k_img_urls: List[str],
                           opts: argparse.Namespace,
                           id_prefix: Optional[str] = None) -> List[str]:
-    dst_root_p = conf.fine_selection.max_focus_annotator.annotated_images_dst
+    img_srv = PyHttpImageServer()
     top_k_img_ids_with_prefix = []
-    # copy images from root_p to output_path and append id_prefix
-    for img_id in top_k_img_ids:
-        img_files = glob.glob(f"{dst_root_p}/{img_id}*")
-        for f in img_files:
-            fn_with_prefix = f"{id_prefix}_{os.path.basename(f)}"
-            dst = os.path.join(opts.output_path, fn_with_prefix)
-            shutil.move(f, dst)
-            top_k_img_ids_with_prefix.append(fn_with_prefix)
+    # link the annotated images of the request served at the URLs into the output_path and append id_prefix. the
+    # URLs are resolved per request, i.e., they do not depend on annotations of other (concurrent) requests
+    for img_url in top_k_img_urls:
+        img_path = url.urlsplit(img_url).path
+        src = img_srv.resolve_path(url.unquote(img_path))
+        if src is None or not os.path.isfile(src) or os.path.dirname(src) not in img_srv.artifact_dirs.values():
+            # the image is not annotated
+            top_k_img_ids_with_prefix.append(img_srv.get_image_id(img_url))
+            continue
+        fn_with_prefix = f"{id_prefix}_{os.path.basename(src)}"
+        dst = os.path.join(opts.output_path, fn_with_prefix)
+        if os.path.lexists(dst):
+            os.remove(dst)
+        # the annotated image stays in the render cache, so the same annotation of other samples is not rendered again
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+        top_k_img_ids_with_prefix.append(fn_with_prefix)
     return top_k_img_ids_with_prefix
 
 
 @logger.catch(reraise=True)
-def run_retrieval_with_pss(df: DataFrame, opts: argparse.Namespace) -> str:
-    prepare_mmirs_config(opts)
-    # build the retrieval request list from the dataframe
-    reqs = build_retrieval_requests(df, opts)
+def run_retrieval_shard(opts: argparse.Namespace, shard_id: int) -> int:
+    """
+    Runs the retrieval of the samples with idx % num_shards == shard_id and appends their results to the parts of the
+    shard. Samples that already have results (of a previous run) are skipped.
+    :return: the number of retrieved samples
+    """
+    if opts.num_shards > 1:
+        setup_logging(opts, shard_id)
+    prepare_mmirs_config(opts, shard_id)
+    df = load_dataset(opts.dataset_path, opts.use_focus)
 
     # create the output path
     os.makedirs(opts.output_path, exist_ok=True)
 
-    # start MMIRS
+    # start MMIRS and load the models and indices before measuring the throughput
     mmirs = MMIRS()
-
+    mmirs.warm_up(opts.image_dataset, opts.retriever_name)
     img_srv = PyHttpImageServer()
+    executor = RequestExecutor()
 
-    logger.info(f"Starting retrieval of {len(reqs)} samples!")
-    top_k_results = []
-    for idx, req in tqdm(enumerate(reqs), desc="Retrieval progress: ", total=len(reqs)):
-        if opts.return_wra_matrices:
-            top_k_img_urls, top_k_wra_urls = MMIRS().retrieve_top_k_images(req)
-        else:
-            top_k_img_urls = mmirs.retrieve_top_k_images(req)
+    writer = ShardResultsWriter(get_parts_dir(opts), shard_id=shard_id, persist_step=opts.persist_step)
+    indices = [idx for idx in range(shard_id, len(df), opts.num_shards) if not writer.is_done(idx)]
+    # build the retrieval request list from the dataframe
+    reqs = build_retrieval_requests(df.iloc[indices], opts)
+
+    logger.info(f"Starting retrieval of {len(reqs)} samples in shard {shard_id}!")
+    num_since_clear = 0
+    progress = tqdm(total=len(reqs), desc=f"Retrieval progress of shard {shard_id}: ", position=shard_id)
+    for start in range(0, len(reqs), opts.batch_size):
+        batch = list(zip(indices[start:start + opts.batch_size], reqs[start:start + opts.batch_size]))
+        futures = [executor.submit(mmirs.retrieve_top_k_images, req) for _, req in batch]
+        for (idx, req), future in zip(batch, futures):
+            if opts.return_wra_matrices:
+                top_k_img_urls, top_k_wra_urls = future.result()
+            else:
+                top_k_img_urls = future.result()
+
+            # the URLs of the annotated images are built per request from the paths of its own artifacts, so the
+            # concurrent requests of the batch cannot overwrite the annotations of each other
+            writer.append(idx, save_annotated_images(top_k_img_urls, opts, id_prefix=str(idx)))
+        progress.update(len(batch))
+
+        num_since_clear += len(batch)
+        if num_since_clear >= opts.persist_step:
+            img_srv.clear_cache()
+            gc.collect()
+            num_since_clear = 0
+    progress.close()
+    writer.close()
+    logger.info(f"Shard {shard_id} retrieved {writer.num_written} samples with {writer.samples_per_sec:.2f} "
+                f"samples/sec")
 
-        top_k_img_ids = img_srv.get_image_ids(top_k_img_urls)
-        top_k_img_ids = save_annotated_images(top_k_img_ids, opts, id_prefix=str(idx))
+    executor.shutdown()
+    return writer.num_written
 
-        top_k_results.append(top_k_img_ids)
-        del top_k_img_ids
 
-        if idx % opts.persist_step == 0:
-            persist_top_k_results_in_result_dataframe(top_k_results=top_k_results,
-                                                      df=df,
-                                                      opts=opts)
-            img_srv.clear_cache()
-            gc.collect()
+def run_retrieval_with_pss(df: DataFrame, opts: argparse.Namespace) -> str:
+    start = time.time()
+    if opts.num_shards == 1:
+        num_samples = run_retrieval_shard(opts, shard_id=0)
+    else:
+        # every shard runs in its own process with its own models, indices and image server
+        logger.info(f"Starting {opts.num_shards} shard processes...")
+        with ProcessPoolExecutor(max_workers=opts.num_shards, mp_context=mp.get_context('spawn')) as pool:
+            futures = [pool.submit(run_retrieval_shard, opts, shard_id) for shard_id in range(opts.num_shards)]
+            num_samples = sum(future.result() for future in futures)
+    duration = time.time() - start
+    logger.info(f"Retrieved {num_samples} samples in {duration:.2f}s "
+                f"({num_samples / duration if duration > 0 else 0.:.2f} samples/sec)")
 
-    return persist_top_k_results_in_result_dataframe(top_k_results=top_k_results,
-                                                     df=df,
-                                                     opts=opts)
+    return persist_top_k_results_in_result_dataframe(df=df, opts=opts)
 
 
 if __name__ == '__main__':
@@ -215,8 +302,9 @@ if __name__ == '__main__':
     parser.add_argument('--ranking_method',
                         type=str,
                         help=("Method that is used to retrieve and rank the images. If no_pss is selected, only FSS"
-                              " is used to retrieve the images, which can be more accurate but takes A LOT OF TIME."
-                              " This currently does not support annotating focus regions etc."),
+                              " is used to retrieve the images by scanning ALL images of the pool, which can be more"
+                              " accurate but takes more time. This ranks by context and currently does not support"
+                              " annotating focus regions etc."),
                         choices=['focus', 'context', 'combined', "no_pss"],
                         default="combined")
     parser.add_argument('--use_focus', action='store_true', default=False)
@@ -230,18 +318,39 @@ if __name__ == '__main__':
                         type=str,
                         choices=['info', 'debug', 'error', "warning"],
                         default="info")
-    parser.add_argument('--persist_step', type=int, default=100)
+    parser.add_argument('--persist_step', type=int, default=100,
+                        help='Number of results per shard that are appended at once to the (resumable) results')
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help='Number of shards of the dataset that are retrieved in parallel worker processes')
+    parser.add_argument('--shard_id', type=int, default=None,
+                        help='Only run this shard, e.g. to distribute the shards across machines. Defaults to all')
+    parser.add_argument('--batch_size', type=int, default=8,
+                        help=('Number of requests per shard that run concurrently so that their contexts get encoded'
+                              ' and searched in batches. Each request gets its own annotated images'))
+    parser.add_argument('--merge_only', action='store_true', default=False,
+                        help='Only merge the results of all shards into the results dataframe')
+    parser.add_argument('--memmap_root',
+                        type=str,
+                        help='Path where the image embeddings memmap for no_pss is stored (or built if missing)',
+                        default='data/memmap')
+    parser.add_argument('--block_size', type=int, default=1024,
+                        help='Number of images that are scored at once in no_pss')
+    parser.add_argument('--query_batch_size', type=int, default=16,
+                        help='Number of captions that are scored at once in no_pss')
+    parser.add_argument('--num_threads', type=int, default=None,
+                        help='Number of threads used for scoring in no_pss. Defaults to all cores')
     opts = parser.parse_args()
 
-    logger.remove()
-    logger.add(sys.stdout, level=opts.log_level.upper())
-    logger.add(opts.output_path + '/logs/{time}.log',
-               rotation=f"{conf.logging.max_file_size} MB",
-               level=opts.log_level.upper())
+    setup_logging(opts)
 
     df = load_dataset(opts.dataset_path, opts.use_focus)
 
-    if opts.ranking_method == "no_pss":
+    if opts.merge_only:
+        persist_top_k_results_in_result_dataframe(df=df, opts=opts)
+    elif opts.ranking_method == "no_pss":
         run_no_pss_retrieval(df, opts)
+    elif opts.shard_id is not None:
+        # the results get merged by running with --merge_only once all shards are done
+        run_retrieval_shard(opts, shard_id=opts.shard_id)
     else:
         run_retrieval_with_pss(df, opts)
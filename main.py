@@ -7,6 +7,8 @@ import api.routers.retrieval as retrieval
 from backend import MMIRS
 from backend.fineselection import FineSelectionStage
 from backend.imgserver.py_http_image_server import PyHttpImageServer
+from backend.util.compute_executor import ComputeExecutor
+from backend.util.request_executor import RequestExecutor
 from config import conf
 
 # create the main api
@@ -19,8 +21,10 @@ app = FastAPI(title="User Study API",
 @app.on_event("shutdown")
 def shutdown_event():
     try:
+        RequestExecutor().shutdown()
         PyHttpImageServer().shutdown()
         FineSelectionStage().shutdown()
+        ComputeExecutor().shutdown()
     except:
         pass
 
@@ -0,0 +1,46 @@
+import os
+import subprocess
+import sys
+from typing import List, Tuple
+
+from loguru import logger
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+HEAVY_MODULES = ['numpy', 'torch', 'matplotlib', 'sklearn', 'faiss', 'sentence_transformers', 'spacy',
+                 'backend.fineselection.fine_selection_stage', 'backend.mmirs']
+
+
+def import_with_importtime(module: str) -> Tuple[List[str], List[Tuple[int, str]]]:
+    """
+    Imports the module in a fresh interpreter with -X importtime.
+    :return: the heavy modules that got imported and the (cumulative time in us, module) of every import
+    """
+    code = f"import sys, {module}; print(','.join(m for m in {HEAVY_MODULES} if m in sys.modules))"
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          cwd=REPO_ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                          check=True)
+    timings = []
+    for line in proc.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if line.startswith('import time:') and 'cumulative' not in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            timings.append((int(cumulative), name.strip()))
+    heavy = [m for m in proc.stdout.strip().split(',') if m != '']
+    return heavy, timings
+
+
+def test_api_models_do_not_import_the_backend():
+    heavy, timings = import_with_importtime('api.model')
+    total = max(t for t, _ in timings)
+    logger.info(f"Importing api.model took {total / 1000:.2f}ms")
+    for t, name in sorted(timings, reverse=True)[:10]:
+        logger.info(f"{t / 1000:>10.2f}ms {name}")
+    assert heavy == []
+
+
+def test_light_backend_modules():
+    for module in ['backend', 'backend.fineselection.ranked_by', 'backend.fineselection.wra_format',
+                   'backend.util.availability']:
+        heavy, timings = import_with_importtime(module)
+        logger.info(f"Importing {module} took {max(t for t, _ in timings) / 1000:.2f}ms")
+        assert heavy == []
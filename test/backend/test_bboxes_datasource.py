@@ -0,0 +1,52 @@
+import time
+
+import numpy as np
+import pytest
+from loguru import logger
+
+from backend.fineselection.plot.bboxes_datasource import BBoxesDatasource
+
+
+@pytest.fixture
+def bboxes_root(tmp_path) -> str:
+    root = tmp_path / "features_36"
+    root.mkdir()
+    for i in range(100):
+        # the feature archives also contain the (heavy) region features
+        np.savez(str(root / f"COCO_000000{i:06d}.npz"),
+                 x=np.random.rand(36, 2048).astype(np.float32),
+                 bbox=np.full((36, 4), i, dtype=np.float32) + np.arange(36, dtype=np.float32)[:, None])
+    return str(root)
+
+
+def test_bboxes_memmap(tmp_path, bboxes_root: str):
+    memmap_root = str(tmp_path / "bboxes")
+    npz_ds = BBoxesDatasource(dataset='coco', bboxes_root=bboxes_root, fn_prefix='COCO_000000', fn_suffix='.npz')
+    assert not npz_ds.has_memmap
+    npz_ds.build_memmap(bboxes_memmap_root=memmap_root)
+    assert npz_ds.has_memmap
+
+    # the memmap gets picked up when the datasource is instantiated
+    mm_ds = BBoxesDatasource(dataset='coco',
+                             bboxes_root=bboxes_root,
+                             fn_prefix='COCO_000000',
+                             fn_suffix='.npz',
+                             bboxes_memmap_root=memmap_root)
+    assert mm_ds.has_memmap
+    assert mm_ds.get_number_of_bboxes() == 100
+
+    fallback_ds = BBoxesDatasource(dataset='coco', bboxes_root=bboxes_root, fn_prefix='COCO_000000', fn_suffix='.npz')
+    img_ids = [f"{i:06d}" for i in range(100)]
+
+    start = time.time()
+    from_npz = [fallback_ds.get_bbox(iid, 7) for iid in img_ids]
+    logger.info(f"Looking up {len(img_ids)} bboxes in the feature archives took {time.time() - start}s")
+
+    start = time.time()
+    from_memmap = [mm_ds.get_bbox(iid, 7) for iid in img_ids]
+    logger.info(f"Looking up {len(img_ids)} bboxes in the memmap took {time.time() - start}s")
+
+    for i, (a, b) in enumerate(zip(from_npz, from_memmap)):
+        assert b.dtype == np.float32
+        assert np.allclose(a, b)
+        assert np.allclose(b, i + 7)
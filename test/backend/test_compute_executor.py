@@ -0,0 +1,107 @@
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Set
+
+import numpy as np
+import pytest
+import torch
+from loguru import logger
+
+from backend.fineselection.retriever import RetrieverFactory
+from backend.fineselection.retriever.teran_retriever import TeranRetriever, compute_distances
+from backend.util.compute_executor import ComputeExecutor
+
+
+@pytest.fixture
+def retriever() -> TeranRetriever:
+    return RetrieverFactory().create_or_get_retriever('teran_coco')
+
+
+@pytest.fixture
+def cex() -> ComputeExecutor:
+    return ComputeExecutor()
+
+
+@pytest.fixture
+def inp(retriever: TeranRetriever, cex: ComputeExecutor) -> List:
+    query_embs, query_lengths = retriever.compute_query_embeddings(["A brown dog is playing with a red ball."])
+    query_embs = query_embs.cpu()
+    # the smallest image search space of 37 (36 rois + global) embeddings per image that is computed on the pool
+    num_images = math.ceil(cex.min_pool_num_elements / (37 * query_embs.shape[-1]))
+    img_embs = torch.nn.functional.normalize(torch.rand(num_images, 37, query_embs.shape[-1]), p=2, dim=2)
+    return [img_embs, query_embs, img_embs.shape[1], query_lengths]
+
+
+def _get_pid(seconds: float) -> int:
+    # blocks the worker so that every worker of the pool gets one of the tasks
+    time.sleep(seconds)
+    return os.getpid()
+
+
+def get_worker_pids(pool: ProcessPoolExecutor, num_workers: int) -> Set[int]:
+    return {f.result() for f in [pool.submit(_get_pid, 0.5) for _ in range(num_workers)]}
+
+
+def test_get_pool_is_size_aware(cex: ComputeExecutor):
+    small = torch.rand(10, 37, 8)
+    assert cex.get_pool(small) is None
+    assert not small.is_shared()
+
+    large = torch.rand(cex.min_pool_num_elements)
+    assert cex.get_pool(large) is cex.pool
+    assert large.is_shared()
+
+
+@pytest.mark.parametrize("return_wra_matrices", [False, True])
+def test_shared_executor_vs_per_retriever_pools(retriever: TeranRetriever,
+                                                cex: ComputeExecutor,
+                                                inp: List,
+                                                return_wra_matrices: bool):
+    img_embs, query_embs, img_length, query_lengths = inp
+    expected = compute_distances(img_embs, query_embs, img_length, query_lengths, retriever.model_config,
+                                 return_wra_matrices=return_wra_matrices)
+    num_requests = 6
+
+    # previous setup: every retriever (coco, wicsmmir, f30k) had its own pool
+    per_retriever_pools = [ProcessPoolExecutor(max_workers=4) for _ in range(3)]
+    start = time.time()
+    for i in range(num_requests):
+        result = compute_distances(img_embs, query_embs, img_length, query_lengths, retriever.model_config,
+                                   return_wra_matrices=return_wra_matrices, dist_pool=per_retriever_pools[i % 3])
+        for r, e in zip(result, expected) if return_wra_matrices else [(result, expected)]:
+            assert np.allclose(r, e, atol=1e-4)
+    logger.info(f"{num_requests} requests with per retriever pools took {time.time() - start}s")
+    for p in per_retriever_pools:
+        p.shutdown()
+
+    # shared, warm executor with pinned threads and shared memory tensor handoff
+    pool = cex.pool
+    worker_pids = get_worker_pids(pool, cex.max_workers)
+    start = time.time()
+    for i in range(num_requests):
+        result = retriever.compute_distances(img_embs, query_embs, img_length, query_lengths,
+                                             return_wra_matrices=return_wra_matrices)
+        for r, e in zip(result, expected) if return_wra_matrices else [(result, expected)]:
+            assert np.allclose(r, e, atol=1e-4)
+    logger.info(f"{num_requests} requests with the shared ComputeExecutor took {time.time() - start}s")
+
+    # the same (warm) workers computed all requests
+    assert cex.get_pool(img_embs) is pool
+    assert get_worker_pids(pool, cex.max_workers) == worker_pids
+
+
+def test_broken_pool_is_restarted(retriever: TeranRetriever, cex: ComputeExecutor, inp: List):
+    img_embs, query_embs, img_length, query_lengths = inp
+    expected = retriever.compute_distances(img_embs, query_embs, img_length, query_lengths)
+
+    # exit a worker so that the pool is broken
+    broken_pool = cex.pool
+    with pytest.raises(BrokenProcessPool):
+        broken_pool.submit(os._exit, 1).result()
+
+    result = retriever.compute_distances(img_embs, query_embs, img_length, query_lengths)
+    assert np.allclose(result, expected, atol=1e-4)
+    assert cex.pool is not broken_pool
@@ -0,0 +1,55 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+from loguru import logger
+
+from backend.util.event_stream import EventStream, encode_ndjson_event
+
+
+def test_events_of_worker_thread_are_streamed_progressively():
+    def work(stream: EventStream):
+        stream.emit('pss', {'num_candidates': 1000})
+        time.sleep(0.2)
+        stream.emit('top_k', {'urls': ['a', 'b']})
+        for rank in range(2):
+            time.sleep(0.1)
+            stream.emit('annotated', {'rank': rank})
+        stream.emit('done', {'urls': ['a', 'b']})
+        stream.close()
+
+    async def run():
+        stream = EventStream()
+        threading.Thread(target=work, args=(stream,)).start()
+        received = []
+        async for event, data in stream.events(timeout=5):
+            received.append((event, stream.elapsed))
+        return received
+
+    received = asyncio.get_event_loop().run_until_complete(run())
+    for event, elapsed in received:
+        logger.info(f"Received {event} after {elapsed * 1000:.2f}ms")
+    assert [e for e, _ in received] == ['pss', 'top_k', 'annotated', 'annotated', 'done']
+    # the first event is received long before the stream is finished
+    assert received[0][1] < 0.1 < received[-1][1]
+
+
+def test_timeout():
+    async def run():
+        stream = EventStream()
+        stream.emit('pss')
+        received = []
+        with pytest.raises(asyncio.TimeoutError):
+            async for event, _ in stream.events(timeout=0.1):
+                received.append(event)
+        return received
+
+    assert asyncio.get_event_loop().run_until_complete(run()) == ['pss']
+
+
+def test_encode_ndjson_event():
+    line = encode_ndjson_event('top_k', {'urls': ['a']})
+    assert line.endswith('\n') and '\n' not in line[:-1]
+    assert json.loads(line) == {'event': 'top_k', 'data': {'urls': ['a']}}
@@ -0,0 +1,122 @@
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from loguru import logger
+
+from backend.fineselection import FineSelectionStage
+from backend.fineselection.fine_selection_stage import RankedBy
+from backend.fineselection.retriever.retrieval_plan import RetrievalPlan
+from backend.preselection import PreselectionStage
+
+
+@pytest.fixture
+def fss() -> FineSelectionStage:
+    return FineSelectionStage()
+
+
+@pytest.fixture
+def pss() -> PreselectionStage:
+    return PreselectionStage()
+
+
+@pytest.fixture
+def inp() -> dict:
+    return {'context': "A brown dog is playing with a red ball.",
+            'focus': "red ball",
+            'dataset': "coco",
+            'retriever_name': "teran_coco"}
+
+
+def test_retrieval_plan_score_only():
+    plan = RetrievalPlan.create(ranked_by=RankedBy.CONTEXT)
+    assert plan.rankings == {'context'}
+    assert not plan.needs_focus_scores
+    assert not plan.needs_wra_matrices
+
+    plan = RetrievalPlan.create(ranked_by=RankedBy.CONTEXT, return_scores=True)
+    assert not plan.needs_wra_matrices
+
+
+def test_retrieval_plan_wra_required():
+    for ranked_by in [RankedBy.FOCUS, RankedBy.COMBINED]:
+        plan = RetrievalPlan.create(ranked_by=ranked_by)
+        assert plan.needs_focus_scores
+        assert plan.needs_wra_matrices
+        assert not plan.return_wra_matrices
+
+    plan = RetrievalPlan.create(ranked_by=RankedBy.CONTEXT, annotate_max_focus_region=True)
+    assert not plan.needs_focus_scores
+    assert plan.needs_wra_matrices
+
+    plan = RetrievalPlan.create(ranked_by=RankedBy.CONTEXT, return_wra_matrices=True)
+    assert plan.needs_wra_matrices
+
+
+def test_retrieval_plan_from_flags():
+    assert RetrievalPlan.from_flags().rankings == {'combined'}
+    assert RetrievalPlan.from_flags(return_separated_ranks=True).rankings == {'context', 'focus', 'combined'}
+    with pytest.raises(ValueError):
+        RetrievalPlan(rankings=['unknown'])
+
+
+@pytest.mark.parametrize("ranked_by,return_scores,annotate_max_focus_region,return_wra_matrices",
+                         list(itertools.product(RankedBy, [False, True], [False, True], [False, True])))
+def test_find_top_k_images_combinations(fss: FineSelectionStage,
+                                        pss: PreselectionStage,
+                                        inp: dict,
+                                        ranked_by: RankedBy,
+                                        return_scores: bool,
+                                        annotate_max_focus_region: bool,
+                                        return_wra_matrices: bool):
+    top_k = 10
+    preselected = pss.retrieve_relevant_images(focus=inp['focus'], context=inp['context'], dataset=inp['dataset'])
+    for i in range(3):
+        start = time.time()
+        top_k_image_ids = fss.find_top_k_images(focus=inp['focus'],
+                                                context=inp['context'],
+                                                top_k=top_k,
+                                                retriever_name=inp['retriever_name'],
+                                                dataset=inp['dataset'],
+                                                preselected_image_ids=preselected,
+                                                ranked_by=ranked_by,
+                                                annotate_max_focus_region=annotate_max_focus_region,
+                                                return_scores=return_scores,
+                                                return_wra_matrices=return_wra_matrices)
+        logger.info(f"{i}th run with ranked_by={ranked_by.value}, return_scores={return_scores}, "
+                    f"annotate_max_focus_region={annotate_max_focus_region}, "
+                    f"return_wra_matrices={return_wra_matrices} took {time.time() - start}s")
+        if annotate_max_focus_region or return_wra_matrices:
+            top_k_image_ids, artifacts = top_k_image_ids
+            if annotate_max_focus_region:
+                assert len(artifacts['annotated_images']) == top_k
+            if return_wra_matrices:
+                assert len(artifacts['wra_plots']) == top_k
+        assert len(top_k_image_ids) == top_k
+
+
+def test_concurrent_requests_get_their_own_artifacts(fss: FineSelectionStage, pss: PreselectionStage, inp: dict):
+    # the same images annotated for different foci
+    focuses = ["red ball", "brown dog", "dog", "ball"]
+    preselected = pss.retrieve_relevant_images(focus=inp['focus'], context=inp['context'], dataset=inp['dataset'])
+
+    def find(focus: str):
+        return fss.find_top_k_images(focus=focus,
+                                     context=inp['context'],
+                                     top_k=10,
+                                     retriever_name=inp['retriever_name'],
+                                     dataset=inp['dataset'],
+                                     preselected_image_ids=preselected,
+                                     ranked_by=RankedBy.CONTEXT,
+                                     annotate_max_focus_region=True,
+                                     return_wra_matrices=True)
+
+    expected = [find(focus) for focus in focuses]
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=len(focuses)) as pool:
+        results = list(pool.map(find, focuses))
+    logger.info(f"{len(focuses)} concurrent requests took {time.time() - start}s")
+    assert results == expected
+    # the annotated images of the different foci are different files
+    assert len({tuple(artifacts['annotated_images']) for _, artifacts in results}) == len(focuses)
@@ -0,0 +1,68 @@
+import os
+import time
+
+import pytest
+from loguru import logger
+
+from backend.imgserver.image_datasource import ImageDatasource
+
+
+@pytest.fixture
+def images_root(tmp_path) -> str:
+    root = tmp_path / "images"
+    root.mkdir()
+    for i in range(1000):
+        (root / f"COCO_000000{i:06d}.jpg").write_bytes(b'')
+    # files that do not belong to the datasource
+    (root / "README.txt").write_bytes(b'')
+    return str(root)
+
+
+def create_datasource(images_root: str, index_cache_dir: str) -> ImageDatasource:
+    return ImageDatasource(dataset='coco',
+                           images_root=images_root,
+                           image_prefix='COCO_000000',
+                           image_suffix='.jpg',
+                           index_cache_dir=index_cache_dir)
+
+
+def test_image_index(tmp_path, images_root: str):
+    index_cache_dir = str(tmp_path / "index")
+    ds = create_datasource(images_root, index_cache_dir)
+    start = time.time()
+    ds.build_index()
+    logger.info(f"Scanning the images took {time.time() - start}s")
+
+    assert os.path.isfile(ds.get_index_cache_file())
+    assert ds.get_number_of_images() == 1000
+    assert ds.lookup_image_path('000042') == os.path.join(images_root, "COCO_000000000042.jpg")
+    assert ds.get_image_path('000042') == os.path.join(images_root, "COCO_000000000042.jpg")
+    assert ds.lookup_image_path('README') is None
+    with pytest.raises(FileNotFoundError):
+        ds.get_image_path('999999')
+
+    start = time.time()
+    num_lookups = 100000
+    for i in range(num_lookups):
+        ds.lookup_image_path(f"{i % 1000:06d}")
+    logger.info(f"{num_lookups} lookups took {time.time() - start}s")
+
+
+def test_image_index_cache_validation(tmp_path, images_root: str):
+    index_cache_dir = str(tmp_path / "index")
+    create_datasource(images_root, index_cache_dir).build_index()
+    cache_mtime = os.stat(os.path.join(index_cache_dir, "coco.index.pkl")).st_mtime_ns
+
+    # unchanged images root -> the index is loaded from the cache
+    ds = create_datasource(images_root, index_cache_dir)
+    ds.build_index()
+    assert os.stat(ds.get_index_cache_file()).st_mtime_ns == cache_mtime
+    assert ds.get_number_of_images() == 1000
+
+    # new image -> the mtime of the images root changes and the index gets rebuilt
+    time.sleep(0.01)
+    with open(os.path.join(images_root, "COCO_000000001000.jpg"), 'wb'):
+        pass
+    ds = create_datasource(images_root, index_cache_dir)
+    assert ds.get_number_of_images() == 1001
+    assert ds.lookup_image_path('001000') is not None
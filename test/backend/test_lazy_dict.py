@@ -0,0 +1,75 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from loguru import logger
+
+from backend.util.lazy_dict import LazyDict
+
+
+class SlowLoader(object):
+    def __init__(self, duration: float):
+        self.duration = duration
+        self.num_loads = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, key: str) -> str:
+        time.sleep(self.duration)
+        with self.lock:
+            self.num_loads[key] = self.num_loads.get(key, 0) + 1
+        return f"index_{key}"
+
+
+def test_values_are_loaded_once_on_first_access():
+    loader = SlowLoader(duration=0.2)
+    indices = LazyDict(keys=['coco', 'wicsmmir', 'f30k'], load=loader, name='test indices')
+
+    # creating the dict does not load anything
+    assert len(loader.num_loads) == 0
+    assert 'coco' in indices and 'unknown' not in indices
+    assert list(indices.keys()) == ['coco', 'wicsmmir', 'f30k']
+
+    # concurrent requests of the same dataset load the index only once
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        values = list(pool.map(lambda _: indices['coco'], range(8)))
+    logger.info(f"8 concurrent accesses took {time.time() - start}s")
+    assert values == ['index_coco'] * 8
+    assert loader.num_loads == {'coco': 1}
+    assert indices.is_loaded('coco') and not indices.is_loaded('f30k')
+
+
+def test_keys_are_loaded_concurrently():
+    loader = SlowLoader(duration=0.2)
+    indices = LazyDict(keys=['coco', 'wicsmmir', 'f30k'], load=loader)
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        list(pool.map(indices.__getitem__, ['coco', 'wicsmmir', 'f30k']))
+    duration = time.time() - start
+    logger.info(f"Loading 3 datasets concurrently took {duration}s")
+    assert duration < 0.5
+    assert sorted(indices.loaded_keys()) == ['coco', 'f30k', 'wicsmmir']
+
+
+def test_failed_loads_are_retried():
+    attempts = []
+
+    def load(key):
+        attempts.append(key)
+        if len(attempts) == 1:
+            raise IOError("index not available")
+        return key
+
+    indices = LazyDict(keys=['coco'], load=load)
+    with pytest.raises(IOError):
+        indices['coco']
+    assert not indices.is_loaded('coco')
+    assert indices['coco'] == 'coco'
+
+
+def test_mapping_methods_load_the_values():
+    indices = LazyDict(keys=['coco', 'f30k'], load=lambda key: f"index_{key}")
+    assert list(indices.values()) == ['index_coco', 'index_f30k']
+    assert dict(indices.items()) == {'coco': 'index_coco', 'f30k': 'index_f30k'}
+    assert indices.get('unknown') is None
@@ -0,0 +1,64 @@
+import time
+from typing import Callable
+
+import numpy as np
+import pytest
+from PIL import Image
+from loguru import logger
+
+from backend.fineselection.plot.max_focus_region_annotator import render_max_focus_region_with_pillow, \
+    render_max_focus_region_with_matplotlib
+
+
+@pytest.fixture
+def img_path(tmp_path) -> str:
+    # smooth gradient so that the JPEG artifacts do not dominate the comparison of the renderers
+    h, w = 480, 640
+    im = np.zeros((h, w, 3), dtype=np.uint8)
+    im[..., 0] = np.linspace(0, 255, w, dtype=np.uint8)[None, :]
+    im[..., 1] = np.linspace(0, 255, h, dtype=np.uint8)[:, None]
+    im[..., 2] = 128
+    p = str(tmp_path / "test_img.jpg")
+    Image.fromarray(im).save(p, quality=95)
+    return p
+
+
+@pytest.fixture
+def bbox() -> np.ndarray:
+    return np.array([120., 150., 360., 400.], dtype=np.float32)
+
+
+def render(render_fn: Callable, img_path: str, bbox: np.ndarray, dst: str, img_format: str) -> np.ndarray:
+    render_fn(img_path=img_path, bbox=bbox, focus_text="red ball", dst=dst, img_format=img_format, img_quality=90)
+    with Image.open(dst) as im:
+        return np.asarray(im.convert('RGB'), dtype=np.float32)
+
+
+def test_renderers_look_the_same(tmp_path, img_path: str, bbox: np.ndarray):
+    pil = render(render_max_focus_region_with_pillow, img_path, bbox, str(tmp_path / "pil.png"), 'png')
+    mpl = render(render_max_focus_region_with_matplotlib, img_path, bbox, str(tmp_path / "mpl.png"), 'png')
+
+    assert pil.shape == mpl.shape == (480, 640, 3)
+    # the bbox border is red in both renderings
+    assert pil[275, 120, 0] > 200 and pil[275, 120, 2] < 100
+    assert mpl[275, 120, 0] > 200 and mpl[275, 120, 2] < 100
+    # only the anti-aliasing of the border and the glyphs differ
+    mean_abs_diff = np.abs(pil - mpl).mean()
+    logger.info(f"Mean absolute pixel difference of the renderers: {mean_abs_diff}")
+    assert mean_abs_diff < 5.
+
+
+@pytest.mark.parametrize("img_format", ['jpeg', 'webp', 'png'])
+def test_renderer_latency(tmp_path, img_path: str, bbox: np.ndarray, img_format: str):
+    num_images = 20
+    for name, render_fn in [('pillow', render_max_focus_region_with_pillow),
+                            ('matplotlib', render_max_focus_region_with_matplotlib)]:
+        start = time.time()
+        for i in range(num_images):
+            render_fn(img_path=img_path,
+                      bbox=bbox,
+                      focus_text="red ball",
+                      dst=str(tmp_path / f"{name}_{i}.{img_format}"),
+                      img_format=img_format,
+                      img_quality=90)
+        logger.info(f"{name} renderer ({img_format}) took {(time.time() - start) / num_images * 1000:.1f}ms per image")
@@ -0,0 +1,56 @@
+import time
+
+from loguru import logger
+
+from backend.util.metrics import MetricsRegistry
+from backend.util.mmirs_timer import MMIRSTimer
+
+
+def test_counter_and_histogram():
+    metrics = MetricsRegistry()
+    counter = metrics.counter('test_lookups_total', 'Test lookups', label_names=('result',))
+    counter.inc(result='hit')
+    counter.inc(2, result='miss')
+    assert metrics.counter('test_lookups_total', 'Test lookups', label_names=('result',)) is counter
+    assert counter.get(result='hit') == 1 and counter.get(result='miss') == 2
+
+    hist = metrics.histogram('test_latency_seconds', 'Test latency', buckets=(0.1, 0.2, 0.5, 1.))
+    for v in [0.05] * 50 + [0.15] * 40 + [0.7] * 10:
+        hist.observe(v)
+    assert hist.get_count() == 100
+    assert 0. < hist.get_quantile(0.5) <= 0.1
+    assert 0.1 < hist.get_quantile(0.9) <= 0.2
+    assert 0.5 < hist.get_quantile(0.99) <= 1.
+
+    text = metrics.render()
+    assert '# TYPE test_lookups_total counter' in text
+    assert 'test_lookups_total{result="miss"} 2' in text
+    assert 'test_latency_seconds_bucket{le="0.2"} 90' in text
+    assert 'test_latency_seconds_bucket{le="+Inf"} 100' in text
+    assert 'test_latency_seconds_count 100' in text
+
+
+def test_timing_sessions_feed_stage_latencies():
+    metrics = MetricsRegistry()
+    timer = MMIRSTimer()
+    count = metrics.stage_duration.get_count(stage='TestStage::inner')
+
+    with timer.timing_session() as session:
+        with timer.measure('TestStage::outer'):
+            with timer.measure('TestStage::inner'):
+                time.sleep(0.01)
+    assert set(session.get_measurements()[2].keys()) == {'TestStage::outer>TestStage::inner'}
+    assert metrics.stage_duration.get_count(stage='TestStage::inner') == count + 1
+    assert metrics.stage_duration.get_quantile(0.5, stage='TestStage::inner') >= 0.005
+
+    # nothing gets measured (and observed) without a session
+    with timer.timing_session(enabled=False) as session:
+        with timer.measure('TestStage::inner'):
+            pass
+    assert session is None
+    assert metrics.stage_duration.get_count(stage='TestStage::inner') == count + 1
+
+    start = time.time()
+    text = metrics.render()
+    logger.info(f"Rendering {len(metrics.metrics)} metrics took {time.time() - start}s")
+    assert 'mmirs_stage_duration_seconds_bucket{stage="TestStage::inner",le="0.01"}' in text
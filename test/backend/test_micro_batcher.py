@@ -0,0 +1,87 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+import pytest
+from loguru import logger
+
+from backend.util.micro_batcher import MicroBatcher
+
+# simulated cost of a forward pass: a large fixed overhead and a small cost per item
+FIXED_COST = 0.02
+ITEM_COST = 0.001
+
+
+class FakeEncoder(object):
+    def __init__(self):
+        self.batches: List[Tuple[str, List[int]]] = []
+        # like a model on a single device, the encoder processes one batch at a time
+        self.device_lock = threading.Lock()
+
+    def encode_batch(self, key: str, items: List[int]) -> List[str]:
+        with self.device_lock:
+            time.sleep(FIXED_COST + ITEM_COST * len(items))
+            self.batches.append((key, items))
+        return [f"{key}_{i}" for i in items]
+
+
+def test_results_are_fanned_out():
+    encoder = FakeEncoder()
+    batcher = MicroBatcher(name='test', batch_fn=encoder.encode_batch, max_batch_size=8, max_wait_ms=50)
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        futures = [pool.submit(batcher.submit, ds, i) for i in range(16) for ds in ['coco', 'wicsmmir']]
+        results = [f.result() for f in futures]
+
+    assert results == [f"{ds}_{i}" for i in range(16) for ds in ['coco', 'wicsmmir']]
+    # items of different keys are never batched together and no batch exceeds the max batch size
+    assert sum(len(items) for _, items in encoder.batches) == 32
+    assert all(len(items) <= 8 for _, items in encoder.batches)
+    assert all(f"{key}_{i}" in results for key, items in encoder.batches for i in items)
+    logger.info(f"Processed 32 items in {len(encoder.batches)} batches")
+
+
+def test_errors_are_propagated():
+    def fail(key, items):
+        raise RuntimeError("encoding failed")
+
+    batcher = MicroBatcher(name='test_errors', batch_fn=fail, max_batch_size=4, max_wait_ms=20)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        futures = [pool.submit(batcher.submit, 'coco', i) for i in range(4)]
+        for f in futures:
+            with pytest.raises(RuntimeError):
+                f.result()
+
+
+def test_single_caller_does_not_wait():
+    encoder = FakeEncoder()
+    batcher = MicroBatcher(name='test_single', batch_fn=encoder.encode_batch, max_batch_size=16, max_wait_ms=500,
+                           concurrency=lambda: 1)
+    start = time.time()
+    assert batcher.submit('coco', 1) == 'coco_1'
+    duration = time.time() - start
+    logger.info(f"Single request took {duration * 1000:.2f}ms")
+    assert duration < 0.5
+
+
+def test_throughput_benchmark():
+    num_requests, concurrency = 64, 16
+
+    def run(submit) -> float:
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(submit, range(num_requests)))
+        return time.time() - start
+
+    encoder = FakeEncoder()
+    unbatched = run(lambda i: encoder.encode_batch('coco', [i])[0])
+
+    encoder = FakeEncoder()
+    batcher = MicroBatcher(name='test_benchmark', batch_fn=encoder.encode_batch, max_batch_size=concurrency,
+                           max_wait_ms=5, concurrency=lambda: concurrency)
+    batched = run(lambda i: batcher.submit('coco', i))
+
+    logger.info(f"{num_requests} requests (concurrency {concurrency}): unbatched {num_requests / unbatched:.1f} req/s, "
+                f"batched {num_requests / batched:.1f} req/s in {len(encoder.batches)} batches")
+    assert batched < unbatched
+    assert len(encoder.batches) < num_requests
@@ -0,0 +1,68 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from backend.util.mmirs_timer import MMIRSTimer
+
+timer = MMIRSTimer()
+
+
+def request(name: str, duration: float):
+    session = timer.start_new_timing_session()
+    timer.start_measurement(f"{name}::outer")
+    with timer.measure(f"{name}::inner"):
+        time.sleep(duration)
+    timer.stop_measurement()
+    return session.get_measurements()
+
+
+def test_concurrent_sessions_do_not_interfere():
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(request, [f"req{i}" for i in range(8)], [0.05] * 8))
+    for i, measurements in enumerate(results):
+        assert set(measurements[1].keys()) == {f"req{i}::outer"}
+        assert set(measurements[2].keys()) == {f"req{i}::outer>req{i}::inner"}
+        assert measurements[2][f"req{i}::outer>req{i}::inner"] >= 0.05
+
+
+def test_measure_decorator_and_bind():
+    @timer.measure("branch")
+    def branch(duration: float):
+        time.sleep(duration)
+        return duration
+
+    session = timer.start_new_timing_session()
+    with timer.measure("stage"):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            # the branches run in parallel threads and are nested in the current measurement
+            results = list(executor.map(timer.bind(branch), [0.05, 0.05]))
+    timer.end_timing_session()
+
+    assert results == [0.05, 0.05]
+    measurements = session.get_measurements()
+    assert set(measurements[1].keys()) == {"stage"}
+    assert set(measurements[2].keys()) == {"stage>branch"}
+    assert measurements[1]["stage"] < 0.1
+
+
+def test_no_session_overhead():
+    timer.end_timing_session()
+    n = 100_000
+    start = time.perf_counter()
+    for _ in range(n):
+        timer.start_measurement("noop")
+        timer.stop_measurement()
+    no_session = time.perf_counter() - start
+
+    timer.start_new_timing_session()
+    start = time.perf_counter()
+    for _ in range(n):
+        timer.start_measurement("measurement")
+        timer.stop_measurement()
+    with_session = time.perf_counter() - start
+    timer.end_timing_session()
+
+    logger.info(f"Measuring without session took {no_session / n * 1e9:.0f}ns, "
+                f"with session {with_session / n * 1e9:.0f}ns per measurement")
+    assert timer.get_current_timing_session() is None
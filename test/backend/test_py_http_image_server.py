@@ -0,0 +1,122 @@
+import os
+import time
+import urllib.parse as url
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
+
+import pytest
+from loguru import logger
+
+from backend.util.render_cache import RenderCache
+from backend.imgserver.py_http_image_server import PyHttpImageServer
+
+
+def render(image_id: str, dst: str) -> Tuple[str, str, str]:
+    time.sleep(0.2)
+    with open(dst, 'wb') as f:
+        f.write(image_id.encode('utf-8'))
+    return image_id, dst, 'anno'
+
+
+@pytest.fixture
+def img_srv() -> PyHttpImageServer:
+    return PyHttpImageServer()
+
+
+def test_lazy_rendering(tmp_path, img_srv: PyHttpImageServer):
+    cache = RenderCache(cache_dir=str(tmp_path / "annotated"))
+    img_srv.register_artifact_dir(name='test_annotated', artifact_dir=cache.cache_dir)
+
+    pool = ThreadPoolExecutor(max_workers=2)
+    num_renders = []
+
+    def submit(fn, **kwargs):
+        num_renders.append(kwargs['image_id'])
+        return pool.submit(fn, **kwargs)
+
+    dst = cache.get_path('123', 'annotated', RenderCache.compute_key('123', "red ball"), 'jpg')
+    start = time.time()
+    img_srv.register_pending_artifact(artifact_path=dst,
+                                      render=lambda: submit(render, image_id='123', dst=dst),
+                                      on_rendered=cache.add)
+    img_url = img_srv.get_artifact_url(dst)
+    logger.info(f"Registering the pending artifact took {time.time() - start}s")
+
+    # nothing gets rendered until the URL is requested
+    assert not os.path.exists(dst)
+    assert url.urlsplit(img_url).path.endswith(f"test_annotated/{os.path.basename(dst)}")
+
+    start = time.time()
+    with urllib.request.urlopen(img_url) as resp:
+        assert resp.read() == b'123'
+    logger.info(f"First request (incl. rendering) took {time.time() - start}s")
+
+    start = time.time()
+    with urllib.request.urlopen(img_url) as resp:
+        assert resp.read() == b'123'
+    logger.info(f"Second request (cached) took {time.time() - start}s")
+
+    assert num_renders == ['123']
+    assert cache.size_bytes == 3
+    pool.shutdown()
+
+
+def test_timed_out_rendering_is_not_submitted_again(tmp_path, img_srv: PyHttpImageServer):
+    cache = RenderCache(cache_dir=str(tmp_path / "annotated"))
+    img_srv.register_artifact_dir(name='test_annotated_timeout', artifact_dir=cache.cache_dir)
+
+    pool = ThreadPoolExecutor(max_workers=2)
+    num_renders = []
+
+    def submit(fn, **kwargs):
+        num_renders.append(kwargs['image_id'])
+        return pool.submit(fn, **kwargs)
+
+    dst = cache.get_path('456', 'annotated', RenderCache.compute_key('456', "red ball"), 'jpg')
+    img_srv.register_pending_artifact(artifact_path=dst,
+                                      render=lambda: submit(render, image_id='456', dst=dst),
+                                      on_rendered=cache.add)
+    rel_path = f"test_annotated_timeout/{os.path.basename(dst)}"
+
+    render_timeout = img_srv.render_timeout
+    img_srv.render_timeout = 0.05
+    try:
+        # the first request times out while the task keeps running
+        assert not img_srv.render_pending_artifact(rel_path)
+        # the next request waits for the same task
+        img_srv.render_timeout = render_timeout
+        assert img_srv.render_pending_artifact(rel_path)
+    finally:
+        img_srv.render_timeout = render_timeout
+
+    assert num_renders == ['456']
+    assert os.path.isfile(dst)
+    pool.shutdown()
+
+
+def test_virtual_image_urls(img_srv: PyHttpImageServer):
+    for dataset, ds in img_srv.datasources.items():
+        fns = [fn for fn in os.listdir(ds.images_root)
+               if fn.startswith(ds.image_prefix) and fn.endswith(ds.image_suffix)]
+        if len(fns) == 0:
+            continue
+        img_id = fns[0][len(ds.image_prefix):len(fns[0]) - len(ds.image_suffix)]
+        img_url = img_srv.get_img_url(img_id, dataset)
+        assert url.urlsplit(img_url).path.endswith(f"/{dataset}/{img_id}")
+        assert PyHttpImageServer.get_image_id(img_url) == img_id
+        assert img_srv.resolve_path(url.urlsplit(img_url).path) == ds.get_image_path(img_id)
+
+        if img_srv.thumbnail_cache is not None:
+            thumb_url = img_srv.get_img_url(img_id, dataset, width=200)
+            assert url.urlsplit(thumb_url).query == f"w={img_srv.thumbnail_cache.get_width(200)}"
+            assert PyHttpImageServer.get_image_id(thumb_url) == img_id
+            thumb_path = img_srv.resolve_path(url.urlsplit(thumb_url).path, url.urlsplit(thumb_url).query)
+            assert thumb_path == img_srv.thumbnail_cache.get_thumbnail_path(dataset, img_id, img_srv.thumbnail_cache.get_width(200))
+
+        with urllib.request.urlopen(img_url) as resp:
+            with open(ds.get_image_path(img_id), 'rb') as f:
+                assert resp.read() == f.read()
+
+    assert img_srv.resolve_path("/unknown/123") is None
+    assert img_srv.resolve_path("/../etc/passwd") is None
@@ -0,0 +1,58 @@
+import os
+import time
+
+import numpy as np
+
+from backend.util.render_cache import RenderCache
+from backend.imgserver.py_http_image_server import PyHttpImageServer
+
+
+def write_file(path: str, size: int):
+    tmp = RenderCache.get_tmp_path(path)
+    with open(tmp, 'wb') as f:
+        f.write(b'\0' * size)
+    os.replace(tmp, path)
+
+
+def test_compute_key():
+    wra = np.random.rand(36, 10).astype(np.float32)
+    key = RenderCache.compute_key('123', 'coco', 3, "red ball", wra)
+    assert key == RenderCache.compute_key('123', 'coco', 3, "red ball", wra.copy())
+    assert key != RenderCache.compute_key('123', 'coco', 3, "blue ball", wra)
+    assert key != RenderCache.compute_key('123', 'coco', 4, "red ball", wra)
+    assert key != RenderCache.compute_key('123', 'coco', 3, "red ball", wra + 1)
+
+
+def test_lookup_and_lru_eviction(tmp_path):
+    cache = RenderCache(cache_dir=str(tmp_path), max_size_mb=1.)
+    size = 300 * 1024
+
+    paths = [cache.get_path(str(i), 'annotated', RenderCache.compute_key(i), 'jpg') for i in range(3)]
+    for p in paths:
+        assert not cache.lookup(p)
+        write_file(p, size)
+        cache.add(p)
+        # make sure that the mtimes differ
+        time.sleep(0.05)
+
+    # mark the first file as recently used
+    assert cache.lookup(paths[0])
+    time.sleep(0.05)
+
+    # exceeds the budget -> the least recently used file gets evicted
+    p = cache.get_path('3', 'annotated', RenderCache.compute_key(3), 'jpg')
+    write_file(p, size)
+    cache.add(p)
+
+    assert cache.lookup(paths[0])
+    assert not os.path.exists(paths[1])
+    assert cache.lookup(paths[2])
+    assert cache.lookup(p)
+    assert cache.size_bytes <= cache.max_size_bytes
+
+
+def test_get_image_id():
+    assert PyHttpImageServer.get_image_id("http://localhost:8080/annotated/123_annotated_0a1b2c3d4e5f6a7b.jpg") == '123'
+    assert PyHttpImageServer.get_image_id("http://localhost:8080/wra/123_wra_0a1b2c3d4e5f6a7b.png") == '123'
+    assert PyHttpImageServer.get_image_id("http://localhost:8080/123_annotated.png") == '123'
+    assert PyHttpImageServer.get_image_id("http://localhost:8080/123.jpg") == '123'
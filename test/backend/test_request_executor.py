@@ -0,0 +1,67 @@
+import asyncio
+import time
+
+import pytest
+from loguru import logger
+
+from backend.util.request_executor import RequestExecutor, RequestRejectedError
+
+
+def work(duration: float) -> float:
+    time.sleep(duration)
+    return duration
+
+
+@pytest.fixture
+def executor() -> RequestExecutor:
+    executor = RequestExecutor()
+    max_queue_size = executor.max_queue_size
+    executor.max_queue_size = 2
+    yield executor
+    executor.max_queue_size = max_queue_size
+
+
+def test_admission_control(executor: RequestExecutor):
+    async def run():
+        # max_workers running + 2 queued requests get admitted, the next one is rejected
+        tasks = [asyncio.ensure_future(executor.run(work, 0.2)) for _ in range(executor.max_workers + 2)]
+        await asyncio.sleep(0.01)
+        with pytest.raises(RequestRejectedError):
+            await executor.run(work, 0.2)
+        return await asyncio.gather(*tasks)
+
+    start = time.time()
+    assert asyncio.get_event_loop().run_until_complete(run()) == [0.2] * (executor.max_workers + 2)
+    logger.info(f"Running {executor.max_workers + 2} requests took {time.time() - start}s")
+    assert executor.num_pending == 0
+
+
+def test_timeout(executor: RequestExecutor):
+    async def run():
+        running = asyncio.ensure_future(executor.run(work, 0.5))
+        await asyncio.sleep(0.01)
+        # the request times out (and gets cancelled if it is still queued)
+        with pytest.raises(asyncio.TimeoutError):
+            await executor.run(work, 0.1, timeout=0.05)
+        return await running
+
+    assert asyncio.get_event_loop().run_until_complete(run()) == 0.5
+    assert executor.num_pending == 0
+
+
+def test_event_loop_stays_responsive(executor: RequestExecutor):
+    async def heartbeat_latency() -> float:
+        start = time.time()
+        await asyncio.sleep(0)
+        return time.time() - start
+
+    async def run():
+        request = asyncio.ensure_future(executor.run(work, 0.5))
+        await asyncio.sleep(0.05)
+        latency = await heartbeat_latency()
+        await request
+        return latency
+
+    latency = asyncio.get_event_loop().run_until_complete(run())
+    logger.info(f"Event loop latency while a request is running: {latency * 1000:.2f}ms")
+    assert latency < 0.05
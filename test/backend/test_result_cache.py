@@ -0,0 +1,92 @@
+import os
+import time
+
+import pytest
+from loguru import logger
+
+from backend.util.result_cache import ResultCache, _MemoryStore, _SqliteStore, _stat_data_path, DATA_VERSION_MARKER
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def cache(request, tmp_path) -> ResultCache:
+    cache = ResultCache()
+    store, ttl, max_entries = cache.store, cache.ttl, cache.max_entries
+    if request.param == 'memory':
+        cache.store = _MemoryStore(max_entries=3)
+    else:
+        cache.store = _SqliteStore(path=str(tmp_path / 'result_cache.sqlite'), max_entries=3)
+    cache.ttl = 1
+    cache.data_versions[('coco', 'teran_coco')] = (time.time(), 'v1')
+    yield cache
+    cache.store, cache.ttl, cache.max_entries = store, ttl, max_entries
+    cache.data_versions.clear()
+
+
+def test_compute_key(cache: ResultCache):
+    params = {'context': 'A brown dog is playing with a red ball', 'focus': 'dog', 'top_k': 10}
+    key = cache.compute_key('top_k_images', params, dataset='coco', retriever='teran_coco')
+    # the key does not depend on the order of the parameters
+    assert key == cache.compute_key('top_k_images', dict(reversed(list(params.items()))),
+                                    dataset='coco', retriever='teran_coco')
+    assert key != cache.compute_key('top_k_images', {**params, 'top_k': 100}, dataset='coco', retriever='teran_coco')
+
+    # a new version of the data (e.g. a rebuilt index) invalidates the results
+    cache.data_versions[('coco', 'teran_coco')] = (time.time(), 'v2')
+    assert key != cache.compute_key('top_k_images', params, dataset='coco', retriever='teran_coco')
+
+
+def test_lru_eviction_and_ttl(cache: ResultCache):
+    for i in range(3):
+        cache.put(f"key_{i}", media_type='application/json', body=f'["url_{i}"]'.encode('utf-8'))
+    # access key_0 so that key_1 is the least recently used result
+    time.sleep(0.01)
+    assert cache.get('key_0') == ('application/json', b'["url_0"]')
+    cache.put('key_3', media_type='application/json', body=b'["url_3"]')
+    assert len(cache) == 3
+    assert cache.get('key_1') is None
+    assert cache.get('key_0') is not None
+
+    # the results expire after the ttl
+    time.sleep(1.1)
+    assert cache.get('key_3') is None
+
+
+def test_lookup_latency(cache: ResultCache):
+    body = b'x' * 2048
+    cache.put('key', media_type='application/json', body=body)
+    n = 1000
+    start = time.time()
+    for _ in range(n):
+        assert cache.get('key') == ('application/json', body)
+    logger.info(f"{type(cache.store).__name__} lookup took {(time.time() - start) / n * 1e6:.2f}us")
+
+
+def test_version_of_a_directory_only_stats_the_marker(tmp_path):
+    feats_root = tmp_path / 'feats'
+    feats_root.mkdir()
+    feats = feats_root / 'feats_0.npy'
+    feats.write_bytes(b'v1')
+    version = _stat_data_path(str(feats_root))
+
+    # the files in the directory are not scanned, i.e., rewriting them in place does not change the version
+    time.sleep(0.01)
+    feats.write_bytes(b'v2 with another size')
+    assert _stat_data_path(str(feats_root)) == version
+
+    # the rebuild touches the marker
+    (feats_root / DATA_VERSION_MARKER).touch()
+    marked_version = _stat_data_path(str(feats_root))
+    assert marked_version != version
+    time.sleep(0.01)
+    os.utime(feats_root / DATA_VERSION_MARKER)
+    assert _stat_data_path(str(feats_root)) != marked_version
+    assert _stat_data_path(str(tmp_path / 'missing')).endswith(':missing')
+
+
+def test_concurrent_requests_do_not_wait_for_the_version_check(cache: ResultCache):
+    # the version is outdated and another thread is re-checking it
+    cache.data_versions[('coco', 'teran_coco')] = (0., 'v1')
+    with cache.version_lock:
+        start = time.time()
+        assert cache.get_data_version('coco', 'teran_coco') == 'v1'
+        assert time.time() - start < 0.1
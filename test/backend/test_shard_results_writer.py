@@ -0,0 +1,45 @@
+import time
+
+import pandas as pd
+from loguru import logger
+
+from backend.util.shard_results_writer import ShardResultsWriter
+
+
+def test_append_resume_and_merge(tmp_path):
+    parts_dir = str(tmp_path / 'results.parts')
+    df = pd.DataFrame({'caption': [f"caption {i}" for i in range(10)], 'dataset': ['coco'] * 10})
+
+    # shard 0 crashes after persisting 2 of its 5 samples (the buffered 3rd result is lost)
+    writer = ShardResultsWriter(parts_dir, shard_id=0, persist_step=2)
+    for idx in [0, 2, 4]:
+        writer.append(idx, [f"img_{idx}"])
+    assert len(ShardResultsWriter.get_part_files(parts_dir)) == 1
+
+    # the resumed shard skips the persisted samples
+    writer = ShardResultsWriter(parts_dir, shard_id=0, persist_step=2)
+    todo = [idx for idx in range(0, len(df), 2) if not writer.is_done(idx)]
+    assert todo == [4, 6, 8]
+    for idx in todo:
+        writer.append(idx, [f"img_{idx}"])
+    writer.close()
+
+    writer = ShardResultsWriter(parts_dir, shard_id=1, persist_step=2)
+    for idx in range(1, len(df), 2):
+        writer.append(idx, [f"img_{idx}", f"img_{idx + 1}"])
+    writer.close()
+
+    merged = ShardResultsWriter.merge(parts_dir, df)
+    assert merged['caption'].tolist() == df['caption'].tolist()
+    assert merged['top_k'][4] == ['img_4'] and merged['top_k'][5] == ['img_5', 'img_6']
+
+
+def test_append_throughput(tmp_path):
+    writer = ShardResultsWriter(str(tmp_path / 'results.parts'), persist_step=1000)
+    n = 10000
+    start = time.time()
+    for idx in range(n):
+        writer.append(idx, [f"img_{i}" for i in range(10)])
+    writer.close()
+    logger.info(f"Appending {n} results took {time.time() - start:.2f}s ({writer.samples_per_sec:.2f} samples/sec)")
+    assert len(ShardResultsWriter.get_part_files(writer.parts_dir)) == 10
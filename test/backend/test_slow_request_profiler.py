@@ -0,0 +1,64 @@
+import json
+import os
+import time
+
+import pytest
+from loguru import logger
+
+from backend.util.slow_request_profiler import SlowRequestProfiler
+
+
+def early_stage(duration: float):
+    time.sleep(duration)
+
+
+def slow_stage(duration: float):
+    time.sleep(duration)
+
+
+@pytest.fixture
+def profiler(tmp_path) -> SlowRequestProfiler:
+    profiler = SlowRequestProfiler()
+    enabled, threshold, profiles_dir = profiler.enabled, profiler.threshold, profiler.profiles_dir
+    profiler.enabled, profiler.threshold, profiler.profiles_dir = True, 0.05, str(tmp_path / "profiles")
+    profiler.start_watchdog()
+    yield profiler
+    profiler.enabled, profiler.threshold, profiler.profiles_dir = enabled, threshold, profiles_dir
+
+
+def test_slow_request_gets_profiled(profiler: SlowRequestProfiler):
+    with profiler.profile(name='top_k_images', params={'context': 'a red ball', 'top_k': 10}):
+        slow_stage(0.5)
+
+    files = sorted(os.listdir(profiler.profiles_dir))
+    assert len(files) == 2 and files[0].endswith('top_k_images.collapsed') and files[1].endswith('top_k_images.json')
+    with open(os.path.join(profiler.profiles_dir, files[1])) as f:
+        meta = json.load(f)
+    assert meta['params'] == {'context': 'a red ball', 'top_k': 10}
+    assert meta['duration'] >= 0.5 and meta['num_samples'] > 0
+    with open(os.path.join(profiler.profiles_dir, files[0])) as f:
+        stacks = f.read()
+    assert 'slow_stage' in stacks
+
+
+def test_profile_covers_the_stages_before_the_threshold(profiler: SlowRequestProfiler):
+    profiler.threshold = 0.3
+    with profiler.profile(name='top_k_images'):
+        # the early stage finishes before the request exceeds the threshold
+        early_stage(0.2)
+        slow_stage(0.2)
+
+    collapsed = [fn for fn in os.listdir(profiler.profiles_dir) if fn.endswith('.collapsed')]
+    with open(os.path.join(profiler.profiles_dir, collapsed[0])) as f:
+        stacks = f.read()
+    assert 'early_stage' in stacks and 'slow_stage' in stacks
+
+
+def test_fast_request_overhead(profiler: SlowRequestProfiler):
+    n = 10_000
+    start = time.perf_counter()
+    for _ in range(n):
+        with profiler.profile(name='fast', params={}):
+            pass
+    logger.info(f"Profiling a fast request costs {(time.perf_counter() - start) / n * 1e6:.2f}us")
+    assert not os.path.exists(profiler.profiles_dir)
@@ -0,0 +1,61 @@
+import time
+
+import numpy as np
+import pytest
+import torch
+from loguru import logger
+
+from backend.fineselection.data import TeranImageEmbeddingsMemmap
+from backend.fineselection.retriever import TeranFullScanEngine
+from backend.fineselection.retriever.teran_full_scan_engine import compute_mrsw_scores, pad_query_embeddings
+
+
+@pytest.fixture
+def memmap(tmp_path) -> TeranImageEmbeddingsMemmap:
+    embs_file, ids_file = TeranImageEmbeddingsMemmap.get_file_paths(str(tmp_path), 'wicsmmir', 'teran_wicsmmir')
+    embs = np.random.rand(5000, 37, 64).astype(np.float32)
+    np.save(embs_file, embs)
+    np.save(ids_file, np.array([str(i) for i in range(len(embs))]))
+    return TeranImageEmbeddingsMemmap(embs_file=embs_file, ids_file=ids_file)
+
+
+@pytest.fixture
+def queries() -> tuple:
+    query_embs = [torch.rand(1, ql, 64) for ql in [12, 7, 20]]
+    return pad_query_embeddings(query_embs), [qe.shape[1] for qe in query_embs]
+
+
+def test_padded_tokens_do_not_contribute(memmap: TeranImageEmbeddingsMemmap, queries: tuple):
+    query_embs, query_lengths = queries
+    img_embs = torch.from_numpy(np.array(memmap.get_block(0, 100)))
+
+    batch_scores = compute_mrsw_scores(img_embs, query_embs, query_lengths)
+    for i, ql in enumerate(query_lengths):
+        single_scores = compute_mrsw_scores(img_embs, query_embs[i:i + 1, :ql], [ql])
+        assert torch.allclose(batch_scores[i], single_scores[0], atol=1e-4)
+
+
+@pytest.mark.parametrize("block_size", [100, 1024, 10000])
+def test_find_top_k_images_equals_exhaustive_search(memmap: TeranImageEmbeddingsMemmap,
+                                                    queries: tuple,
+                                                    block_size: int):
+    query_embs, query_lengths = queries
+    top_k = 10
+    engine = TeranFullScanEngine(memmap=memmap, block_size=block_size)
+
+    start = time.time()
+    top_k_image_ids = engine.find_top_k_images(query_embs, query_lengths, top_k)
+    logger.debug(f"Full scan with block size {block_size} took {time.time() - start}s")
+
+    scores = compute_mrsw_scores(torch.from_numpy(np.array(memmap.embs)), query_embs, query_lengths)
+    for q_scores, q_top_k in zip(scores, top_k_image_ids):
+        expected = memmap.get_image_ids(torch.argsort(q_scores, descending=True)[:top_k].tolist())
+        assert q_top_k == expected
+
+
+def test_scan_does_not_change_the_threads_of_the_process(memmap: TeranImageEmbeddingsMemmap, queries: tuple):
+    num_threads = torch.get_num_threads()
+    engine = TeranFullScanEngine(memmap=memmap, num_threads=1)
+    assert torch.get_num_threads() == num_threads
+    engine.find_top_k_images(*queries, top_k=10)
+    assert torch.get_num_threads() == num_threads
@@ -0,0 +1,51 @@
+import time
+
+import pytest
+import torch
+from loguru import logger
+
+from backend.fineselection.data import ImageFeaturePoolFactory
+from backend.fineselection.retriever import RetrieverFactory
+from backend.fineselection.retriever.teran_retriever import TeranRetriever
+from backend.preselection import PreselectionStage
+
+CONTEXTS = ["A brown dog is playing with a red ball.",
+            "Two people ride their bikes.",
+            "A man in a blue shirt is standing in front of a large building next to a parked car."]
+FOCUSES = ["red ball", "bikes", "blue shirt"]
+
+
+@pytest.fixture
+def retriever() -> TeranRetriever:
+    return RetrieverFactory().create_or_get_retriever('teran_coco')
+
+
+def test_batched_query_embeddings_match_single_queries(retriever: TeranRetriever):
+    start = time.time()
+    query_embs, query_lengths = retriever.compute_query_embeddings(CONTEXTS)
+    logger.info(f"Encoding {len(CONTEXTS)} contexts in a batch took {time.time() - start}s")
+
+    start = time.time()
+    for i, context in enumerate(CONTEXTS):
+        qe, ql = retriever.query_encoder.compute_query_embedding(context)
+        qe = qe.squeeze(0).to(query_embs.device)
+        assert query_lengths[i] == ql[0]
+        assert torch.allclose(query_embs[i, :ql[0]], qe, atol=1e-4)
+        # the padded tokens are zero
+        assert torch.count_nonzero(query_embs[i, ql[0]:]) == 0
+    logger.info(f"Encoding {len(CONTEXTS)} contexts one after another took {time.time() - start}s")
+
+
+def test_batched_rankings_match_single_queries(retriever: TeranRetriever):
+    pss = PreselectionStage()
+    preselected = pss.retrieve_relevant_images(focus=FOCUSES[0], context=CONTEXTS[0], dataset='coco')
+    pool = ImageFeaturePoolFactory().create_or_get_pool(source_dataset='coco', retriever_name='teran_coco')
+    iss = pool.get_image_search_space(preselected)
+
+    batched = retriever.find_top_k_images_batch(focuses=FOCUSES, contexts=CONTEXTS, top_k=10, iss=iss,
+                                                return_separated_ranks=True)
+    for focus, context, result in zip(FOCUSES, CONTEXTS, batched):
+        single = retriever.find_top_k_images(focus=focus, context=context, top_k=10, iss=iss,
+                                             return_separated_ranks=True)
+        for ranking in ['context', 'focus', 'combined']:
+            assert list(result['top_k'][ranking]) == list(single['top_k'][ranking])
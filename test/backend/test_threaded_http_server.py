@@ -0,0 +1,134 @@
+import http.client
+import os
+import socketserver
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple, List, Callable, Optional
+
+import numpy as np
+import pytest
+from loguru import logger
+
+from backend.imgserver.py_http_image_server import handler_from
+from backend.imgserver.threaded_http_server import ThreadingImageHTTPServer, create_handler, parse_range
+
+
+@pytest.fixture
+def root_dir(tmp_path) -> str:
+    for i in range(50):
+        with open(str(tmp_path / f"{i}.jpg"), 'wb') as f:
+            f.write(os.urandom(200 * 1024))
+    return str(tmp_path)
+
+
+def start_server(server: socketserver.TCPServer) -> Tuple[str, int]:
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[0], server.server_address[1]
+
+
+def resolver(root_dir: str) -> Callable[[str, str], Optional[str]]:
+    return lambda url_path, query='': os.path.join(root_dir, url_path.strip('/'))
+
+
+@pytest.fixture
+def threaded_server(root_dir: str):
+    server = ThreadingImageHTTPServer(('localhost', 0), create_handler(resolver(root_dir), cache_max_age=60))
+    yield start_server(server)
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def simple_server(root_dir: str):
+    server = socketserver.TCPServer(('localhost', 0), handler_from(resolver(root_dir)))
+    yield start_server(server)
+    server.shutdown()
+    server.server_close()
+
+
+def test_parse_range():
+    assert parse_range("bytes=0-499", 1000) == (0, 499)
+    assert parse_range("bytes=500-", 1000) == (500, 999)
+    assert parse_range("bytes=-200", 1000) == (800, 999)
+    assert parse_range("bytes=900-2000", 1000) == (900, 999)
+    assert parse_range("bytes=1000-", 1000) is None
+    assert parse_range("bytes=500-100", 1000) is None
+    assert parse_range("bytes=-", 1000) is None
+    assert parse_range("items=0-1", 1000) is None
+
+
+def test_conditional_and_range_requests(root_dir: str, threaded_server: Tuple[str, int]):
+    with open(os.path.join(root_dir, "0.jpg"), 'rb') as f:
+        content = f.read()
+
+    conn = http.client.HTTPConnection(*threaded_server)
+    conn.request('GET', '/0.jpg')
+    resp = conn.getresponse()
+    assert resp.status == 200
+    assert resp.read() == content
+    assert resp.getheader('Content-Type') == 'image/jpeg'
+    assert resp.getheader('Accept-Ranges') == 'bytes'
+    assert resp.getheader('Cache-Control') == 'public, max-age=60'
+    etag = resp.getheader('ETag')
+    last_modified = resp.getheader('Last-Modified')
+
+    # the connection is kept alive
+    conn.request('GET', '/0.jpg', headers={'If-None-Match': etag})
+    resp = conn.getresponse()
+    assert resp.status == 304
+    assert resp.read() == b''
+
+    conn.request('GET', '/0.jpg', headers={'If-Modified-Since': last_modified})
+    resp = conn.getresponse()
+    assert resp.status == 304
+    resp.read()
+
+    conn.request('GET', '/0.jpg', headers={'Range': 'bytes=100-199'})
+    resp = conn.getresponse()
+    assert resp.status == 206
+    assert resp.getheader('Content-Range') == f'bytes 100-199/{len(content)}'
+    assert resp.read() == content[100:200]
+
+    conn.request('GET', '/0.jpg', headers={'Range': f'bytes={len(content)}-'})
+    resp = conn.getresponse()
+    assert resp.status == 416
+    resp.read()
+
+    conn.request('GET', '/missing.jpg')
+    resp = conn.getresponse()
+    assert resp.status == 404
+    resp.read()
+    conn.close()
+
+
+def run_load(address: Tuple[str, int], num_clients: int, requests_per_client: int) -> Tuple[float, float]:
+    def client(cid: int) -> List[float]:
+        latencies = []
+        conn = http.client.HTTPConnection(*address)
+        for i in range(requests_per_client):
+            start = time.time()
+            conn.request('GET', f'/{(cid + i) % 50}.jpg')
+            resp = conn.getresponse()
+            resp.read()
+            # the single-threaded server closes the connection after every request (HTTP/1.0)
+            if resp.will_close:
+                conn.close()
+                conn = http.client.HTTPConnection(*address)
+            latencies.append(time.time() - start)
+        conn.close()
+        return latencies
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=num_clients) as executor:
+        latencies = [lat for lats in executor.map(client, range(num_clients)) for lat in lats]
+    duration = time.time() - start
+    return len(latencies) / duration, float(np.percentile(latencies, 99))
+
+
+def test_load_benchmark(simple_server: Tuple[str, int], threaded_server: Tuple[str, int]):
+    num_clients, requests_per_client = 10, 50
+    for name, address in [('SimpleHTTPRequestHandler', simple_server), ('threaded', threaded_server)]:
+        rps, p99 = run_load(address, num_clients, requests_per_client)
+        logger.info(f"{name} server: {rps:.1f} requests/s, p99 latency {p99 * 1000:.1f}ms "
+                    f"({num_clients} clients with {requests_per_client} requests each)")
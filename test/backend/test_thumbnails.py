@@ -0,0 +1,75 @@
+import os
+import time
+
+import numpy as np
+from PIL import Image
+from loguru import logger
+
+from backend.imgserver.thumbnails import ThumbnailCache, create_thumbnail
+
+
+def create_image(path: str, width: int = 2048, height: int = 1536):
+    rng = np.random.default_rng(42)
+    Image.fromarray(rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)).save(path, quality=90)
+
+
+def test_create_thumbnail(tmp_path):
+    src = str(tmp_path / "src.jpg")
+    create_image(src)
+
+    dst = str(tmp_path / "thumb.jpg")
+    create_thumbnail(src, dst, width=256)
+    with Image.open(dst) as im:
+        assert im.size == (256, 192)
+        assert im.format == 'JPEG'
+
+    # images are never upscaled
+    create_thumbnail(dst, str(tmp_path / "thumb_large.jpg"), width=512)
+    with Image.open(str(tmp_path / "thumb_large.jpg")) as im:
+        assert im.size == (256, 192)
+
+
+def test_thumbnail_cache(tmp_path):
+    src = str(tmp_path / "src.jpg")
+    create_image(src)
+    cache = ThumbnailCache(cache_dir=str(tmp_path / "thumbnails"), widths=[512, 128, 256], max_size_mb=1)
+
+    assert cache.get_width(1) == 128
+    assert cache.get_width(200) == 256
+    assert cache.get_width(256) == 256
+    assert cache.get_width(4096) == 512
+
+    thumb = cache.get_or_create('coco', '123', src, 200)
+    assert thumb == cache.get_thumbnail_path('coco', '123', 256)
+    mtime = os.stat(thumb).st_mtime_ns
+    # cache hit
+    assert cache.get_or_create('coco', '123', src, 256) == thumb
+    with Image.open(thumb) as im:
+        assert im.width == 256
+    assert cache.render_cache.size_bytes == os.path.getsize(thumb)
+    assert os.stat(thumb).st_mtime_ns >= mtime
+
+    assert cache.get_or_create('coco', 'missing', str(tmp_path / "missing.jpg"), 256) is None
+
+
+def test_draft_mode_benchmark(tmp_path):
+    src = str(tmp_path / "src.jpg")
+    create_image(src)
+    n = 20
+
+    start = time.time()
+    for i in range(n):
+        create_thumbnail(src, str(tmp_path / f"draft_{i}.jpg"), width=256)
+    draft_time = time.time() - start
+
+    start = time.time()
+    for i in range(n):
+        with Image.open(src) as im:
+            im = im.convert('RGB').resize((256, 192), Image.LANCZOS)
+        im.save(str(tmp_path / f"full_{i}.jpg"), quality=85)
+    full_time = time.time() - start
+
+    logger.info(f"Creating {n} thumbnails with draft mode took {draft_time}s")
+    logger.info(f"Creating {n} thumbnails with full decoding took {full_time}s")
+    logger.info(f"Size of original: {os.path.getsize(src)} bytes, "
+                f"size of thumbnail: {os.path.getsize(str(tmp_path / 'draft_0.jpg'))} bytes")
@@ -0,0 +1,37 @@
+import pytest
+
+from backend.fineselection.retriever.tokenization_context import find_sub_list, find_focus_span, TokenizationContext
+
+
+def test_find_sub_list():
+    assert find_sub_list([3], [1, 2, 3, 4]) == (2, 2)
+    assert find_sub_list([2, 3], [1, 2, 3, 4]) == (1, 2)
+    assert find_sub_list([1, 2, 3, 4], [1, 2, 3, 4]) == (0, 3)
+
+    with pytest.raises(ValueError):
+        find_sub_list([3, 2], [1, 2, 3, 4])
+    with pytest.raises(ValueError):
+        find_sub_list([], [1, 2, 3, 4])
+
+
+def test_find_focus_span_with_repeated_tokens():
+    # "a red car and a red ball" with focus "red ball"
+    ctx = [1, 10, 20, 30, 1, 10, 40]
+    assert find_focus_span([10, 40], ctx) == (5, 6)
+    # "red" occurs twice, the first occurrence is used
+    assert find_focus_span([10], ctx) == (1, 1)
+
+
+def test_find_focus_span_fallback():
+    # the focus is not a contiguous sub-list of the context
+    assert find_focus_span([10, 40], [1, 10, 20, 40]) == (1, 3)
+    with pytest.raises(ValueError):
+        find_focus_span([50], [1, 10, 20, 40])
+
+
+def test_tokenization_context():
+    tok_ctx = TokenizationContext(context_tokens=['a', 'red', 'car', 'and', 'a', 'red', 'ball'],
+                                  context_token_ids=[1, 10, 20, 30, 1, 10, 40],
+                                  focus_tokens=['red', 'ball'],
+                                  focus_token_ids=[10, 40])
+    assert tok_ctx.focus_span == (5, 6)
@@ -0,0 +1,37 @@
+import json
+import time
+
+import numpy as np
+from loguru import logger
+
+from backend.util.wra_payload import encode_wra_payload, decode_wra_payload
+
+
+def test_wra_payload_roundtrip():
+    rng = np.random.default_rng(42)
+    wra_matrices = rng.standard_normal((10, 36, 12)).astype(np.float32)
+    img_urls = [f"http://localhost:10162/coco/{i:06d}" for i in range(10)]
+    context_tokens = [f"token{i}" for i in range(13)]
+
+    start = time.time()
+    payload = encode_wra_payload(image_urls=img_urls,
+                                 wra_matrices=wra_matrices,
+                                 context_tokens=context_tokens,
+                                 focus_span=(2, 3),
+                                 max_focus_region_indices=list(range(10)),
+                                 timings={'MMIRS::top_k_images': 0.1})
+    logger.info(f"Encoding the WRA payload took {time.time() - start}s")
+
+    decoded = decode_wra_payload(payload)
+    assert decoded['image_urls'] == img_urls
+    assert decoded['wra'].dtype == np.float16 and decoded['wra'].shape == (10, 36, 12)
+    assert np.allclose(decoded['wra'], wra_matrices, atol=1e-2)
+    # FIXME LAST TOKEN MISSING, i.e., one token per column of the wras
+    assert decoded['context_tokens'] == context_tokens[:12]
+    assert decoded['focus_span'].tolist() == [2, 3]
+    assert decoded['max_focus_region_indices'].tolist() == list(range(10))
+    assert decoded['timings'] == {'MMIRS::top_k_images': 0.1}
+
+    json_size = len(json.dumps({'urls': img_urls, 'wra': wra_matrices.tolist()}).encode('utf-8'))
+    logger.info(f"Size of the npz payload: {len(payload)} bytes, size as JSON: {json_size} bytes")
+    assert len(payload) < json_size
@@ -0,0 +1,95 @@
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+from loguru import logger
+
+from backend.fineselection.plot.wra_plotter import WRAPlotter, plot_wra, render_wra_sprite, \
+    compute_wra_sprite_layout, colorize_wras, MAX_FOCUS_REGION_COLOR
+
+
+@pytest.fixture
+def wra_matrices() -> np.ndarray:
+    rng = np.random.default_rng(42)
+    return rng.standard_normal((10, 36, 12)).astype(np.float32)
+
+
+@pytest.fixture
+def context_tokens():
+    return [f"token{i}" for i in range(13)]  # FIXME LAST TOKEN MISSING (see plot_wra)
+
+
+def test_colorize_wras(wra_matrices: np.ndarray):
+    rgb = colorize_wras(wra_matrices)
+    assert rgb.shape == (10, 36, 12, 3) and rgb.dtype == np.uint8
+    # every wra is normalized by its own min and max, i.e., the min is dark purple and the max is yellow
+    for wra, wra_rgb in zip(wra_matrices, rgb):
+        mn, mx = np.unravel_index(wra.argmin(), wra.shape), np.unravel_index(wra.argmax(), wra.shape)
+        assert tuple(wra_rgb[mn]) == (68, 1, 84)
+        assert tuple(wra_rgb[mx]) == (253, 231, 37)
+
+
+def test_render_wra_sprite(tmp_path, wra_matrices: np.ndarray):
+    cell_size_px = 10
+    mfris = list(range(10))
+    dst = str(tmp_path / "sprite.png")
+    _, path, task = render_wra_sprite(wra_matrices, mfris, (2, 3), cell_size_px, dst)
+    assert path == dst and task == 'wra_sprite'
+
+    layout = compute_wra_sprite_layout(10, wra_matrices.shape[1:], cell_size_px)
+    # 4 x 3 grid of 120 x 360 tiles
+    assert layout[0] == (0, 0, 120, 360)
+    assert layout[5] == (124, 364, 120, 360)
+    with Image.open(dst) as im:
+        sheet = np.asarray(im.convert('RGB'))
+    assert sheet.shape == (3 * 360 + 2 * 4, 4 * 120 + 3 * 4, 3)
+
+    rgb = colorize_wras(wra_matrices)
+    for i, (x, y, w, h) in enumerate(layout):
+        # center of the cell (0, 0) and the border of the max focus region
+        assert tuple(sheet[y + 5, x + 5]) == tuple(rgb[i, 0, 0])
+        assert tuple(sheet[y + mfris[i] * cell_size_px, x + 2 * cell_size_px + 5]) == MAX_FOCUS_REGION_COLOR
+
+
+def test_wra_renderer_latency(tmp_path, wra_matrices: np.ndarray, context_tokens):
+    cell_size_px = 40
+    mfris = [0] * len(wra_matrices)
+
+    start = time.time()
+    for i, wra in enumerate(wra_matrices):
+        plot_wra(image_id=str(i),
+                 wra=wra,
+                 context_tokens=context_tokens,
+                 max_focus_region_idx=0,
+                 focus_span=(2, 3),
+                 cell_size_px=cell_size_px,
+                 dst=str(tmp_path / f"wra_{i}.png"))
+    logger.info(f"Plotting {len(wra_matrices)} WRAs with matplotlib took {time.time() - start}s")
+
+    start = time.time()
+    render_wra_sprite(wra_matrices, mfris, (2, 3), cell_size_px, str(tmp_path / "sprite.png"))
+    logger.info(f"Rendering the WRA sprite of {len(wra_matrices)} WRAs took {time.time() - start}s")
+
+
+def test_sprite_tiles_are_returned_per_request(wra_matrices: np.ndarray, context_tokens):
+    plotter = WRAPlotter()
+    renderer, plotter.renderer = plotter.renderer, 'sprite'
+    image_ids = [str(i) for i in range(10)]
+    mfris = list(range(10))
+    try:
+        # two concurrent requests that rank the same images with different wras
+        req_a = plotter.register_lazy_wra_plots(lambda *args, **kwargs: None, image_ids, wra_matrices, mfris,
+                                                (2, 3), context_tokens)
+        req_b = plotter.register_lazy_wra_plots(lambda *args, **kwargs: None, image_ids, wra_matrices[::-1], mfris,
+                                                (2, 3), context_tokens)
+    finally:
+        plotter.renderer = renderer
+
+    layout = compute_wra_sprite_layout(10, wra_matrices.shape[1:], plotter.cell_size_px)
+    fragments = [f"xywh={x},{y},{w},{h}" for x, y, w, h in layout]
+    for req in [req_a, req_b]:
+        # every image is a tile of the sprite sheet of its own request
+        assert len({dst for dst, _ in req}) == 1
+        assert [fragment for _, fragment in req] == fragments
+    assert req_a[0][0] != req_b[0][0]